@@ -0,0 +1,579 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import json
+import time
+import heapq
+import signal
+import socket
+import traceback
+import subprocess
+import SocketServer
+from optparse import OptionParser
+from threading import Thread, Condition
+
+from sonLib.bioio import addLoggingOptions, setLoggingFromOptions
+
+# progressiveCactus (and with it jobTree and cactus) is only imported by
+# the service itself, so the client commands start quickly
+
+defaultSocketPath = os.path.join(os.path.expanduser("~"),
+                                 ".progressiveCactus.sock")
+
+# Options of runProgressiveCactus.sh whose values are paths, and so have
+# to be resolved against the client's working directory
+pathOptions = ["optionsFile", "outputMaf", "configFile", "metricsPromFile"]
+
+# Kill a process and everything it started (cactus_progressive's jobTree
+# workers and ktservers), children first
+def killProcessTree(pid, sig=signal.SIGKILL):
+    children = dict()
+    try:
+        for line in subprocess.check_output(["ps", "-eo", "pid=,ppid="]).\
+                split("\n"):
+            tokens = line.split()
+            if len(tokens) == 2:
+                children.setdefault(int(tokens[1]), []).append(
+                    int(tokens[0]))
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    pids = []
+    stack = [pid]
+    while len(stack) > 0:
+        p = stack.pop()
+        pids.append(p)
+        stack += children.get(p, [])
+    for p in reversed(pids):
+        try:
+            os.kill(p, sig)
+        except OSError:
+            pass
+
+class JobCancelled(Exception):
+    pass
+
+# The state dictionary runAlignment() fills in for a job.  A process set
+# in it after the job was cancelled is killed straight away, so a
+# cancellation can't slip in between the slot being taken and
+# cactus_progressive starting.
+class JobState(dict):
+    def __init__(self, job):
+        dict.__init__(self)
+        self.job = job
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if key == "process" and self.job.cancelRequested:
+            killProcessTree(value.pid)
+
+###############################################################################
+# One alignment submitted to the service.  Its state goes from queued to
+# running, then to succeeded, failed or cancelled.
+###############################################################################
+class AlignmentJob:
+    stageNames = ["setup", "alignment", "export"]
+    def __init__(self, jobId, name, args, options, priority):
+        self.jobId = jobId
+        self.name = name
+        self.args = args
+        self.options = options
+        self.priority = priority
+        self.seqFile, self.workDir, self.outputHalFile = args
+        self.state = "queued"
+        self.jobState = JobState(self)
+        self.cancelRequested = False
+        self.submitTime = time.time()
+        self.startTime = None
+        self.endTime = None
+        self.error = None
+
+    def stage(self):
+        if self.state != "running" or "stage" not in self.jobState:
+            return None
+        return AlignmentJob.stageNames[self.jobState["stage"]]
+
+    # The last sample written by the job's MetricsExporter, if any
+    def lastMetrics(self):
+        path = os.path.join(self.workDir, "metrics.jsonl")
+        if not os.path.isfile(path):
+            return None
+        try:
+            metricsFile = open(path, "r")
+            metricsFile.seek(max(0, os.path.getsize(path) - 65536))
+            lines = metricsFile.read().strip().split("\n")
+            metricsFile.close()
+            return json.loads(lines[-1])
+        except (IOError, ValueError):
+            return None
+
+    def status(self, detailed=False):
+        now = time.time()
+        status = { "id" : self.jobId,
+                   "name" : self.name,
+                   "priority" : self.priority,
+                   "state" : self.state,
+                   "cancelRequested" : self.cancelRequested,
+                   "stage" : self.stage(),
+                   "seqFile" : self.seqFile,
+                   "workDir" : self.workDir,
+                   "outputHalFile" : self.outputHalFile,
+                   "submitTime" : self.submitTime,
+                   "startTime" : self.startTime,
+                   "endTime" : self.endTime,
+                   "queuedSeconds" : (self.startTime or now) -
+                                     self.submitTime,
+                   "error" : self.error }
+        if self.startTime is not None:
+            status["runSeconds"] = (self.endTime or now) - self.startTime
+        if detailed:
+            report = self.jobState.get("report")
+            if report is not None:
+                status["stageSeconds"] = dict(
+                    [(stage["name"], stage["wallTime"]) for stage in
+                     report.stages])
+            status["metrics"] = self.lastMetrics()
+        return status
+
+###############################################################################
+# Run submitted alignments from one long-lived process, so the Python
+# interpreter, sonLib, jobTree, cactus and the environment are only loaded
+# once rather than for every alignment.
+#
+# Jobs wait in a priority queue (higher priorities first, then in order of
+# submission) and are run by a pool of worker threads that are started up
+# front.  As with progressiveCactusBatch, at most numSlots alignments are
+# in their setup and alignment stages at once, each with its own range of
+# ktserver ports, and there are twice as many workers as slots so that HAL
+# exports overlap alignments.
+###############################################################################
+class AlignmentService:
+    def __init__(self, numSlots, basePort, portsPerSlot):
+        from progressiveCactus import initParser, runAlignment
+        from progressiveCactusBatch import AlignmentSlots
+        self.initParser = initParser
+        self.runAlignment = runAlignment
+        self.slots = AlignmentSlots(numSlots, basePort, portsPerSlot)
+        self.numSlots = numSlots
+        self.condition = Condition()
+        self.queue = []
+        self.jobs = dict()
+        self.jobOrder = []
+        self.nextId = 1
+        self.running = True
+        self.startTime = time.time()
+        self.workers = []
+        for i in xrange(2 * numSlots):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # Parse the command line of a submission (the arguments of
+    # runProgressiveCactus.sh) and queue it.  Raises RuntimeError if it
+    # can't be run.
+    def submit(self, args, cwd, priority=0, name=None):
+        from progressiveCactus import parseOptionsFile
+        parser = self.initParser()
+        def parserError(msg):
+            raise RuntimeError(msg)
+        parser.error = parserError
+        argv = list(args)
+        try:
+            options, args = parser.parse_args(argv)
+            if options.optionsFile is not None:
+                options, args = parser.parse_args(parseOptionsFile(
+                    os.path.join(cwd, options.optionsFile)) + argv)
+        except SystemExit:
+            # ie --help
+            raise RuntimeError("Invalid arguments: %s" % " ".join(argv))
+        if len(args) != 3:
+            raise RuntimeError("Expected <seqFile> <workDir> <outputHalFile>"
+                               " but got %d arguments" % len(args))
+        if options.plan:
+            raise RuntimeError("--plan can't be used with the service")
+        if (options.rootOutgroupDists is not None) ^ \
+               (options.rootOutgroupPaths is not None):
+            raise RuntimeError("--rootOutgroupDists and --rootOutgroupPaths "
+                               "must be provided together")
+        for option in pathOptions:
+            if getattr(options, option) is not None:
+                setattr(options, option,
+                        os.path.join(cwd, getattr(options, option)))
+        if options.rootOutgroupPaths is not None:
+            options.rootOutgroupPaths = ",".join(
+                [os.path.join(cwd, p) for p in
+                 options.rootOutgroupPaths.split(",")])
+        args = [os.path.abspath(os.path.join(cwd, arg)) for arg in args]
+        with self.condition:
+            if not self.running:
+                raise RuntimeError("The service is shutting down")
+            for job in self.jobs.values():
+                if job.state in ["queued", "running"] and \
+                       (job.workDir == args[1] or
+                        job.outputHalFile == args[2]):
+                    raise RuntimeError("Job %d is already using %s" % (
+                        job.jobId, job.workDir if job.workDir == args[1]
+                        else job.outputHalFile))
+            jobId = self.nextId
+            self.nextId += 1
+            if name is None:
+                name = os.path.splitext(os.path.basename(args[2]))[0]
+            job = AlignmentJob(jobId, name, args, options, priority)
+            self.jobs[jobId] = job
+            self.jobOrder.append(jobId)
+            heapq.heappush(self.queue, (-priority, jobId))
+            self.condition.notify()
+        return job
+
+    # Worker thread: run queued jobs until the service shuts down
+    def work(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait(1)
+                if not self.running:
+                    return
+                priority, jobId = heapq.heappop(self.queue)
+                job = self.jobs[jobId]
+                if job.state != "queued":
+                    continue
+                job.state = "running"
+                job.startTime = time.time()
+            self.runJob(job)
+
+    def runJob(self, job):
+        parser = self.initParser()
+        slot = CancellableSlot(job, self.slots.slot())
+        try:
+            self.runAlignment(job.seqFile, job.workDir, job.outputHalFile,
+                              job.options, parser, job.jobState, slot)
+            state = "succeeded"
+        except Exception, e:
+            state = "failed"
+            job.error = str(e)
+            if not isinstance(e, RuntimeError) and \
+                   not isinstance(e, JobCancelled):
+                job.error += "\n" + traceback.format_exc()
+            if job.jobState.get("report") is not None:
+                job.jobState["report"].write()
+        if job.cancelRequested and state == "failed":
+            state = "cancelled"
+            job.error = None
+        with self.condition:
+            job.state = state
+            job.endTime = time.time()
+        sys.stderr.write("Job %d (%s) %s after %ds\n" % (
+            job.jobId, job.name, state, job.endTime - job.startTime))
+
+    # Cancel a job: a queued job is dropped, and a running one is killed
+    # (along with everything cactus_progressive started), leaving its
+    # working directory to be resumed by a later submission.  A job that's
+    # exporting its output can't be cancelled.
+    def cancel(self, jobId):
+        with self.condition:
+            job = self.getJob(jobId)
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.endTime = time.time()
+                return job
+            if job.state != "running":
+                raise RuntimeError("Job %d has already %s" % (jobId,
+                                                              job.state))
+            if job.stage() == "export":
+                raise RuntimeError("Job %d is exporting its output and can't "
+                                   "be cancelled" % jobId)
+            job.cancelRequested = True
+            process = job.jobState.get("process")
+        # runCommand() is the one waiting on the process, so don't poll()
+        if process is not None and process.returncode is None:
+            killProcessTree(process.pid)
+        return job
+
+    def getJob(self, jobId):
+        try:
+            return self.jobs[int(jobId)]
+        except (KeyError, ValueError, TypeError):
+            raise RuntimeError("No job %s" % str(jobId))
+
+    def status(self, jobId=None):
+        with self.condition:
+            if jobId is not None:
+                return self.getJob(jobId).status(detailed=True)
+            return [self.jobs[i].status() for i in self.jobOrder]
+
+    def metrics(self):
+        with self.condition:
+            counts = dict([(state, 0) for state in
+                           ["queued", "running", "succeeded", "failed",
+                            "cancelled"]])
+            stages = dict([(stage, 0) for stage in AlignmentJob.stageNames])
+            finished = []
+            for job in self.jobs.values():
+                counts[job.state] += 1
+                if job.stage() is not None:
+                    stages[job.stage()] += 1
+                if job.endTime is not None and job.startTime is not None:
+                    finished.append(job)
+            metrics = { "uptime" : time.time() - self.startTime,
+                        "slots" : self.numSlots,
+                        "workers" : len(self.workers),
+                        "jobs" : counts,
+                        "runningStages" : stages }
+            if len(finished) > 0:
+                metrics["meanQueuedSeconds"] = sum(
+                    [j.startTime - j.submitTime for j in finished]) / \
+                    len(finished)
+                metrics["meanRunSeconds"] = sum(
+                    [j.endTime - j.startTime for j in finished]) / \
+                    len(finished)
+            return metrics
+
+    # Stop taking jobs, cancel the queued ones and, if cancelRunning is
+    # set, the running ones too
+    def shutdown(self, cancelRunning=False):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+            jobs = self.jobs.values()
+        for job in jobs:
+            if job.state == "queued" or \
+                   (cancelRunning and job.state == "running" and
+                    job.stage() != "export"):
+                self.cancel(job.jobId)
+
+    # Wait for the running jobs to finish
+    def wait(self):
+        for worker in self.workers:
+            while worker.is_alive():
+                worker.join(1)
+
+# AlignmentSlot that gives up (rather than starting the alignment) if its
+# job was cancelled while it waited for the slot
+class CancellableSlot:
+    def __init__(self, job, slot):
+        self.job = job
+        self.slot = slot
+
+    def acquire(self, options):
+        self.slot.acquire(options)
+        if self.job.cancelRequested:
+            self.slot.release()
+            raise JobCancelled("Cancelled")
+
+    def release(self):
+        self.slot.release()
+
+###############################################################################
+# The service listens on a Unix socket.  Each connection sends one
+# request, a line of json with a "command" (submit, status, cancel, metrics
+# or shutdown) and its arguments, and gets back one line of json: the
+# result, or an "error".
+###############################################################################
+class ServiceRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = { "result" : self.server.dispatch(request) }
+        except RuntimeError, e:
+            response = { "error" : str(e) }
+        except Exception, e:
+            response = { "error" : "%s\n%s" % (str(e),
+                                                traceback.format_exc()) }
+        self.wfile.write(json.dumps(response) + "\n")
+
+class ServiceServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+    def __init__(self, socketPath, service):
+        SocketServer.ThreadingUnixStreamServer.__init__(
+            self, socketPath, ServiceRequestHandler)
+        self.service = service
+
+    def dispatch(self, request):
+        command = request.get("command")
+        service = self.service
+        if command == "submit":
+            job = service.submit(request["args"], request["cwd"],
+                                 int(request.get("priority", 0)),
+                                 request.get("name"))
+            return job.status()
+        elif command == "status":
+            return service.status(request.get("id"))
+        elif command == "cancel":
+            return service.cancel(request["id"]).status()
+        elif command == "metrics":
+            return service.metrics()
+        elif command == "shutdown":
+            service.shutdown(bool(request.get("cancelRunning", False)))
+            Thread(target=self.shutdown).start()
+            return service.metrics()
+        raise RuntimeError("Unknown command %s" % str(command))
+
+# Send a request to the service and return its result
+def sendRequest(socketPath, request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socketPath)
+        except socket.error, e:
+            raise RuntimeError("Can't connect to the service at %s: %s" % (
+                socketPath, str(e)))
+        sockFile = sock.makefile("rw")
+        sockFile.write(json.dumps(request) + "\n")
+        sockFile.flush()
+        response = json.loads(sockFile.readline())
+        sockFile.close()
+    finally:
+        sock.close()
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["result"]
+
+def formatJobs(jobs):
+    lines = ["%5s %-24s %4s %-10s %-10s %8s" % ("id", "name", "pri", "state",
+                                              "stage", "time")]
+    for job in jobs:
+        seconds = job.get("runSeconds", job["queuedSeconds"])
+        lines.append("%5d %-24s %4d %-10s %-10s %7ds" % (
+            job["id"], job["name"][:24], job["priority"], job["state"],
+            job["stage"] or "-", seconds))
+    return "\n".join(lines)
+
+def startService(options):
+    setLoggingFromOptions(options)
+    if os.path.exists(options.socket):
+        try:
+            sendRequest(options.socket, { "command" : "metrics" })
+            raise RuntimeError("A service is already listening on %s" %
+                               options.socket)
+        except RuntimeError, e:
+            if "already listening" in str(e):
+                raise
+            # left behind by a service that's gone
+            os.remove(options.socket)
+    service = AlignmentService(options.concurrent, options.ktPort,
+                               options.portsPerAlignment)
+    # the socket is created private: anyone who can connect to it can run
+    # jobs as this user
+    oldUmask = os.umask(0077)
+    try:
+        server = ServiceServer(options.socket, service)
+    finally:
+        os.umask(oldUmask)
+    signal.signal(signal.SIGTERM,
+                  lambda sig, frame: Thread(target=server.shutdown).start())
+    print "Listening on %s with %d alignment slots" % (options.socket,
+                                                       options.concurrent)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(options.socket)
+        service.shutdown(cancelRunning=True)
+        service.wait()
+    return 0
+
+def main():
+    parser = OptionParser(usage="usage: progressiveCactusService.sh "
+                          "[options] <command> [arguments]\n\n"
+                          "Commands:\n"
+                          "  start                 run the service\n"
+                          "  submit <args>         queue an alignment, where "
+                          "<args> are those of\n"
+                          "                        runProgressiveCactus.sh\n"
+                          "  status [<id>]         list the jobs, or show one "
+                          "in detail\n"
+                          "  cancel <id>           cancel a job\n"
+                          "  metrics               show the service's "
+                          "counters\n"
+                          "  shutdown              stop taking jobs and exit "
+                          "once the running\n"
+                          "                        ones are done")
+    parser.disable_interspersed_args()
+    parser.add_option("--socket", dest="socket", default=defaultSocketPath,
+                      help="Path of the service's Unix socket "
+                      "[default: %default]")
+    parser.add_option("--concurrent", dest="concurrent", type=int, default=1,
+                      help="(start) Number of alignments to run at once "
+                      "[default: %default]")
+    parser.add_option("--ktPort", dest="ktPort", type=int, default=1978,
+                      help="(start) First ktserver port given to the "
+                      "alignments [default: %default]")
+    parser.add_option("--portsPerAlignment", dest="portsPerAlignment",
+                      type=int, default=100, help="(start) Size of the range "
+                      "of ktserver ports given to each running alignment "
+                      "[default: %default]")
+    parser.add_option("--priority", dest="priority", type=int, default=0,
+                      help="(submit) Priority of the job; higher runs first "
+                      "[default: %default]")
+    parser.add_option("--name", dest="name", default=None,
+                      help="(submit) Name of the job [default: the output's "
+                      "file name]")
+    parser.add_option("--cancelRunning", dest="cancelRunning",
+                      action="store_true", default=False,
+                      help="(shutdown) Cancel the running jobs too")
+    parser.add_option("--json", dest="json", action="store_true",
+                      default=False, help="Print results as json")
+    addLoggingOptions(parser)
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.print_help()
+        return 1
+    command = args[0]
+    try:
+        if command == "start":
+            if options.concurrent < 1:
+                raise RuntimeError("--concurrent must be at least 1")
+            return startService(options)
+        if command == "submit":
+            submitArgs = args[1:]
+            if len(submitArgs) > 0 and submitArgs[0] == "--":
+                submitArgs = submitArgs[1:]
+            request = { "args" : submitArgs, "cwd" : os.getcwd(),
+                        "priority" : options.priority, "name" : options.name }
+        elif command == "status" and len(args) <= 2:
+            request = { "id" : args[1] if len(args) == 2 else None }
+        elif command == "cancel" and len(args) == 2:
+            request = { "id" : args[1] }
+        elif command == "metrics":
+            request = dict()
+        elif command == "shutdown":
+            request = { "cancelRunning" : options.cancelRunning }
+        else:
+            parser.print_help()
+            return 1
+        request["command"] = command
+        result = sendRequest(options.socket, request)
+    except RuntimeError, e:
+        sys.stderr.write("Error: %s\n" % str(e))
+        return 1
+    if options.json or (command == "status" and len(args) == 2) or \
+           command in ["metrics", "shutdown"]:
+        print json.dumps(result, indent=2, sort_keys=True)
+    elif command == "status":
+        print formatJobs(result)
+    else:
+        print formatJobs([result])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
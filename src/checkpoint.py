@@ -0,0 +1,339 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import json
+import time
+import datetime
+import xml.etree.ElementTree as ET
+from threading import RLock, Thread, Event
+
+from cactus.progressive.multiCactusProject import MultiCactusProject
+from cactus.shared.experimentWrapper import ExperimentWrapper
+
+from projectWrapper import ProjectWrapper
+from seqManifest import fingerprintPath
+
+# (size, mtime) of each of a list of files, or None if any is missing
+def filesSignature(paths):
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        signature += [st.st_size, st.st_mtime]
+    return signature
+
+###############################################################################
+# Durable record of what a progressive alignment in a working directory
+# has finished: the ancestral events whose outputs (the .c2h and .fa files
+# that cactus writes at the end of an event) are complete, with a
+# fingerprint (see seqManifest) of those outputs, and the HAL file each
+# event was exported to by the IncrementalHalExporter.  It's kept in
+# <workDir>/checkpoint.json.
+#
+# cactus_progressive skips any event whose outputs exist, so what a
+# restart re-runs is decided by which outputs are there.  update() is
+# called while the alignment runs to record events once their outputs
+# have stopped changing for settleTime seconds.  validate() is called
+# before a restart: outputs that no longer match their fingerprint, went
+# missing, or are empty (ie cut short by a node failure) are deleted
+# along with those of every event above them (which were aligned from
+# them), so exactly the events that are missing or suspect get aligned
+# again and nothing that was verified is.
+#
+# Outputs that were never recorded finished after the last update (or
+# were still changing at the time), so they may have been cut short by a
+# crash and are aligned again too.  The one exception is a working
+# directory that has never been checkpointed (ie from before checkpoints
+# were kept).  If its cactus.log shows the last alignment finished, its
+# outputs are all trusted.  Otherwise they're only trusted if they had
+# settled before the last write to any event's directory, ie before the
+# last run ended.
+###############################################################################
+class Checkpoint:
+    fileName = "checkpoint.json"
+    # state file of the IncrementalHalExporter before it moved in here
+    oldHalExportName = "halExport.json"
+    def __init__(self, workDir, settleTime=60):
+        self.workDir = workDir
+        self.settleTime = settleTime
+        self.path = os.path.join(workDir, Checkpoint.fileName)
+        self.lock = RLock()
+        self.mcProj = MultiCactusProject()
+        self.mcProj.readXML(os.path.join(
+            workDir, ProjectWrapper.alignmentDirName,
+            "%s_project.xml" % ProjectWrapper.alignmentDirName))
+        tree = self.mcProj.mcTree
+        # parent event of each event, and events in postorder
+        self.parentEvent = dict()
+        self.events = []
+        for node in tree.postOrderTraversal():
+            name = tree.getName(node)
+            if name not in self.mcProj.expMap:
+                continue
+            self.events.append(name)
+            self.parentEvent[name] = None
+            parent = node
+            while tree.hasParent(parent):
+                parent = tree.getParent(parent)
+                if tree.getName(parent) in self.mcProj.expMap:
+                    self.parentEvent[name] = tree.getName(parent)
+                    break
+        self.outputs = dict()
+        for event in self.events:
+            exp = ExperimentWrapper(ET.parse(
+                self.mcProj.expMap[event]).getroot())
+            self.outputs[event] = [exp.getHALPath(), exp.getHALFastaPath()]
+        self.entries = dict()
+        # time of the last update() or validate(), when every output on
+        # disk was either recorded or known to be unfinished
+        self.updated = None
+        if os.path.isfile(self.path):
+            try:
+                state = json.load(open(self.path, "r"))
+                if "events" in state and "updated" in state:
+                    self.entries = state["events"]
+                    self.updated = state["updated"]
+                else:
+                    # written before the update time was kept
+                    self.entries = state
+            except:
+                sys.stderr.write("Ignoring unreadable checkpoint %s\n" %
+                                 self.path)
+                self.entries = dict()
+        self.importHalExport()
+
+    def importHalExport(self):
+        oldPath = os.path.join(self.workDir, Checkpoint.oldHalExportName)
+        if not os.path.isfile(oldPath):
+            return
+        try:
+            for event, state in json.load(open(oldPath, "r")).items():
+                self.setExported(event, state["hal"], state["signature"])
+        except:
+            sys.stderr.write("Ignoring unreadable HAL export state %s\n" %
+                             oldPath)
+        self.write()
+        os.remove(oldPath)
+
+    def signature(self, event):
+        return filesSignature(self.outputs[event])
+
+    def fingerprint(self, event):
+        return [fingerprintPath(path) for path in self.outputs[event]]
+
+    def isComplete(self, event):
+        entry = self.entries.get(event)
+        return entry is not None and "fingerprint" in entry and \
+               entry["signature"] == self.signature(event)
+
+    def completeEvents(self):
+        return [e for e in self.events if self.isComplete(e)]
+
+    # Events that aren't complete but whose child events all are, ie
+    # what a restart will align first
+    def frontier(self):
+        complete = set(self.completeEvents())
+        blocked = set()
+        for event in self.events:
+            if event not in complete and self.parentEvent[event] is not None:
+                blocked.add(self.parentEvent[event])
+        return [e for e in self.events if e not in complete and
+                e not in blocked]
+
+    # Record the events whose outputs have appeared (or changed) and
+    # have settled (for settleTime seconds, if given), and return their
+    # names
+    def update(self, settleTime=None):
+        if settleTime is None:
+            settleTime = self.settleTime
+        recorded = []
+        now = time.time()
+        with self.lock:
+            self.updated = now
+            for event in self.events:
+                signature = self.signature(event)
+                if signature is None or 0 in signature[0::2] or \
+                       max(signature[1::2]) > now - settleTime:
+                    continue
+                entry = self.entries.setdefault(event, dict())
+                if entry.get("signature") == signature and \
+                       "fingerprint" in entry:
+                    continue
+                entry["signature"] = signature
+                entry["fingerprint"] = self.fingerprint(event)
+                entry["finished"] = max(signature[1::2])
+                recorded.append(event)
+            self.write()
+        return recorded
+
+    # Time the last run ended, as far as we can tell without a
+    # checkpoint: the last change to anything in an event's directory
+    def lastRunEnd(self):
+        end = None
+        for event in self.events:
+            eventDir = os.path.dirname(os.path.abspath(
+                self.mcProj.expMap[event]))
+            try:
+                names = os.listdir(eventDir)
+            except OSError:
+                continue
+            for name in names:
+                try:
+                    mtime = os.stat(os.path.join(eventDir, name)).st_mtime
+                except OSError:
+                    continue
+                end = max(end, mtime)
+        return end
+
+    # Did the last alignment logged in cactus.log finish?  True if there's
+    # no alignment in the log to go by.
+    def lastRunFinished(self):
+        finished = True
+        try:
+            logFile = open(os.path.join(self.workDir, "cactus.log"), "r")
+        except IOError:
+            return finished
+        for line in logFile:
+            if "Beginning Progressive Cactus Alignment" in line:
+                finished = False
+            elif "Finished Progressive Cactus Alignment" in line:
+                finished = True
+        logFile.close()
+        return finished
+
+    # Check the outputs in the working directory against the checkpoint
+    # before a restart.  Events whose outputs can't be vouched for are
+    # deleted, along with their ancestors', and forgotten.  Returns the
+    # names of the events that were invalidated.
+    def validate(self):
+        invalid = set()
+        with self.lock:
+            # a working directory that was never checkpointed: trust its
+            # outputs if its last run finished, otherwise only those that
+            # had settled before it ended
+            trustUnrecorded = False
+            lastRunEnd = None
+            if self.updated is None:
+                trustUnrecorded = self.lastRunFinished()
+                if not trustUnrecorded:
+                    lastRunEnd = self.lastRunEnd()
+            for event in self.events:
+                signature = self.signature(event)
+                entry = self.entries.get(event, dict())
+                if signature is None:
+                    # not finished, or lost since
+                    if "fingerprint" in entry:
+                        invalid.add(event)
+                elif 0 in signature[0::2]:
+                    invalid.add(event)
+                elif "fingerprint" not in entry:
+                    finished = max(signature[1::2])
+                    if not trustUnrecorded and (
+                        self.updated is not None or lastRunEnd is None or
+                        finished > lastRunEnd - self.settleTime):
+                        # finished too close to the crash to be trusted
+                        invalid.add(event)
+                        continue
+                    entry["signature"] = signature
+                    entry["fingerprint"] = self.fingerprint(event)
+                    entry["finished"] = finished
+                    self.entries[event] = entry
+                elif entry["signature"] != signature:
+                    if entry["fingerprint"] == self.fingerprint(event):
+                        # touched but unchanged
+                        entry["signature"] = signature
+                    else:
+                        invalid.add(event)
+            for event in list(invalid):
+                parent = self.parentEvent[event]
+                while parent is not None:
+                    invalid.add(parent)
+                    parent = self.parentEvent[parent]
+            for event in invalid:
+                for path in self.outputs[event]:
+                    if path is not None and os.path.isfile(path):
+                        os.remove(path)
+                if event in self.entries:
+                    del self.entries[event]
+            self.updated = time.time()
+            self.write()
+        return [e for e in self.events if e in invalid]
+
+    # Has an event been exported from its current outputs?
+    def isExported(self, event, signature):
+        entry = self.entries.get(event)
+        return entry is not None and "hal" in entry and \
+               os.path.isfile(entry["hal"]) and signature is not None and \
+               entry["halSignature"] == signature
+
+    def exportedPath(self, event):
+        return self.entries[event]["hal"]
+
+    def setExported(self, event, halPath, signature):
+        with self.lock:
+            entry = self.entries.setdefault(event, dict())
+            entry["hal"] = halPath
+            entry["halSignature"] = signature
+            self.write()
+
+    # Forget everything (ie when the alignment is restarted from scratch)
+    def clear(self):
+        with self.lock:
+            self.entries = dict()
+            self.updated = time.time()
+            self.write()
+
+    def write(self):
+        with self.lock:
+            tempPath = self.path + ".tmp"
+            checkpointFile = open(tempPath, "w")
+            json.dump({ "updated" : self.updated, "events" : self.entries },
+                      checkpointFile, indent=1, sort_keys=True)
+            checkpointFile.close()
+            os.rename(tempPath, self.path)
+
+###############################################################################
+# Keep a Checkpoint up to date while the alignment runs, calling update()
+# every pollTime seconds.
+###############################################################################
+class CheckpointThread(Thread):
+    def __init__(self, checkpoint, pollTime=60):
+        Thread.__init__(self)
+        self.checkpoint = checkpoint
+        self.pollTime = pollTime
+        self.stopEvent = Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.checkpoint.update()
+            except Exception, e:
+                sys.stderr.write("%s: Checkpoint update failed: %s\n" % (
+                    str(datetime.datetime.now()), str(e)))
+            self.stopEvent.wait(self.pollTime)
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import Queue
+from threading import Thread, Lock
+from multiprocessing.pool import ThreadPool
+
+from sonLib.bioio import logger
+
+###############################################################################
+# Remove big directory trees (ie a jobTree with millions of files on NFS)
+# without making anybody wait.
+#
+# remove() renames a directory into a .cactusTrash directory next to it,
+# which is atomic and instant, so the path is free to be reused right
+# away.  A background thread then deletes what's in the trash: the top of
+# each tree is split into subtrees that a pool of threads unlink in
+# parallel (which is what makes a difference on network filesystems),
+# with progress written to the log every progressInterval seconds.
+#
+# Anything left in a trash directory by a run that was interrupted is
+# picked up the next time something is removed next to it.
+###############################################################################
+class DirRemover(Thread):
+    trashName = ".cactusTrash"
+    def __init__(self, numThreads=16, progressInterval=60):
+        Thread.__init__(self)
+        self.numThreads = numThreads
+        self.progressInterval = progressInterval
+        self.queue = Queue.Queue()
+        self.queued = set()
+        self.lock = Lock()
+        # files and directories removed from the current tree
+        self.removed = 0
+        self.daemon = True
+
+    # Move path out of the way and delete it in the background
+    def remove(self, path):
+        if not os.path.lexists(path):
+            return
+        path = os.path.abspath(path)
+        trashDir = os.path.join(os.path.dirname(path), DirRemover.trashName)
+        if not os.path.isdir(trashDir):
+            os.makedirs(trashDir)
+        trashPath = os.path.join(trashDir, "%s.%d.%d" % (
+            os.path.basename(path), int(time.time() * 1000), os.getpid()))
+        os.rename(path, trashPath)
+        for name in os.listdir(trashDir):
+            self.__enqueue(os.path.join(trashDir, name))
+        if not self.is_alive():
+            self.start()
+
+    def __enqueue(self, path):
+        with self.lock:
+            if path not in self.queued:
+                self.queued.add(path)
+                self.queue.put(path)
+
+    # Delete the files and directories of a subtree, bottom up (run in a
+    # pool thread), and return how many there were
+    def removeSubtree(self, path):
+        count = 0
+        for dirPath, dirNames, fileNames in os.walk(path, topdown=False):
+            for name in fileNames + [d for d in dirNames if os.path.islink(
+                os.path.join(dirPath, d))]:
+                os.remove(os.path.join(dirPath, name))
+                count += 1
+            os.rmdir(dirPath)
+            count += 1
+            if count >= 1000:
+                self.__count(count)
+                count = 0
+        self.__count(count)
+        return path
+
+    def __count(self, count):
+        with self.lock:
+            self.removed += count
+
+    # Delete a directory tree now, with the pool of threads
+    def removeTree(self, path):
+        if not os.path.isdir(path) or os.path.islink(path):
+            os.remove(path)
+            return
+        self.removed = 0
+        start = time.time()
+        # split the tree into enough subtrees to keep the threads busy,
+        # removing the files met on the way
+        tops = []
+        subtrees = [path]
+        while 0 < len(subtrees) < self.numThreads * 4:
+            expanded = []
+            for dirPath in subtrees:
+                tops.append(dirPath)
+                for name in os.listdir(dirPath):
+                    childPath = os.path.join(dirPath, name)
+                    if os.path.isdir(childPath) and \
+                           not os.path.islink(childPath):
+                        expanded.append(childPath)
+                    else:
+                        os.remove(childPath)
+                        self.__count(1)
+            subtrees = expanded
+        pool = ThreadPool(self.numThreads)
+        try:
+            result = pool.map_async(self.removeSubtree, subtrees)
+            while not result.ready():
+                result.wait(self.progressInterval)
+                if not result.ready():
+                    logger.info("Removing %s: %d files removed in %ds" % (
+                        path, self.removed, time.time() - start))
+            result.get()
+        finally:
+            pool.close()
+            pool.join()
+        for dirPath in reversed(tops):
+            os.rmdir(dirPath)
+        logger.info("Removed %s: %d files in %ds" % (
+            path, self.removed + len(tops), time.time() - start))
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            try:
+                self.removeTree(path)
+            except Exception, e:
+                sys.stderr.write("Unable to remove %s: %s\n" % (path, str(e)))
+            with self.lock:
+                self.queued.discard(path)
+            self.queue.task_done()
+
+    # Block until everything that was removed is really gone
+    def wait(self):
+        self.queue.join()
+
+defaultRemover = None
+defaultRemoverLock = Lock()
+
+# Remove a file or directory tree like rm -rf.  Unless background is
+# False, it's moved out of the way straight away and deleted in the
+# background by the shared DirRemover.
+def removeDir(path, background=True):
+    global defaultRemover
+    if background:
+        # several alignments (threads) can get here at once
+        with defaultRemoverLock:
+            if defaultRemover is None:
+                defaultRemover = DirRemover()
+        defaultRemover.remove(path)
+    elif os.path.lexists(path):
+        DirRemover().removeTree(path)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from jobTree.src.job import Job
+
+from seqFile import SeqFile
+from projectWrapper import ProjectWrapper
+from jobTreeIndex import JobTreeIndex
+
+# Job files per directory of a synthetic jobTree, about what jobTree
+# itself uses
+jobsPerDir = 100
+
+# Random binary tree with numLeaves leaves named g0, g1, ... and random
+# branch lengths, in newick format.  Nodes are joined at random (like a
+# coalescent), so the depth stays roughly logarithmic.
+def randomNewick(numLeaves, rng):
+    nodes = ["g%d" % i for i in xrange(numLeaves)]
+    label = 0
+    while len(nodes) > 1:
+        i, j = rng.sample(xrange(len(nodes)), 2)
+        joined = "(%s:%.3f,%s:%.3f)a%d" % (nodes[i], rng.uniform(0.01, 0.3),
+                                           nodes[j], rng.uniform(0.01, 0.3),
+                                           label)
+        label += 1
+        for k in sorted([i, j], reverse=True):
+            nodes[k] = nodes[-1]
+            nodes.pop()
+        nodes.append(joined)
+    return nodes[0] + ";"
+
+# Write a seqFile for a random tree of numLeaves leaves, along with a small
+# fasta file for each leaf, under dirPath.  A fraction missing of the
+# leaves get no sequence line, so cleanTree has something to prune.
+def makeSeqFile(dirPath, numLeaves, rng, seqLength=1000, missing=0.1):
+    seqDir = os.path.join(dirPath, "sequences")
+    os.makedirs(seqDir)
+    seqFilePath = os.path.join(dirPath, "seqFile.txt")
+    seqFile = open(seqFilePath, "w")
+    seqFile.write(randomNewick(numLeaves, rng) + "\n")
+    for i in xrange(numLeaves):
+        if i > 1 and rng.random() < missing:
+            continue
+        path = os.path.join(seqDir, "g%d.fa" % i)
+        fastaFile = open(path, "w")
+        fastaFile.write(">g%d\n" % i)
+        for j in xrange(0, seqLength, 80):
+            fastaFile.write("".join([rng.choice("ACGTacgtN") for k in
+                                     xrange(min(80, seqLength - j))]) + "\n")
+        fastaFile.close()
+        seqFile.write("g%d %s\n" % (i, path))
+    seqFile.close()
+    return seqFilePath
+
+# Write numJobs job files into a jobTree-style tree of directories (at
+# most about jobsPerDir entries per directory) under jobDir.  Most jobs
+# are waiting on children, a few are runnable and a few have failed.
+def makeJobTree(jobDir, numJobs, rng):
+    for i in xrange(numJobs):
+        dirPath = jobDir
+        dirNum = i / jobsPerDir
+        while dirNum > 0:
+            dirPath = os.path.join(dirPath, "t%d" % (dirNum % jobsPerDir))
+            dirNum /= jobsPerDir
+        jobPath = os.path.join(dirPath, "j%d" % i)
+        os.makedirs(jobPath)
+        retries = 0 if rng.random() < 0.01 else 3
+        job = Job("true", 1024, 1, retries, jobPath)
+        if rng.random() < 0.9:
+            job.children.append(("true", 1024, 1))
+        job.write()
+
+# Best wall-clock time over repeat calls of fn, in seconds
+def timeIt(fn, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# progressiveCactus's default options, as ProjectWrapper expects them
+def defaultOptions():
+    from progressiveCactus import initParser
+    options, args = initParser().parse_args([])
+    return options
+
+###############################################################################
+# Time the SeqFile and ProjectWrapper code paths on a seqFile with
+# numLeaves leaves, returning name -> seconds.  ProjectWrapper is built in
+# dryRun mode, so only the XML generation is timed (not
+# cactus_createMultiCactusProject).
+###############################################################################
+def benchmarkSeqFile(numLeaves, repeat, rng):
+    results = dict()
+    tempDir = tempfile.mkdtemp(prefix="cactusBenchmark")
+    try:
+        seqFilePath = makeSeqFile(tempDir, numLeaves, rng)
+        results["SeqFile.parseFile"] = timeIt(
+            lambda: SeqFile(seqFilePath), repeat)
+        seqFile = SeqFile(seqFilePath)
+        results["SeqFile.cleanTree"] = timeIt(seqFile.cleanTree, repeat)
+        results["SeqFile.validate"] = timeIt(seqFile.validate, repeat)
+        results["SeqFile.toXMLElement"] = timeIt(seqFile.toXMLElement,
+                                                 repeat)
+        options = defaultOptions()
+        workDir = os.path.join(tempDir, "work")
+        os.mkdir(workDir)
+        def makeProject():
+            projWrapper = ProjectWrapper(options, seqFile, workDir,
+                                         dryRun=True)
+            projWrapper.configWrapper.writeXML(
+                os.path.join(workDir, "config.xml"))
+            projWrapper.expWrapper.writeXML(
+                os.path.join(workDir, "expTemplate.xml"))
+        results["ProjectWrapper.xml"] = timeIt(makeProject, repeat)
+    finally:
+        shutil.rmtree(tempDir)
+    return results
+
+###############################################################################
+# Time polling a synthetic jobTree of numJobs jobs the way the
+# JobStatusMonitor does: a first (cold) update of the JobTreeIndex, an
+# update where nothing changed, and one where 1% of the jobs finished.
+###############################################################################
+def benchmarkJobTree(numJobs, rng):
+    results = dict()
+    tempDir = tempfile.mkdtemp(prefix="cactusBenchmark")
+    try:
+        jobDir = os.path.join(tempDir, "jobs")
+        makeJobTree(jobDir, numJobs, rng)
+        index = JobTreeIndex(jobDir)
+        # mtimes are only trusted once they're older than the last scan
+        time.sleep(1.1)
+        results["JobTreeIndex.coldUpdate"] = timeIt(index.update, 1)
+        time.sleep(1.1)
+        index.update()
+        results["JobTreeIndex.idleUpdate"] = timeIt(index.update, 1)
+        jobFiles = sorted(index.jobs.keys())
+        for jobFile in rng.sample(jobFiles, max(1, len(jobFiles) / 100)):
+            shutil.rmtree(os.path.dirname(jobFile))
+        results["JobTreeIndex.busyUpdate"] = timeIt(index.update, 1)
+    finally:
+        shutil.rmtree(tempDir)
+    return results
+
+# Names of results that are more than tolerance times slower than in
+# the baseline (results too small to measure reliably are ignored)
+def regressions(results, baseline, tolerance, minTime=0.01):
+    slower = []
+    for key, seconds in sorted(results.items()):
+        if key in baseline and seconds > minTime and \
+               seconds > baseline[key] * tolerance:
+            slower.append(key)
+    return slower
+
+def main():
+    usage = "usage: benchmarkDriver.sh [options]\n\n"\
+            "Time the driver code (seqFile parsing, project XML generation "\
+            "and jobTree polling) on synthetic trees and jobTrees"
+    parser = OptionParser(usage=usage)
+    parser.add_option("--leaves", dest="leaves", default="10,100,1000,10000",
+                      help="Comma-separated numbers of leaves of the "
+                      "synthetic trees [default: %default]")
+    parser.add_option("--jobs", dest="jobs", default="1000,10000,100000",
+                      help="Comma-separated numbers of job files of the "
+                      "synthetic jobTrees [default: %default]")
+    parser.add_option("--repeat", dest="repeat", type=int, default=3,
+                      help="Times to run each seqFile benchmark (the best "
+                      "time is kept) [default: %default]")
+    parser.add_option("--seed", dest="seed", type=int, default=0,
+                      help="Random seed [default: %default]")
+    parser.add_option("--baseline", dest="baseline", default=None,
+                      help="JSON file of earlier results to compare against")
+    parser.add_option("--writeBaseline", dest="writeBaseline",
+                      action="store_true", default=False,
+                      help="Write the results to the --baseline file "
+                      "instead of comparing against it")
+    parser.add_option("--tolerance", dest="tolerance", type=float,
+                      default=1.5, help="Flag results this many times slower "
+                      "than the baseline [default: %default]")
+    options, args = parser.parse_args()
+    if len(args) != 0 or (options.writeBaseline and
+                          options.baseline is None):
+        parser.print_help()
+        return 1
+
+    rng = random.Random(options.seed)
+    results = dict()
+    for numLeaves in [int(n) for n in options.leaves.split(",") if n]:
+        for name, seconds in benchmarkSeqFile(numLeaves, options.repeat,
+                                              rng).items():
+            results["%s[leaves=%d]" % (name, numLeaves)] = seconds
+    for numJobs in [int(n) for n in options.jobs.split(",") if n]:
+        for name, seconds in benchmarkJobTree(numJobs, rng).items():
+            results["%s[jobs=%d]" % (name, numJobs)] = seconds
+
+    baseline = dict()
+    if options.baseline is not None and not options.writeBaseline and \
+           os.path.isfile(options.baseline):
+        baseline = json.load(open(options.baseline))
+    for key, seconds in sorted(results.items()):
+        line = "%-45s %10.4fs" % (key, seconds)
+        if key in baseline:
+            line += "  (baseline %.4fs)" % baseline[key]
+        print line
+    if options.writeBaseline:
+        baselineFile = open(options.baseline, "w")
+        json.dump(results, baselineFile, indent=1, sort_keys=True)
+        baselineFile.close()
+        return 0
+    slower = regressions(results, baseline, options.tolerance)
+    if len(slower) > 0:
+        print "\nRegressions (more than %gx slower than %s):\n  %s" % (
+            options.tolerance, options.baseline, "\n  ".join(slower))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
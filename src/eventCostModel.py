@@ -0,0 +1,152 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+
+###############################################################################
+# Rough model of how much work each ancestral event (subproblem) of a
+# progressive alignment is, for the purposes of estimating progress and
+# deciding which events to run first.
+#
+# tree is a sonLib NXTree and leafSizes maps leaf names to genome sizes
+# (in bases).  events is the list of names of the nodes that are the roots
+# of subproblems (ie the keys of a MultiCactusProject's expMap); if it's
+# not given every internal node is assumed to be its own event.
+#
+# - an ancestral genome is assumed to be as big as its biggest child
+# - the inputs of an event are the nodes below it down to (and including)
+#   the first leaves or other events on each path
+# - the work of an event is the sum of the sizes of its inputs, each
+#   weighted by 1 + the distance to it (capped at 1), since more
+#   divergent genomes take longer to align
+###############################################################################
+class EventCostModel:
+    def __init__(self, tree, leafSizes, events=None):
+        self.tree = tree
+        self.leafSizes = leafSizes
+        self.sizes = dict()
+        self.nameToId = dict()
+        for node in self.tree.postOrderTraversal():
+            name = self.tree.getName(node)
+            self.nameToId[name] = node
+            if self.tree.isLeaf(node):
+                self.sizes[name] = leafSizes.get(name, 0)
+            else:
+                self.sizes[name] = max([self.sizes[self.tree.getName(c)]
+                                        for c in self.tree.getChildren(node)])
+        if events is None:
+            events = [self.tree.getName(node) for node in
+                      self.tree.postOrderTraversal()
+                      if not self.tree.isLeaf(node)]
+        self.eventSet = set(events)
+        self.priorities = None
+        # events in postorder, so children always come before parents
+        self.events = [self.tree.getName(node) for node in
+                       self.tree.postOrderTraversal()
+                       if self.tree.getName(node) in self.eventSet]
+
+    def genomeSize(self, name):
+        return self.sizes[name]
+
+    # list of (input name, distance from event) pairs
+    def eventInputs(self, event):
+        inputs = []
+        stack = [(child, self.__weight(child)) for child in
+                 self.tree.getChildren(self.nameToId[event])]
+        while len(stack) > 0:
+            node, dist = stack.pop()
+            name = self.tree.getName(node)
+            if self.tree.isLeaf(node) or name in self.eventSet:
+                inputs.append((name, dist))
+            else:
+                stack += [(child, dist + self.__weight(child)) for child in
+                          self.tree.getChildren(node)]
+        return inputs
+
+    # the events that have to be finished before event can start
+    def eventChildren(self, event):
+        return [name for name, dist in self.eventInputs(event)
+                if name in self.eventSet]
+
+    # total size of the genomes an event aligns
+    def eventInputSize(self, event):
+        return sum([self.sizes[name] for name, dist in
+                    self.eventInputs(event)])
+
+    def eventWork(self, event):
+        return sum([self.sizes[name] * (1. + min(dist, 1.)) for name, dist
+                    in self.eventInputs(event)])
+
+    # the event that has to wait for event to finish, or None for the root
+    def eventParent(self, event):
+        node = self.nameToId[event]
+        while self.tree.hasParent(node):
+            node = self.tree.getParent(node)
+            if self.tree.getName(node) in self.eventSet:
+                return self.tree.getName(node)
+        return None
+
+    # Scheduling priority of an event: the work on the longest chain of
+    # events from it up to the root (inclusive).  Starting the events
+    # with the highest priority first keeps the critical path moving.
+    def eventPriority(self, event):
+        if self.priorities is None:
+            self.priorities = dict()
+            for e in reversed(self.events):
+                parent = self.eventParent(e)
+                self.priorities[e] = self.eventWork(e)
+                if parent is not None:
+                    self.priorities[e] += self.priorities[parent]
+        return self.priorities[event]
+
+    # The chain of events (root last) that bounds the total runtime
+    def criticalPath(self):
+        if len(self.events) == 0:
+            return []
+        event = max(self.events, key=self.eventPriority)
+        path = [event]
+        while self.eventParent(path[-1]) is not None:
+            path.append(self.eventParent(path[-1]))
+        return path
+
+    # Map each node id of the tree to the highest priority of any event
+    # in its subtree (0 if there aren't any), for ordering siblings
+    def subtreePriorities(self):
+        nodePriorities = dict()
+        for node in self.tree.postOrderTraversal():
+            priority = 0
+            if self.tree.getName(node) in self.eventSet:
+                priority = self.eventPriority(self.tree.getName(node))
+            for child in self.tree.getChildren(node):
+                priority = max(priority, nodePriorities[child])
+            nodePriorities[node] = priority
+        return nodePriorities
+
+    def totalWork(self):
+        return sum([self.eventWork(event) for event in self.events])
+
+    def __weight(self, node):
+        weight = None
+        if self.tree.hasParent(node):
+            weight = self.tree.getWeight(self.tree.getParent(node), node)
+        if weight is None:
+            return 1.
+        return float(weight)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2012 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import string
+import re
+import json
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+# Compressed sequence files are recognized by their extension.  BGZF
+# (.bgz, as written by bgzip) is a special case of gzip.
+compressedExtensions = { ".gz" : "gzip", ".bgz" : "gzip", ".xz" : "xz" }
+
+# "gzip", "xz" or None
+def compressionType(path):
+    return compressedExtensions.get(os.path.splitext(path)[1].lower())
+
+# Read a (possibly compressed) file in blocks of up to bufferSize bytes.
+# Compressed files are piped through gzip or xz, which also lets the
+# decompression run on another core.
+def readBlocks(filePath, bufferSize):
+    compression = compressionType(filePath)
+    proc = None
+    if compression is None:
+        inFile = open(filePath, "rb")
+    else:
+        proc = subprocess.Popen([compression, "-dc", filePath],
+                                stdout=subprocess.PIPE,
+                                bufsize=bufferSize)
+        inFile = proc.stdout
+    try:
+        while True:
+            block = inFile.read(bufferSize)
+            if not block:
+                break
+            yield block
+    finally:
+        inFile.close()
+        if proc is not None and proc.wait() != 0:
+            raise RuntimeError("Unable to decompress %s" % filePath)
+
+# Sequence paths in the seqFile can either be a single FASTA file or a
+# directory of them.  Directories are read the same way cactus reads
+# them (ie cat dir/*), so hidden files are skipped and the rest are
+# read in sorted order.
+def sequenceFiles(path):
+    if os.path.isdir(path):
+        files = []
+        for name in sorted(os.listdir(path)):
+            filePath = os.path.join(path, name)
+            if name[0] != '.' and os.path.isfile(filePath):
+                files.append(filePath)
+        return files
+    return [path]
+
+# Cheap (size, mtime) signature of a sequence path, used to decide if
+# anything we cached about it is still valid without reading it.  For
+# directories the directory's own mtime is included so that removing a
+# file is noticed.  Returned as a list so it survives a json round trip.
+def pathSignature(path):
+    size = 0
+    mtime = 0
+    if os.path.isdir(path):
+        mtime = os.stat(path).st_mtime
+    for filePath in sequenceFiles(path):
+        st = os.stat(filePath)
+        size += st.st_size
+        mtime = max(mtime, st.st_mtime)
+    return [size, mtime]
+
+###############################################################################
+# Stream through a FASTA file (or directory, either of which may be
+# compressed) in large blocks, counting bases, soft-masked (lowercase)
+# bases, Ns and contigs.  Everything is done with str.translate /
+# str.count so the inner loop stays in C and the scan runs at about the
+# speed of the disk.  Problems cactus would choke on are counted too:
+# headers whose first word isn't a valid sequence name, first words that
+# aren't unique within the genome, and carriage returns.
+###############################################################################
+def scanFasta(path, bufferSize=1 << 24):
+    stats = { "length" : 0, "masked" : 0, "ns" : 0, "contigs" : 0,
+              "badHeaders" : 0, "duplicateHeaders" : 0,
+              "carriageReturns" : 0 }
+    headerNames = set()
+    for filePath in sequenceFiles(path):
+        inHeader = False
+        atLineStart = True
+        headerParts = []
+        for block in readBlocks(filePath, bufferSize):
+            stats["carriageReturns"] += block.count("\r")
+            pos = 0
+            while pos < len(block):
+                if inHeader:
+                    eol = block.find("\n", pos)
+                    if eol < 0:
+                        headerParts.append(block[pos:])
+                        break
+                    headerParts.append(block[pos:eol])
+                    checkHeader("".join(headerParts), headerNames, stats)
+                    headerParts = []
+                    pos = eol + 1
+                    inHeader = False
+                    atLineStart = True
+                elif atLineStart and block[pos] == ">":
+                    stats["contigs"] += 1
+                    inHeader = True
+                    pos += 1
+                else:
+                    gt = block.find("\n>", pos)
+                    if gt < 0:
+                        countBases(block[pos:], stats)
+                        atLineStart = block[-1] == "\n"
+                        break
+                    countBases(block[pos:gt + 1], stats)
+                    pos = gt + 1
+                    atLineStart = True
+        if inHeader:
+            checkHeader("".join(headerParts), headerNames, stats)
+    return stats
+
+# cactus uses the first word of each header as the sequence name, and
+# (by default) only accepts letters, digits, '_', '.' and '-' in it
+validNamePattern = re.compile(r"^[A-Za-z0-9_.\-]+$")
+
+def headerName(header):
+    words = header.split(None, 1)
+    if len(words) == 0:
+        return ""
+    return words[0]
+
+def checkHeader(header, headerNames, stats):
+    name = headerName(header)
+    if not validNamePattern.match(name):
+        stats["badHeaders"] += 1
+    if name in headerNames:
+        stats["duplicateHeaders"] += 1
+    else:
+        headerNames.add(name)
+
+def countBases(segment, stats):
+    seq = segment.translate(None, string.whitespace)
+    stats["length"] += len(seq)
+    stats["masked"] += len(seq) - len(seq.translate(None,
+                                                    string.ascii_lowercase))
+    stats["ns"] += seq.count("N") + seq.count("n")
+
+# Bumped whenever scanFasta starts collecting something new, so that
+# older cache entries get rescanned
+scanVersion = 2
+
+# Pool.map can only send module-level functions to the workers
+def scanSequencePath(path):
+    return scanFasta(path)
+
+###############################################################################
+# Scan a set of sequence paths, one genome per worker process.  Results
+# are cached in a json file keyed on the absolute path and checked
+# against the path's size and mtime, so reruns on the same inputs don't
+# have to read anything.
+###############################################################################
+class FastaScanner:
+    def __init__(self, cachePath=None, numProcs=None):
+        self.cachePath = cachePath
+        self.numProcs = numProcs
+        if self.numProcs is None:
+            self.numProcs = cpu_count()
+        self.cache = dict()
+        if self.cachePath is not None and os.path.isfile(self.cachePath):
+            try:
+                self.cache = json.load(open(self.cachePath, "r"))
+            except:
+                sys.stderr.write("Ignoring unreadable sequence scan cache "
+                                 "%s\n" % self.cachePath)
+                self.cache = dict()
+
+    # return a dictionary mapping each path to its stats
+    def scan(self, paths):
+        results = dict()
+        signatures = dict()
+        todo = []
+        for path in paths:
+            key = os.path.abspath(path)
+            signatures[key] = pathSignature(path)
+            entry = self.cache.get(key)
+            if entry is not None and entry["signature"] == signatures[key] \
+                   and entry.get("version") == scanVersion:
+                results[path] = entry["stats"]
+            elif path not in todo:
+                todo.append(path)
+
+        if len(todo) > 1 and self.numProcs > 1:
+            pool = Pool(processes=min(len(todo), self.numProcs))
+            try:
+                scanned = pool.map(scanSequencePath, todo)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            scanned = [scanSequencePath(path) for path in todo]
+
+        for path, stats in zip(todo, scanned):
+            key = os.path.abspath(path)
+            results[path] = stats
+            self.cache[key] = { "signature" : signatures[key],
+                                "version" : scanVersion,
+                                "stats" : stats }
+        if len(todo) > 0:
+            self.writeCache()
+        return results
+
+    # stats of path if they are in the cache and still valid, else None
+    def cachedStats(self, path):
+        entry = self.cache.get(os.path.abspath(path))
+        if entry is not None and os.path.exists(path) and \
+               entry["signature"] == pathSignature(path) and \
+               entry.get("version") == scanVersion:
+            return entry["stats"]
+        return None
+
+    # record stats for path that are known without scanning it (ie for a
+    # copy of a file that was scanned)
+    def setStats(self, path, stats):
+        self.cache[os.path.abspath(path)] = {
+            "signature" : pathSignature(path),
+            "version" : scanVersion,
+            "stats" : stats }
+
+    def writeCache(self):
+        if self.cachePath is None:
+            return
+        tempPath = self.cachePath + ".tmp"
+        cacheFile = open(tempPath, "w")
+        json.dump(self.cache, cacheFile, indent=1, sort_keys=True)
+        cacheFile.close()
+        os.rename(tempPath, self.cachePath)
+
+# Number of bases in a sequence path if it's known to scanner, otherwise
+# the size of its file(s)
+def sequenceSize(path, scanner=None):
+    stats = None
+    if scanner is not None:
+        stats = scanner.cachedStats(path)
+    if stats is not None:
+        return stats["length"]
+    return pathSignature(path)[0]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import shutil
+import datetime
+import xml.etree.ElementTree as ET
+from threading import Thread, Event
+
+from sonLib.bioio import system
+
+from cactus.progressive.multiCactusProject import MultiCactusProject
+from cactus.shared.experimentWrapper import ExperimentWrapper
+
+from projectWrapper import ProjectWrapper
+from checkpoint import Checkpoint, filesSignature
+from runReport import envCommand
+
+# Newick string of the part of the tree an event aligns: the event and
+# everything below it down to the leaves and other events
+def eventNewick(tree, node, events, isRoot=True):
+    name = tree.getName(node)
+    newick = ""
+    if isRoot or name not in events:
+        children = [eventNewick(tree, child, events, False) for child in
+                    tree.getChildren(node)]
+        if len(children) > 0:
+            newick = "(%s)" % ",".join(children)
+    newick += name
+    if isRoot:
+        return newick + ";"
+    weight = tree.getWeight(tree.getParent(node), node)
+    if weight is not None:
+        newick += ":%s" % repr(float(weight))
+    return newick
+
+###############################################################################
+# Export the progressive alignment in a working directory to HAL one event
+# at a time, as the events finish, instead of all at once at the end
+# (which is what cactus2hal.py does).
+#
+# Each event is exported with halAppendCactusSubtree into its own HAL file
+# in <workDir>/halExport once the Checkpoint has recorded it as complete,
+# so a .c2h that cactus is still writing is never exported.  When the
+# whole alignment is done, assemble() copies the root event's file to the
+# output and merges the other events' files into it from the top down
+# with halAppendSubtree --merge, which only copies already-built HAL data,
+# so it's much quicker than exporting everything at the end.
+#
+# What's been exported is kept in the working directory's Checkpoint, along
+# with the size and mtime of the .c2h and .fa files each event was
+# exported from, so that a resumed alignment only exports events that are
+# new or were re-aligned.
+###############################################################################
+class IncrementalHalExporter:
+    def __init__(self, workDir, envFile=None, checkpoint=None):
+        self.workDir = workDir
+        self.envFile = envFile
+        self.projectPath = os.path.join(
+            workDir, ProjectWrapper.alignmentDirName,
+            "%s_project.xml" % ProjectWrapper.alignmentDirName)
+        self.mcProj = MultiCactusProject()
+        self.mcProj.readXML(self.projectPath)
+        self.halDir = os.path.join(workDir, "halExport")
+        self.logPath = os.path.join(workDir, "cactus.log")
+        self.checkpoint = checkpoint
+        if self.checkpoint is None:
+            self.checkpoint = Checkpoint(workDir)
+        tree = self.mcProj.mcTree
+        self.nameToId = dict()
+        # events in preorder, so parents come before their children
+        self.events = []
+        for node in reversed(list(tree.postOrderTraversal())):
+            name = tree.getName(node)
+            self.nameToId[name] = node
+            if name in self.mcProj.expMap:
+                self.events.append(name)
+
+    def rootEvent(self):
+        return self.events[0]
+
+    def experiment(self, event):
+        return ExperimentWrapper(ET.parse(
+            self.mcProj.expMap[event]).getroot())
+
+    # (size, mtime) of the files an event is exported from, or None if
+    # they aren't there
+    def inputSignature(self, event):
+        exp = self.experiment(event)
+        return filesSignature([exp.getHALPath(), exp.getHALFastaPath()])
+
+    def isExported(self, event):
+        return self.checkpoint.isExported(event, self.inputSignature(event))
+
+    def __run(self, cmd):
+        system("%s >> %s 2>&1" % (envCommand(self.envFile, cmd),
+                                  self.logPath))
+
+    def exportEvent(self, event):
+        if not os.path.isdir(self.halDir):
+            os.makedirs(self.halDir)
+        exp = self.experiment(event)
+        signature = self.inputSignature(event)
+        halPath = os.path.join(self.halDir, "%s.hal" % event)
+        if os.path.exists(halPath):
+            os.remove(halPath)
+        cmd = "halAppendCactusSubtree '%s' '%s' '%s' '%s'" % (
+            exp.getHALPath(), exp.getHALFastaPath(),
+            eventNewick(self.mcProj.mcTree, self.nameToId[event],
+                        self.mcProj.expMap), halPath)
+        # as cactus2hal.py does, from the event's own experiment (the
+        # project read back from XML has no outgroup map)
+        outgroups = exp.getOutgroupEvents()
+        if len(outgroups) > 0:
+            cmd += " --outgroups %s" % ",".join(outgroups)
+        self.__run(cmd)
+        self.checkpoint.setExported(event, halPath, signature)
+
+    # Export every event that the checkpoint has recorded as complete (ie
+    # whose outputs have settled) and that hasn't been exported yet
+    # (children first), and return how many were exported.  If stopEvent
+    # is given, stop as soon as it's set.
+    def exportFinished(self, stopEvent=None):
+        numExported = 0
+        for event in reversed(self.events):
+            if stopEvent is not None and stopEvent.is_set():
+                break
+            if self.checkpoint.isComplete(event) and \
+                   not self.isExported(event):
+                self.exportEvent(event)
+                numExported += 1
+        return numExported
+
+    # Build the output HAL file from the exported events, exporting any
+    # that haven't been yet
+    def assemble(self, outputHalFile):
+        self.exportFinished()
+        missing = [e for e in self.events if not self.isExported(e)]
+        if len(missing) > 0:
+            raise RuntimeError("Events %s have not been aligned, so the HAL "
+                               "file can't be built" % ", ".join(missing))
+        shutil.copyfile(self.checkpoint.exportedPath(self.rootEvent()),
+                        outputHalFile)
+        for event in self.events[1:]:
+            self.__run("halAppendSubtree '%s' '%s' '%s' '%s' --merge" % (
+                outputHalFile, self.checkpoint.exportedPath(event), event,
+                event))
+
+###############################################################################
+# Run an IncrementalHalExporter in the background while the alignment
+# runs, checking for newly finished events every pollTime seconds.  Call
+# stop() (which waits for any export in progress) before assembling.
+###############################################################################
+class HalExportThread(Thread):
+    def __init__(self, exporter, pollTime=60):
+        Thread.__init__(self)
+        self.exporter = exporter
+        self.pollTime = pollTime
+        self.stopEvent = Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.exporter.exportFinished(self.stopEvent)
+            except Exception, e:
+                # assemble() will try again at the end
+                sys.stderr.write("%s: Incremental HAL export failed: %s\n" % (
+                    str(datetime.datetime.now()), str(e)))
+            self.stopEvent.wait(self.pollTime)
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
@@ -32,103 +32,108 @@ import socket
 from time import sleep
 import signal
 import traceback
-from threading import Thread
+from threading import Thread, Event
 
 from jobTree.src.master import getJobFileDirName, getConfigFileName
-from jobTree.src.jobTreeStatus import parseJobFiles
-
-from cactus.progressive.multiCactusProject import MultiCactusProject
-from cactus.shared.experimentWrapper import ExperimentWrapper
-from cactus.pipeline.ktserverControl import pingKtServer
 
 from seqFile import SeqFile
 from projectWrapper import ProjectWrapper
+from jobTreeIndex import JobTreeIndex
+from ktServerProber import KtServerProber
+from stallDetector import StallDetector
+from ktTelemetry import KtTelemetry
 
 ###############################################################################
 # Keep tabs on how progressive cactus is doing.  In particular look for:
 # - errors in jobTreeStatus
-# - which ktservers are running
+# - which ktservers are running, and how big they are getting
 #
 # we use this information to detect cases where some kind of failure leads
-# ktservers running and nothing else.  the logic for calling these deadlocks is
-# - the same ktservers have been running for more than deadlockTime
-# - AND no other jobs have been running for this time
-# - AND there is some kind of error message in the log
-# Make sure I'm a daemon! 
+# ktservers running and nothing else.  a deadlock is called when none of
+# the signs of progress (job files changing, jobs completing, the log
+# growing, events finishing) have been seen for much longer than usual
+# (see StallDetector, which also sets how often we poll: between
+# minPollTime and pollTime), AND the only jobs running over that time were
+# the same ktservers (and the jobs waiting on them), so a long but healthy
+# job isn't mistaken for a deadlock.  sensitivity is how many times longer
+# than the usual gap between signs of progress we wait, and deadlockTime
+# is the longest we'll ever wait.
+# the statistics of each ktserver are tracked too (see KtTelemetry), with a
+# warning (and a call to memoryPressureCallbackFn, if given) when a server
+# is about to outgrow ktMemoryCeiling bytes.
+# Make sure I'm a daemon!  (or stop() me when the alignment is over)
 ###############################################################################
 class JobStatusMonitor(Thread):
+    # active jobs a running ktserver accounts for: the job serving it and
+    # the one waiting on it
+    jobsPerKtserver = 2
     def __init__(self, jobTreePath, projectPath, logPath, pollTime=600,
-                 deadlockTime=14400, deadlockCallbackFn=None):
+                 deadlockTime=14400, deadlockCallbackFn=None,
+                 useInotify=False, metricsExporter=None,
+                 progressEstimator=None, sensitivity=8.0, minPollTime=30,
+                 minDeadlockTime=300, ktMemoryCeiling=None,
+                 memoryPressureCallbackFn=None):
         Thread.__init__(self)
         self.jobTreePath = jobTreePath
         self.projectPath = projectPath
         self.logPath = logPath
         self.pollTime = pollTime
+        self.minPollTime = minPollTime
         self.deadlockTime = deadlockTime
+        self.stallDetector = StallDetector(sensitivity, minDeadlockTime,
+                                           deadlockTime)
+        self.memoryPressureCallbackFn = memoryPressureCallbackFn
+        self.stopEvent = Event()
+        self.ktTelemetry = KtTelemetry(
+            ktMemoryCeiling, pressureCallbackFn=self.__memoryPressure)
         self.deadlockCallbackFn = deadlockCallbackFn
+        self.useInotify = useInotify
+        self.jobIndex = None
+        self.ktProber = None
+        self.metricsExporter = metricsExporter
+        self.progressEstimator = progressEstimator
         self.daemon = True
 
     ###########################################################################
-    # Get the active jobs as done by jobTreeStatus, which is the world-renowned
-    # expert at doing this. If the same jobs are running as last time we polled
-    # add the polltime to sameJobsTime
+    # Get the active jobs the same way as jobTreeStatus, but from an index
+    # that is only updated with the job files that changed since the last
+    # poll. If the same jobs are running as last time we polled
+    # add the time since then to sameJobsTime
     ###########################################################################
     def __pollJobTree(self):
-        childJobFileToParentJob, childCounts =  {}, {}
-        updatedJobFiles, shellJobs = set(), set()
         try:
-            parseJobFiles(getJobFileDirName(self.jobTreePath),
-                          updatedJobFiles, childJobFileToParentJob,
-                          childCounts, shellJobs)
-            failedJobs = [ job for job in updatedJobFiles | \
-                           set(childCounts.keys()) \
-                           if job.remainingRetryCount == 0 ]
-
-            self.curActiveJobs = set()
-            for job in updatedJobFiles:
-                self.curActiveJobs.add(job.getJobFileName())
-            self.failedJobs = max(len(failedJobs), self.failedJobs)
+            jobDir = getJobFileDirName(self.jobTreePath)
+            if self.jobIndex is None and os.path.isdir(jobDir):
+                self.jobIndex = JobTreeIndex(jobDir, self.useInotify)
+            self.jobIndex.update()
+            self.curActiveJobs = self.jobIndex.activeJobs()
+            self.failedJobs = max(len(self.jobIndex.failedJobs()),
+                                  self.failedJobs)
 
         except:
             self.curActiveJobs = set()
 
         if len(self.prevActiveJobs) > 0 and len(self.curActiveJobs) > 0 and\
                self.curActiveJobs == self.prevActiveJobs:
-            self.sameJobsTime += self.pollTime
+            self.sameJobsTime += self.elapsed
         else:
             self.sameJobsTime = 0
             self.prevActiveJobs = set(self.curActiveJobs)
 
     ###########################################################################
-    # Get the active ktservers
+    # Get the active ktservers and their statistics
     ###########################################################################
     def __pollKtServers(self):
-        self.curKtservers = set()
         try:
-            mc = MultiCactusProject()
-            mc.readXML(self.projectPath)
-            for eventName,expPath in mc.expMap.items():
-                exp = ExperimentWrapper(ET.parse(expPath).getroot())
-                try:
-                    if pingKtServer(exp):
-                        self.curKtservers.add("%s_%s:%s" % (
-                            eventName, exp.getDbHost(), str(exp.getDbPort())))
-                except:
-                    pass
-                try:
-                    secElem = exp.getSecondaryDBElem()
-                    if secElem is not None and pingKtServer(secElem):
-                        self.curKtservers.add("%s_secondary_%s:%s" % (
-                            eventName, secElem.getDbHost(),
-                            str(secElem.getDbPort())))
-                except:
-                    pass
-
+            if self.ktProber is None:
+                self.ktProber = KtServerProber(self.projectPath)
+            self.curKtservers = self.ktProber.probe()
+            self.ktTelemetry.update(self.ktProber.reports)
         except:
             self.curKtservers = set()
         if len(self.prevKtservers) > 0 and len(self.curKtservers) > 0 and\
                self.curKtservers == self.prevKtservers:
-            self.sameKtserversTime += self.pollTime
+            self.sameKtserversTime += self.elapsed
         else:
             self.prevKtservers = set(self.curKtservers)
             self.sameKtserversTime = 0
@@ -142,11 +147,122 @@ class JobStatusMonitor(Thread):
         self.prevKtservers = set()
         self.sameJobsTime = 0
         self.sameKtserversTime = 0
+        self.elapsed = 0
+        self.numDoneEvents = 0
+        self.ktTotals = (0, 0)
+        self.logSize = self.__logSize()
+
+    ###########################################################################
+    # Have the only active jobs since the last sign of progress been the
+    # same ktservers (and the jobs waiting on them)?
+    ###########################################################################
+    def __onlyKtserversActive(self):
+        quietTime = self.stallDetector.idleTime() - 1
+        return len(self.curKtservers) > 0 and \
+               self.sameKtserversTime >= quietTime and \
+               (len(self.curActiveJobs) == 0 or
+                self.sameJobsTime >= quietTime) and \
+               len(self.curActiveJobs) <= JobStatusMonitor.jobsPerKtserver * \
+               len(self.curKtservers)
+
+    def __logSize(self):
+        try:
+            return os.path.getsize(self.logPath)
+        except OSError:
+            return 0
+
+    ###########################################################################
+    # How much of each sign of progress there's been since the last poll
+    ###########################################################################
+    def __progressSignals(self):
+        progress = dict()
+        if self.jobIndex is not None:
+            progress["changedJobs"] = self.jobIndex.numChanged
+            progress["completedJobs"] = self.jobIndex.numRemoved
+        ktTotals = self.ktTelemetry.totals()
+        progress["ktRecords"] = ktTotals[0] - self.ktTotals[0]
+        progress["ktOperations"] = ktTotals[1] - self.ktTotals[1]
+        self.ktTotals = ktTotals
+        logSize = self.__logSize()
+        progress["logGrowth"] = logSize - self.logSize
+        self.logSize = logSize
+        if self.progressEstimator is not None:
+            numDoneEvents = len(self.progressEstimator.doneEvents)
+            progress["finishedEvents"] = numDoneEvents - self.numDoneEvents
+            self.numDoneEvents = numDoneEvents
+        return progress
+
+    ###########################################################################
+    # Update the progress estimate, and log it whenever an event finishes
+    ###########################################################################
+    def __pollProgress(self):
+        try:
+            numDone = len(self.progressEstimator.doneEvents)
+            self.progressEstimator.update()
+            if len(self.progressEstimator.doneEvents) > numDone:
+                with open(self.logPath, "a") as logFile:
+                    logFile.write("\nProgress: %s\n" %
+                                  self.progressEstimator.summary())
+        except Exception, e:
+            sys.stderr.write("Unable to estimate progress: %s\n" % str(e))
+
+    ###########################################################################
+    # Hand what we know after a poll to the metrics exporter (if any)
+    ###########################################################################
+    def __exportMetrics(self):
+        sample = { "activeJobs" : len(self.curActiveJobs),
+                   "sameJobsTime" : self.sameJobsTime,
+                   "liveKtservers" : len(self.curKtservers),
+                   "sameKtserversTime" : self.sameKtserversTime }
+        if self.jobIndex is not None:
+            sample["totalJobs"] = len(self.jobIndex.jobs)
+            sample["waitingJobs"] = len(self.jobIndex.jobs) - \
+                                    len(self.curActiveJobs)
+            sample["failedJobs"] = len(self.jobIndex.failedJobs())
+            sample["shellJobs"] = len(self.jobIndex.shellJobs)
+            sample["changedJobs"] = self.jobIndex.numChanged
+        sample["idleTime"] = self.stallDetector.idleTime()
+        sample["stallThreshold"] = self.stallDetector.stallThreshold()
+        if self.progressEstimator is not None:
+            sample["fractionDone"] = self.progressEstimator.fractionDone
+            if self.progressEstimator.eta is not None:
+                sample["etaSeconds"] = self.progressEstimator.eta
+        if self.ktProber is not None:
+            sample["ktserverLatency"] = dict(
+                [(name, latency) for name, (reachable, latency) in
+                 self.ktProber.stats.items() if reachable is True])
+        for key, statName in [("ktserverRecords", "records"),
+                              ("ktserverMemoryBytes", "memory"),
+                              ("ktserverOpsPerSecond", "opsPerSecond"),
+                              ("ktserverGrowthBytesPerSecond", "growth")]:
+            sample[key] = dict(
+                [(name, stats[statName]) for name, stats in
+                 self.ktTelemetry.stats.items()
+                 if stats[statName] is not None])
+        try:
+            self.metricsExporter.export(sample)
+        except Exception, e:
+            sys.stderr.write("Unable to export metrics: %s\n" % str(e))
 
     def __write(self, msg):
         sys.stderr.write(msg)
         with open(self.logPath, "a") as logFile:
             logFile.write(msg)
+        # our own messages aren't progress
+        self.logSize = self.__logSize()
+
+    ###########################################################################
+    # Called by the KtTelemetry when a ktserver is about to run out of
+    # memory
+    ###########################################################################
+    def __memoryPressure(self, name, stats):
+        self.__write("\nWARNING: ktserver %s.  An in-memory ktserver that "
+                     "outgrows the memory of its node will crash or be "
+                     "killed.  Consider restarting with --ktType snapshot "
+                     "or disk, or with a larger --ktMemoryCeiling on "
+                     "bigger nodes.\n" % self.ktTelemetry.describe(name))
+        if self.memoryPressureCallbackFn is not None:
+            self.memoryPressureCallbackFn(name, stats)
 
     def __hints(self):
         self.__write(" It is likely that Progressive Cactus " +
@@ -171,20 +287,33 @@ class JobStatusMonitor(Thread):
 
     ###########################################################################
     # Poll until we hit a deadlock.  If that happens print a warning
-    # and call the callback (if specified)
+    # and call the callback (if specified).  Both happen once per
+    # deadlock: we warn again only if progress resumes and stalls again.
     ###########################################################################
     def run(self):
         self.__resetTimes()
         inDeadlock = False
+        lastPoll = time.time()
         while True:
-            sleep(self.pollTime)
+            self.stopEvent.wait(self.stallDetector.pollInterval(
+                self.minPollTime, self.pollTime))
+            if self.stopEvent.is_set():
+                break
+            now = time.time()
+            self.elapsed = now - lastPoll
+            lastPoll = now
             self.__pollJobTree()
             self.__pollKtServers()
+            if self.progressEstimator is not None:
+                self.__pollProgress()
+            stalled = self.stallDetector.observe(self.__progressSignals()) \
+                      and self.__onlyKtserversActive()
+            if self.metricsExporter is not None:
+                self.__exportMetrics()
 
-            if self.sameJobsTime > self.deadlockTime and\
-                   self.sameKtserversTime > self.deadlockTime:
+            if stalled and not inDeadlock:
                 inDeadlock = True
-                hangTime = min(self.sameJobsTime, self.sameKtserversTime)
+                hangTime = self.stallDetector.idleTime()
                 failedJobs = self.failedJobs
                 self.__write("\n\n"
                              "*****************************************"
@@ -197,9 +326,14 @@ class JobStatusMonitor(Thread):
                              "*****************************************\n"
                              "*****************************************"
                              "*****************************************\n")
-                self.__write("The only jobs that I have detected running" +
-                             " for at least the past %ds" % hangTime +
-                             " are %d ktservers." % len(self.curKtservers))
+                self.__write("No progress has been made for the past %ds " %
+                             hangTime + "(usually there is some every "
+                             "%ds).  The only jobs that I have detected "
+                             "running in that time are %d ktservers (%d "
+                             "active jobs in all)." % (
+                                 self.stallDetector.meanGap or 0,
+                                 len(self.curKtservers),
+                                 len(self.curActiveJobs)))
                 if failedJobs > 0:
                     self.__write(" Furthermore, there appears to have " +
                                  "been %d failed jobs. " % failedJobs)    
@@ -207,12 +341,11 @@ class JobStatusMonitor(Thread):
                     self.deadlockCallbackFn()
                 else:
                     self.__hints()
-            else:
-                if inDeadlock is True:
-                    self.__write("\nDeadlock no longer detected.  Progress"+
-                                 " resumed")
-                inDeadLock = False
-
-
-
+            elif not stalled and inDeadlock:
+                self.__write("\nDeadlock no longer detected.  Progress"+
+                             " resumed (%s)\n" % ", ".join(
+                                 self.stallDetector.lastSignals))
+                inDeadlock = False
 
+    def stop(self):
+        self.stopEvent.set()
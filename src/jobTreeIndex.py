@@ -0,0 +1,193 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+
+from jobTree.src.job import Job
+
+# inotify is only used if pyinotify happens to be installed
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+###############################################################################
+# Incrementally maintained index of the job files in a jobTree.
+#
+# jobTreeStatus (parseJobFiles) reads every job file each time it is run,
+# which is far too slow to do every few seconds on a big jobTree.  Here we
+# remember the mtime of each directory and only list the directories that
+# changed since the last update, and only re-read the job files in them
+# whose mtime changed.  This works because jobTree always writes job files
+# by renaming a temporary file into place, which updates the directory's
+# mtime.  If pyinotify is available (and useInotify is set), the changed
+# directories come from inotify events instead, with a full mtime scan
+# every fullScanInterval updates to catch anything inotify can't see (ie
+# writes from other NFS clients).
+###############################################################################
+class JobTreeIndex:
+    def __init__(self, jobDir, useInotify=False, fullScanInterval=20):
+        self.jobDir = jobDir
+        self.fullScanInterval = fullScanInterval
+        # directory -> (mtime, set of subdirectories, set of files)
+        self.dirs = dict()
+        # job file -> (mtime, remainingRetryCount, number of children)
+        self.jobs = dict()
+        self.shellJobs = set()
+        self.lastScanTime = 0
+        self.numUpdates = 0
+        # number of job files created, changed or removed by last update
+        self.numChanged = 0
+        # number of job files removed (ie completed) by last update
+        self.numRemoved = 0
+        self.watchManager = None
+        self.notifier = None
+        self.dirtyDirs = set()
+        if useInotify is True and pyinotify is not None:
+            self.__startInotify()
+
+    def __startInotify(self):
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+               pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
+               pyinotify.IN_CLOSE_WRITE | pyinotify.IN_Q_OVERFLOW
+        index = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.mask & pyinotify.IN_Q_OVERFLOW:
+                    index.dirtyDirs.add(None)
+                else:
+                    index.dirtyDirs.add(event.path)
+        self.watchManager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watchManager, Handler(),
+                                           timeout=0)
+        self.watchManager.add_watch(self.jobDir, mask, rec=True,
+                                    auto_add=True)
+
+    # Bring the index up to date.  Returns the number of job files that
+    # were created, changed or deleted since the last update.
+    def update(self):
+        self.numChanged = 0
+        self.numRemoved = 0
+        scanTime = time.time()
+        fullScan = self.notifier is None or \
+                   self.numUpdates % self.fullScanInterval == 0
+        if self.notifier is not None:
+            while self.notifier.check_events(timeout=0):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            if None in self.dirtyDirs:
+                fullScan = True
+        if fullScan:
+            self.__scanDir(self.jobDir, False)
+        else:
+            for dirPath in sorted(self.dirtyDirs):
+                if dirPath in self.dirs or dirPath == self.jobDir:
+                    self.__scanDir(dirPath, True)
+                elif os.path.isdir(dirPath):
+                    # new directory: let its parent pick it up
+                    self.__scanDir(os.path.dirname(dirPath), True)
+        self.dirtyDirs = set()
+        # Anything modified within a second of the last scan could have
+        # been missed on filesystems with coarse mtimes
+        self.lastScanTime = scanTime - 1
+        self.numUpdates += 1
+        return self.numChanged
+
+    # job files that have no children left, ie are runnable or running
+    # (jobTreeStatus's updatedJobFiles)
+    def activeJobs(self):
+        return set([jobFile for jobFile, entry in self.jobs.items()
+                    if entry[2] == 0])
+
+    def failedJobs(self):
+        return set([jobFile for jobFile, entry in self.jobs.items()
+                    if entry[1] == 0])
+
+    def __scanDir(self, dirPath, force):
+        try:
+            mtime = os.stat(dirPath).st_mtime
+        except OSError:
+            self.__removeDir(dirPath)
+            return
+        if dirPath in self.dirs and not force:
+            oldMtime, subDirs, files = self.dirs[dirPath]
+            if oldMtime == mtime and mtime < self.lastScanTime:
+                for subDir in list(subDirs):
+                    self.__scanDir(subDir, False)
+                return
+        oldSubDirs, oldFiles = set(), set()
+        if dirPath in self.dirs:
+            oldSubDirs, oldFiles = self.dirs[dirPath][1:]
+        subDirs, files = set(), set()
+        for name in os.listdir(dirPath):
+            path = os.path.join(dirPath, name)
+            if os.path.isdir(path):
+                subDirs.add(path)
+            elif name.endswith(".new"):
+                files.add(path)
+                self.shellJobs.add(path)
+            elif name.endswith("job"):
+                files.add(path)
+                self.__updateJob(path)
+        for path in oldFiles - files:
+            self.shellJobs.discard(path)
+            if path in self.jobs:
+                del self.jobs[path]
+                self.numChanged += 1
+                self.numRemoved += 1
+        for subDir in oldSubDirs - subDirs:
+            self.__removeDir(subDir)
+        self.dirs[dirPath] = (mtime, subDirs, files)
+        for subDir in subDirs:
+            self.__scanDir(subDir, False)
+
+    def __updateJob(self, jobFile):
+        try:
+            mtime = os.stat(jobFile).st_mtime
+        except OSError:
+            return
+        if jobFile in self.jobs and self.jobs[jobFile][0] == mtime and \
+               mtime < self.lastScanTime:
+            return
+        try:
+            job = Job.read(jobFile)
+        except:
+            # probably caught half-written: try again next time
+            return
+        entry = (mtime, job.remainingRetryCount, len(job.children))
+        if self.jobs.get(jobFile) != entry:
+            self.numChanged += 1
+        self.jobs[jobFile] = entry
+
+    def __removeDir(self, dirPath):
+        if dirPath not in self.dirs:
+            return
+        mtime, subDirs, files = self.dirs[dirPath]
+        del self.dirs[dirPath]
+        for path in files:
+            self.shellJobs.discard(path)
+            if path in self.jobs:
+                del self.jobs[path]
+                self.numChanged += 1
+                self.numRemoved += 1
+        for subDir in subDirs:
+            self.__removeDir(subDir)
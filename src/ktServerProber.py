@@ -0,0 +1,174 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import urllib2
+import xml.etree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+
+from cactus.progressive.multiCactusProject import MultiCactusProject
+from cactus.shared.experimentWrapper import ExperimentWrapper
+
+from ktTelemetry import fetchReport, serverStats
+
+# ping a ktserver (with an echo over its HTTP RPC interface, which gives
+# up after timeout seconds), returning (reachable, latency in seconds)
+def timedPing(dbElem, timeout=5):
+    start = time.time()
+    try:
+        response = urllib2.urlopen("http://%s:%s/rpc/echo" % (
+            dbElem.getDbHost(), str(dbElem.getDbPort())), timeout=timeout)
+        response.read()
+        response.close()
+        reachable = True
+    except:
+        reachable = False
+    return (reachable, time.time() - start)
+
+# ping a ktserver and, if it answers, fetch its statistics, returning
+# (reachable, latency in seconds, stats or None).  The ping and the fetch
+# each have their own timeout.
+def probeServer(dbElem, pingTimeout=5, reportTimeout=10):
+    reachable, latency = timedPing(dbElem, pingTimeout)
+    stats = None
+    if reachable is True:
+        try:
+            stats = serverStats(fetchReport(dbElem.getDbHost(),
+                                            dbElem.getDbPort(),
+                                            reportTimeout))
+        except:
+            stats = None
+    return (reachable, latency, stats)
+
+###############################################################################
+# Find which of the ktservers of a progressive cactus project are up.
+#
+# The project and experiment xml files are only re-read when their mtime
+# changes (cactus rewrites an experiment when it launches its server) and
+# the servers are all pinged at once from a pool of threads.  Each ping
+# and report fetch has its own socket timeout, and we give up waiting on
+# the whole batch after timeout seconds, so one hung host can't hold up
+# the rest.  A server whose probe is still running from an earlier batch
+# isn't probed again until it returns (it's counted as unreachable in the
+# meantime), and after a batch with a probe that missed the deadline the
+# pool is replaced, so hung probes never take threads away from later
+# ones.  The reachability and latency of each server
+# from the last probe are kept in self.stats, and the statistics from the
+# report of each server that answered (see ktTelemetry) in self.reports.
+###############################################################################
+class KtServerProber:
+    def __init__(self, projectPath, numThreads=16, timeout=30, pingTimeout=5,
+                 reportTimeout=10):
+        self.projectPath = projectPath
+        self.numThreads = numThreads
+        self.timeout = timeout
+        self.pingTimeout = pingTimeout
+        self.reportTimeout = reportTimeout
+        self.projectMtime = None
+        self.expMap = dict()
+        # experiment path -> (mtime, ExperimentWrapper)
+        self.expCache = dict()
+        # server name -> (reachable, latency or None if timed out)
+        self.stats = dict()
+        # server name -> serverStats() of its report
+        self.reports = dict()
+        self.pool = None
+        # server name -> result of its probe that missed the deadline
+        self.hung = dict()
+
+    # Return a list of (server name, db element) for all servers in
+    # the project
+    def servers(self):
+        mtime = os.stat(self.projectPath).st_mtime
+        if mtime != self.projectMtime:
+            mc = MultiCactusProject()
+            mc.readXML(self.projectPath)
+            self.expMap = dict(mc.expMap)
+            self.projectMtime = mtime
+        servers = []
+        for eventName, expPath in sorted(self.expMap.items()):
+            try:
+                exp = self.__readExperiment(expPath)
+            except:
+                continue
+            servers.append(("%s_%s:%s" % (eventName, exp.getDbHost(),
+                                          str(exp.getDbPort())), exp))
+            try:
+                secElem = exp.getSecondaryDBElem()
+            except:
+                secElem = None
+            if secElem is not None:
+                servers.append(("%s_secondary_%s:%s" % (
+                    eventName, secElem.getDbHost(), str(secElem.getDbPort())),
+                                secElem))
+        return servers
+
+    def __readExperiment(self, expPath):
+        mtime = os.stat(expPath).st_mtime
+        if expPath not in self.expCache or self.expCache[expPath][0] != mtime:
+            exp = ExperimentWrapper(ET.parse(expPath).getroot())
+            self.expCache[expPath] = (mtime, exp)
+        return self.expCache[expPath][1]
+
+    # Ping every server and return the set of names of those that answered
+    def probe(self):
+        servers = self.servers()
+        if self.pool is None:
+            self.pool = ThreadPool(self.numThreads)
+        for name in self.hung.keys():
+            if self.hung[name].ready():
+                del self.hung[name]
+        results = []
+        for name, dbElem in servers:
+            if name in self.hung:
+                results.append((name, None))
+            else:
+                results.append((name, self.pool.apply_async(
+                    probeServer, (dbElem, self.pingTimeout,
+                                  self.reportTimeout))))
+        deadline = time.time() + self.timeout
+        self.stats = dict()
+        self.reports = dict()
+        liveServers = set()
+        timedOut = False
+        for name, result in results:
+            try:
+                if result is None:
+                    raise TimeoutError()
+                reachable, latency, stats = result.get(
+                    max(0, deadline - time.time()))
+            except TimeoutError:
+                reachable, latency, stats = False, None, None
+                if result is not None:
+                    self.hung[name] = result
+                    timedOut = True
+            self.stats[name] = (reachable, latency)
+            if stats is not None:
+                self.reports[name] = stats
+            if reachable is True:
+                liveServers.add(name)
+        if timedOut:
+            # leave the hung threads to finish in the old pool
+            self.pool.close()
+            self.pool = None
+        return liveServers
@@ -0,0 +1,106 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+
+# Rough footprint of the cactus database per base of input sequence
+# aligned by an event.  These are calibrated so that an event aligning
+# three mammal-sized genomes plus an outgroup needs a bit over 100G, which
+# is what we see in practice.
+bytesPerBase = 10
+recordsPerBase = 0.01
+# Kyoto Cabinet recommends a bucket count of about twice the record count
+bucketsPerRecord = 2
+# Extra room on top of the estimate when setting msiz
+headroom = 1.25
+# Below this fraction of the ceiling, a pure in-memory server is fine.
+# Above it (but under the ceiling) we use snapshots so a server that dies
+# near the limit can be recovered.  Above the ceiling we go to disk.
+memoryFraction = 0.75
+
+# Parse a number of bytes with an optional k, m, g or t suffix (ie 64g)
+def parseBytes(text):
+    text = str(text).strip().lower()
+    if text.endswith("b"):
+        text = text[:-1]
+    multiplier = 1
+    for i, suffix in enumerate(["k", "m", "g", "t"]):
+        if text.endswith(suffix):
+            multiplier = 1024 ** (i + 1)
+            text = text[:-1]
+    try:
+        return int(float(text) * multiplier)
+    except ValueError:
+        raise RuntimeError("Invalid memory size: %s" % text)
+
+def formatBytes(numBytes):
+    for suffix in ["", "k", "m", "g"]:
+        if numBytes < 1024:
+            return "%d%s" % (numBytes, suffix)
+        numBytes /= 1024.
+    return "%dt" % numBytes
+
+# Estimated (bytes, records) of the database of an event.  Besides its
+# inputs, each event also aligns at least one outgroup, which we assume
+# is about as big as the event's own genome.
+def eventDbSize(costModel, event):
+    bases = costModel.eventInputSize(event) + costModel.genomeSize(event)
+    return (int(bases * bytesPerBase), int(bases * recordsPerBase))
+
+###############################################################################
+# Pick the ktserver type and tuning for a project.  All events share the
+# same database settings (they come from the experiment template), so
+# everything is sized for the biggest event.  Returns (ktType, create
+# tuning string, list of lines explaining the choice).
+###############################################################################
+def sizeKtServers(costModel, memoryCeiling):
+    reasons = []
+    maxEvent, maxBytes, maxRecords = None, 0, 0
+    for event in costModel.events:
+        numBytes, numRecords = eventDbSize(costModel, event)
+        reasons.append("  %s: %d input bases plus an outgroup -> ~%s, "
+                       "~%d records" % (
+            event, costModel.eventInputSize(event), formatBytes(numBytes),
+            numRecords))
+        if numBytes >= maxBytes:
+            maxEvent, maxBytes, maxRecords = event, numBytes, numRecords
+    needed = int(maxBytes * headroom)
+    bnum = max(1000000, maxRecords * bucketsPerRecord)
+    if needed <= memoryCeiling * memoryFraction:
+        ktType = "memory"
+        msiz = needed
+        why = "fits comfortably under"
+    elif needed <= memoryCeiling:
+        ktType = "snapshot"
+        msiz = needed
+        why = "fits, but with little room, under"
+    else:
+        ktType = "disk"
+        msiz = int(memoryCeiling * memoryFraction)
+        why = "does not fit under"
+    tuning = "#bnum=%d#msiz=%d" % (bnum, msiz)
+    reasons.insert(0, "Sizing ktservers for largest event %s, which needs "
+                   "~%s (with %d%% headroom) and %s the %s memory ceiling: "
+                   "using ktType=%s and tuning %s.  Per-event estimates:" % (
+                       maxEvent, formatBytes(needed),
+                       int(100 * (headroom - 1)), why,
+                       formatBytes(memoryCeiling), ktType, tuning))
+    return (ktType, tuning, reasons)
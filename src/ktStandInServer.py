@@ -0,0 +1,165 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import time
+import BaseHTTPServer
+from optparse import OptionParser
+from threading import Thread
+
+from ktServerSizing import parseBytes
+from ktTelemetry import KtTelemetry, fetchReport, serverStats
+
+###############################################################################
+# A small local stand-in for a ktserver, for checking the telemetry (and
+# the KtServerProber) without running cactus.  It answers /rpc/echo and
+# /rpc/report over HTTP like Kyoto Tycoon does, with a report describing
+# one in-memory database that holds records (each recordBytes big) and
+# grows by growthBytes per second from when the server starts.  Every
+# report request counts as an operation.  If hang is set, requests are
+# accepted but never answered, like a wedged server.
+###############################################################################
+class StandInKtServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, port=0, records=1000, recordBytes=1024,
+                 growthBytes=0, hang=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                           StandInRequestHandler)
+        self.records = records
+        self.recordBytes = recordBytes
+        self.growthBytes = growthBytes
+        self.hang = hang
+        self.startTime = time.time()
+        self.operations = 0
+        self.thread = None
+
+    def port(self):
+        return self.server_address[1]
+
+    def report(self):
+        self.operations += 1
+        size = self.records * self.recordBytes + int(
+            self.growthBytes * (time.time() - self.startTime))
+        count = size / max(1, self.recordBytes)
+        lines = ["conf_kc_version\t1.2.76 (16.13)",
+                 "db_0\tcount=%d size=%d path=*" % (count, size),
+                 "db_total_count\t%d" % count,
+                 "db_total_size\t%d" % size,
+                 "cnt_get\t%d" % self.operations,
+                 "cnt_set\t%d" % count,
+                 "cnt_misc\t%d" % self.operations,
+                 "serv_conn_count\t1"]
+        return "\n".join(lines) + "\n"
+
+    # Serve from a daemon thread, returning straight away
+    def startThread(self):
+        self.thread = Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stopThread(self):
+        self.shutdown()
+        self.server_close()
+
+class StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.server.hang:
+            time.sleep(3600)
+            return
+        if self.path.startswith("/rpc/report"):
+            body = self.server.report()
+        elif self.path.startswith("/rpc/echo"):
+            body = ""
+        else:
+            self.send_error(501)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/tab-separated-values")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Poll a stand-in server the way the JobStatusMonitor polls the real ones,
+# printing what the telemetry makes of it each time
+def checkTelemetry(server, memoryCeiling=None, numPolls=5, pollTime=1):
+    telemetry = KtTelemetry(memoryCeiling, horizon=3600,
+                            pressureCallbackFn=lambda name, stats:
+                            sys.stdout.write("  under memory pressure\n"))
+    for i in xrange(numPolls):
+        stats = serverStats(fetchReport("127.0.0.1", server.port()))
+        telemetry.update({ "standIn" : stats })
+        print telemetry.describe("standIn")
+        if i < numPolls - 1:
+            time.sleep(pollTime)
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]\n\n"
+                          "Run a stand-in for a ktserver's HTTP RPC "
+                          "interface (/rpc/echo and /rpc/report)")
+    parser.add_option("--port", dest="port", type=int, default=1978,
+                      help="Port to listen on [default: %default]")
+    parser.add_option("--records", dest="records", type=int, default=1000,
+                      help="Records in the database at the start "
+                      "[default: %default]")
+    parser.add_option("--recordBytes", dest="recordBytes", type=int,
+                      default=1024, help="Size of a record "
+                      "[default: %default]")
+    parser.add_option("--growth", dest="growth", default="0",
+                      help="Bytes the database grows by per second "
+                      "(ex 10m) [default: %default]")
+    parser.add_option("--hang", dest="hang", action="store_true",
+                      default=False, help="Accept requests but never "
+                      "answer them")
+    parser.add_option("--check", dest="check", action="store_true",
+                      default=False, help="Instead of serving until "
+                      "killed, poll the server with the telemetry a few "
+                      "times and print the results")
+    parser.add_option("--memoryCeiling", dest="memoryCeiling", default=None,
+                      help="(--check) Memory ceiling to check against "
+                      "(ex 1g)")
+    options, args = parser.parse_args()
+    if len(args) != 0:
+        parser.print_help()
+        return 1
+    server = StandInKtServer(options.port, options.records,
+                             options.recordBytes, parseBytes(options.growth),
+                             options.hang)
+    if options.check:
+        server.startThread()
+        memoryCeiling = None
+        if options.memoryCeiling is not None:
+            memoryCeiling = parseBytes(options.memoryCeiling)
+        try:
+            checkTelemetry(server, memoryCeiling)
+        finally:
+            server.stopThread()
+        return 0
+    print "Stand-in ktserver listening on 127.0.0.1:%d" % server.port()
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
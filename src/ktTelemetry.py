@@ -0,0 +1,206 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import urllib2
+
+from ktServerSizing import formatBytes
+
+# Parse the tab separated key/value lines of a Kyoto Tycoon /rpc/report
+# response.  Database lines (db_0, db_1...) hold space separated
+# key=value pairs and are returned as dictionaries.
+def parseReport(text):
+    report = dict()
+    for line in text.split("\n"):
+        tokens = line.rstrip("\r").split("\t", 1)
+        if len(tokens) != 2:
+            continue
+        key, value = tokens
+        if key.startswith("db_") and key[3:].isdigit():
+            fields = dict()
+            for pair in value.split():
+                if "=" in pair:
+                    name, field = pair.split("=", 1)
+                    fields[name] = field
+            value = fields
+        report[key] = value
+    return report
+
+def reportInt(report, key):
+    try:
+        return int(report[key])
+    except (KeyError, ValueError):
+        return None
+
+# Statistics of a server from its report: records and bytes in its
+# databases, the memory it uses (its resident size when the server
+# reports it, otherwise the size of its databases, which is what an
+# in-memory server holds) and the number of operations it has served
+def serverStats(report):
+    records = 0
+    dbSize = 0
+    for key, value in report.items():
+        if key.startswith("db_") and isinstance(value, dict):
+            try:
+                records += int(value.get("count", 0))
+                dbSize += int(value.get("size", 0))
+            except ValueError:
+                pass
+    memory = reportInt(report, "sys_mem_rss")
+    if memory is None:
+        memory = dbSize
+    operations = 0
+    for key in report:
+        if key.startswith("cnt_") and not key.endswith("_misc"):
+            operations += reportInt(report, key) or 0
+    return { "records" : records, "dbSize" : dbSize, "memory" : memory,
+             "operations" : operations }
+
+# Fetch the report of the server at host:port over Kyoto Tycoon's HTTP
+# RPC interface
+def fetchReport(host, port, timeout=10):
+    response = urllib2.urlopen("http://%s:%s/rpc/report" % (host, str(port)),
+                               timeout=timeout)
+    try:
+        return parseReport(response.read())
+    finally:
+        response.close()
+
+# Slope (per second) of the least squares line through (time, value)
+# points, or None if there are too few of them
+def growthRate(points):
+    if len(points) < 2:
+        return None
+    n = float(len(points))
+    meanT = sum([t for t, v in points]) / n
+    meanV = sum([v for t, v in points]) / n
+    varT = sum([(t - meanT) ** 2 for t, v in points])
+    if varT == 0:
+        return None
+    return sum([(t - meanT) * (v - meanV) for t, v in points]) / varT
+
+###############################################################################
+# Keep the recent history of each ktserver's statistics, and estimate how
+# fast it's growing and how soon it will reach the memory ceiling.
+#
+# update() takes the stats of the servers that answered a poll.  The
+# growth rate of a server is the slope of a least squares fit of its
+# memory over the last window seconds, and its operation rate comes from
+# the change in its operation count since the previous sample.  A server
+# is under memory pressure once it's using more than warnFraction of the
+# ceiling, or is on course to reach the ceiling within horizon seconds.
+# The callback (if given) is called with (server name, stats) when a server
+# comes under pressure, and again only if it came out of it in between.
+###############################################################################
+class KtTelemetry:
+    def __init__(self, memoryCeiling=None, window=3600, horizon=7200,
+                 warnFraction=0.9, pressureCallbackFn=None):
+        self.memoryCeiling = memoryCeiling
+        self.window = window
+        self.horizon = horizon
+        self.warnFraction = warnFraction
+        self.pressureCallbackFn = pressureCallbackFn
+        # server name -> list of (time, stats)
+        self.history = dict()
+        # server name -> latest stats, with the rates
+        self.stats = dict()
+        self.underPressure = set()
+
+    def update(self, serverStats, now=None):
+        if now is None:
+            now = time.time()
+        self.stats = dict()
+        for name, stats in serverStats.items():
+            history = self.history.setdefault(name, [])
+            stats = dict(stats)
+            stats["opsPerSecond"] = None
+            if len(history) > 0:
+                prevTime, prevStats = history[-1]
+                if now > prevTime and \
+                       stats["operations"] >= prevStats["operations"]:
+                    stats["opsPerSecond"] = (stats["operations"] -
+                                             prevStats["operations"]) / \
+                                             (now - prevTime)
+            history.append((now, stats))
+            while len(history) > 2 and history[0][0] < now - self.window:
+                history.pop(0)
+            stats["growth"] = growthRate([(t, s["memory"]) for t, s in
+                                          history])
+            stats["timeToCeiling"] = self.timeToCeiling(stats)
+            self.stats[name] = stats
+        # forget servers that have gone away
+        for name in self.history.keys():
+            if name not in serverStats:
+                del self.history[name]
+                self.underPressure.discard(name)
+        return self.checkPressure()
+
+    # Seconds until a server's memory reaches the ceiling at its current
+    # growth rate, or None if it isn't growing (or there's no ceiling)
+    def timeToCeiling(self, stats):
+        if self.memoryCeiling is None or stats["growth"] is None or \
+               stats["growth"] <= 0:
+            return None
+        return max(0., (self.memoryCeiling - stats["memory"]) /
+                   stats["growth"])
+
+    def isUnderPressure(self, stats):
+        if self.memoryCeiling is None:
+            return False
+        if stats["memory"] >= self.warnFraction * self.memoryCeiling:
+            return True
+        return stats["timeToCeiling"] is not None and \
+               stats["timeToCeiling"] < self.horizon
+
+    # Return the names of the servers that newly came under pressure,
+    # calling the callback for each
+    def checkPressure(self):
+        newlyPressured = []
+        for name, stats in sorted(self.stats.items()):
+            if self.isUnderPressure(stats):
+                if name not in self.underPressure:
+                    self.underPressure.add(name)
+                    newlyPressured.append(name)
+                    if self.pressureCallbackFn is not None:
+                        self.pressureCallbackFn(name, stats)
+            else:
+                self.underPressure.discard(name)
+        return newlyPressured
+
+    # Total records and operations over all servers, for spotting progress
+    def totals(self):
+        return (sum([s["records"] for s in self.stats.values()]),
+                sum([s["operations"] for s in self.stats.values()]))
+
+    # Line describing a server's state, for warnings
+    def describe(self, name):
+        stats = self.stats[name]
+        desc = "%s: %d records, %s" % (name, stats["records"],
+                                       formatBytes(stats["memory"]))
+        if self.memoryCeiling is not None:
+            desc += " of %s" % formatBytes(self.memoryCeiling)
+        if stats["growth"] is not None:
+            desc += ", growing %s/hour" % formatBytes(
+                max(0, stats["growth"]) * 3600)
+        if stats["timeToCeiling"] is not None:
+            desc += ", full in about %dm" % (stats["timeToCeiling"] / 60)
+        return desc
@@ -0,0 +1,154 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import re
+import shutil
+import tempfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from sonLib.bioio import system, popenCatch
+
+from runReport import envCommand
+
+# Leaf names of a newick tree, in the order they appear
+def newickLeaves(newick):
+    return [name.strip() for name in re.findall(r"[(,]([^(),:;]+)", newick)]
+
+# Split sequences (a list of (name, length) pairs) into windows of at
+# most windowSize bases, then group the windows into pieces of about
+# windowSize bases each (so that small scaffolds don't each get a piece).
+# Returns a list of pieces, each a list of (name, start, length) windows,
+# in reference order.
+def mafPieces(sequences, windowSize):
+    pieces = []
+    piece = []
+    pieceSize = 0
+    for name, length in sequences:
+        for start in xrange(0, length, windowSize):
+            windowLength = min(windowSize, length - start)
+            if pieceSize > 0 and pieceSize + windowLength > windowSize:
+                pieces.append(piece)
+                piece = []
+                pieceSize = 0
+            piece.append((name, start, windowLength))
+            pieceSize += windowLength
+    if len(piece) > 0:
+        pieces.append(piece)
+    return pieces
+
+###############################################################################
+# Export a HAL file to MAF with bounded memory.  The reference genome's
+# sequences are cut into windows, and groups of windows (pieces) are
+# exported by numWorkers hal2maf processes at a time.  Each hal2maf runs
+# with an HDF5 cache of half of workerMemory and under a ulimit of
+# workerMemory, so memory use depends only on the number of workers.
+# Pieces are appended to the output (minus their MAF headers) in
+# reference order as soon as they and all the pieces before them are
+# done, and are deleted as they go, so the temporary space needed stays
+# small too.
+###############################################################################
+class MafExporter:
+    def __init__(self, halPath, refGenome=None, numWorkers=None,
+                 workerMemory=2 << 30, windowSize=10000000, envFile=None,
+                 logPath=None, tempDir=None):
+        self.halPath = halPath
+        self.envFile = envFile
+        self.logPath = logPath
+        self.refGenome = refGenome
+        if self.refGenome is None:
+            self.refGenome = newickLeaves(self.__halStats("--tree"))[0]
+        self.numWorkers = numWorkers
+        if self.numWorkers is None:
+            self.numWorkers = cpu_count()
+        self.workerMemory = workerMemory
+        self.windowSize = windowSize
+        self.tempDir = tempDir
+
+    def __command(self, cmd):
+        return envCommand(self.envFile, cmd)
+
+    def __halStats(self, args):
+        return popenCatch(self.__command("halStats %s '%s'" % (
+            args, self.halPath))).strip()
+
+    # (name, length) of each sequence of the reference genome
+    def sequences(self):
+        sequences = []
+        for line in self.__halStats("--chromSizes %s" %
+                                    self.refGenome).split("\n"):
+            tokens = line.split()
+            if len(tokens) == 2:
+                sequences.append((tokens[0], int(tokens[1])))
+        return sequences
+
+    # Write the MAF of one piece to piecePath (run in a pool thread)
+    def exportPiece(self, args):
+        piece, piecePath = args
+        for name, start, length in piece:
+            cmd = "ulimit -v %d && hal2maf '%s' '%s' --refGenome '%s' " \
+                  "--refSequence '%s' --start %d --length %d --noAncestors " \
+                  "--cacheBytes %d --append" % (
+                      self.workerMemory / 1024, self.halPath, piecePath,
+                      self.refGenome, name, start, length,
+                      self.workerMemory / 2)
+            if self.logPath is not None:
+                cmd += " 2>> %s" % self.logPath
+            system(self.__command(cmd))
+        return piecePath
+
+    def export(self, mafPath):
+        pieces = mafPieces(self.sequences(), self.windowSize)
+        if len(pieces) == 0:
+            raise RuntimeError("No sequences found for reference genome %s "
+                               "in %s" % (self.refGenome, self.halPath))
+        pieceDir = tempfile.mkdtemp(prefix="mafExport", dir=self.tempDir)
+        tempPath = mafPath + ".tmp"
+        pool = ThreadPool(min(self.numWorkers, len(pieces)))
+        try:
+            jobs = [(piece, os.path.join(pieceDir, "%d.maf" % i))
+                    for i, piece in enumerate(pieces)]
+            mafFile = open(tempPath, "w")
+            mafFile.write("##maf version=1 scoring=N/A\n\n")
+            for piecePath in pool.imap(self.exportPiece, jobs):
+                if os.path.exists(piecePath):
+                    appendMaf(piecePath, mafFile)
+                    os.remove(piecePath)
+            mafFile.close()
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(pieceDir)
+        os.rename(tempPath, mafPath)
+
+# Append a MAF file to an open output, without its header (the leading
+# comment lines)
+def appendMaf(piecePath, outFile):
+    pieceFile = open(piecePath, "r")
+    while True:
+        pos = pieceFile.tell()
+        line = pieceFile.readline()
+        if not line or not line.startswith("#"):
+            pieceFile.seek(pos)
+            break
+    shutil.copyfileobj(pieceFile, outFile, 1 << 24)
+    pieceFile.close()
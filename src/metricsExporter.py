@@ -0,0 +1,99 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import json
+
+from runReport import usageSampler
+
+###############################################################################
+# Write the samples taken by the JobStatusMonitor to disk, as a line of
+# json per poll appended to <workDir>/metrics.jsonl and, optionally, as a
+# Prometheus text format file that the node_exporter textfile collector
+# can pick up.  A sample is a flat dictionary of numbers, except for the
+# per-ktserver values (ie "ktserverLatency", the ping latencies) which map
+# server names to numbers.
+#
+# Running du on a big working directory isn't free, so the disk usage is
+# taken from the shared DiskUsageSampler (see runReport), and only
+# measured again once its last measurement is diskUsageInterval seconds
+# old.
+###############################################################################
+class MetricsExporter:
+    jsonFileName = "metrics.jsonl"
+    def __init__(self, workDir, promPath=None, diskUsageInterval=600):
+        self.workDir = workDir
+        self.jsonPath = os.path.join(workDir, MetricsExporter.jsonFileName)
+        self.promPath = promPath
+        self.diskUsageInterval = diskUsageInterval
+
+    def diskUsage(self):
+        return usageSampler(self.workDir).usage(
+            maxAge=self.diskUsageInterval)
+
+    def export(self, sample):
+        sample = dict(sample)
+        sample["time"] = time.time()
+        sample["workDirBytes"] = self.diskUsage()
+        jsonFile = open(self.jsonPath, "a")
+        jsonFile.write(json.dumps(sample, sort_keys=True) + "\n")
+        jsonFile.close()
+        if self.promPath is not None:
+            self.writeProm(sample)
+
+    # node_exporter may read the file at any time, so it is written to a
+    # temporary file then renamed into place
+    def writeProm(self, sample):
+        label = 'workdir="%s"' % os.path.abspath(self.workDir).replace(
+            '"', '\\"')
+        lines = []
+        for key in sorted(sample.keys()):
+            value = sample[key]
+            if isinstance(value, dict):
+                if key == "ktserverLatency":
+                    metric = "progressive_cactus_ktserver_latency_seconds"
+                else:
+                    metric = "progressive_cactus_" + promName(key)
+                lines.append("# TYPE %s gauge" % metric)
+                for server, serverValue in sorted(value.items()):
+                    if serverValue is not None:
+                        lines.append('%s{%s,server="%s"} %f' % (
+                            metric, label, server, serverValue))
+            elif isinstance(value, (int, long, float)):
+                metric = "progressive_cactus_" + promName(key)
+                lines.append("# TYPE %s gauge" % metric)
+                lines.append("%s{%s} %s" % (metric, label, repr(value)))
+        tempPath = self.promPath + ".tmp"
+        promFile = open(tempPath, "w")
+        promFile.write("\n".join(lines) + "\n")
+        promFile.close()
+        os.rename(tempPath, self.promPath)
+
+# camelCase sample key -> snake_case metric name
+def promName(key):
+    name = ""
+    for c in key:
+        if c.isupper():
+            name += "_" + c.lower()
+        else:
+            name += c
+    return name
@@ -0,0 +1,141 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import heapq
+import datetime
+from multiprocessing import cpu_count
+
+from ktServerSizing import eventDbSize, formatBytes, headroom
+from subtreePlanner import jobLimit
+
+# CPU seconds per unit of EventCostModel work.  The README's mammal run
+# took about 100 CPU days per 3G genome aligned.
+cpuSecondsPerWork = 100. * 24 * 3600 / (2 * 3e9)
+# Output (.c2h, .fa and .hal) left on disk per base aligned by an event
+outputBytesPerBase = 3
+# CPUs a subtree gets on a cluster when --maxJobs doesn't say otherwise
+clusterCpusPerSubtree = 32
+
+###############################################################################
+# Simulate running the events of a progressive alignment with maxParallel
+# subtrees at a time, each getting cpusPerSlot CPUs.  An event starts as
+# soon as its child events are done and a slot is free, with the
+# highest-priority (see EventCostModel) ready event going first.
+#
+# While running, an event holds its ktserver's memory, and its database
+# also counts against disk unless the servers are purely in memory.
+# Finished events leave their output on disk.
+#
+# Returns a dictionary with the predicted makespan, peak memory, peak
+# disk and the (start, end) time of every event, in seconds.
+###############################################################################
+def simulateSchedule(costModel, maxParallel, cpusPerSlot, ktType='memory'):
+    maxParallel = max(1, int(maxParallel))
+    cpusPerSlot = max(1, cpusPerSlot)
+    waitingOn = dict()
+    for event in costModel.events:
+        waitingOn[event] = len(costModel.eventChildren(event))
+    ready = [(-costModel.eventPriority(event), event) for event in
+             costModel.events if waitingOn[event] == 0]
+    heapq.heapify(ready)
+    running = []
+    timings = dict()
+    now, memory, disk = 0., 0, 0
+    peakMemory, peakDisk = 0, 0
+    while len(ready) > 0 or len(running) > 0:
+        while len(ready) > 0 and len(running) < maxParallel:
+            priority, event = heapq.heappop(ready)
+            duration = costModel.eventWork(event) * cpuSecondsPerWork / \
+                       cpusPerSlot
+            heapq.heappush(running, (now + duration, event))
+            timings[event] = (now, now + duration)
+            dbBytes = eventDbSize(costModel, event)[0] * headroom
+            memory += dbBytes
+            if ktType != 'memory':
+                disk += dbBytes
+        peakMemory = max(peakMemory, memory)
+        peakDisk = max(peakDisk, disk)
+        now, event = heapq.heappop(running)
+        dbBytes = eventDbSize(costModel, event)[0] * headroom
+        memory -= dbBytes
+        if ktType != 'memory':
+            disk -= dbBytes
+        disk += costModel.eventInputSize(event) * outputBytesPerBase
+        peakDisk = max(peakDisk, disk)
+        parent = costModel.eventParent(event)
+        if parent is not None:
+            waitingOn[parent] -= 1
+            if waitingOn[parent] == 0:
+                heapq.heappush(ready, (-costModel.eventPriority(parent),
+                                       parent))
+    return { "makespan" : now,
+             "peakMemory" : peakMemory,
+             "peakDisk" : peakDisk,
+             "timings" : timings }
+
+def formatSeconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+# Human readable summary of a simulation
+def planSummary(costModel, plan, maxParallel, cpusPerSlot, ktType):
+    lines = ["Plan for %d events with %d parallel subtrees of %d cpus each "
+             "(ktType %s):" % (len(costModel.events), maxParallel,
+                               cpusPerSlot, ktType),
+             "  predicted makespan: %s" % formatSeconds(plan["makespan"]),
+             "  peak ktserver memory: %s" % formatBytes(plan["peakMemory"]),
+             "  peak disk: %s" % formatBytes(plan["peakDisk"]),
+             "  critical path: %s" % " -> ".join(costModel.criticalPath()),
+             "  %-20s %12s %12s %12s" % ("event", "start", "end", "memory")]
+    for event in sorted(plan["timings"], key=lambda e: plan["timings"][e]):
+        start, end = plan["timings"][event]
+        lines.append("  %-20s %12s %12s %12s" % (
+            event, formatSeconds(start), formatSeconds(end),
+            formatBytes(eventDbSize(costModel, event)[0] * headroom)))
+    return "\n".join(lines)
+
+###############################################################################
+# Simulate the alignment that projWrapper (built with dryRun=True) is set
+# up for, using its config's maxParallelSubtrees and ktserver type, and
+# return the summary.  The CPUs are shared evenly between the subtrees.
+###############################################################################
+def planAlignment(projWrapper):
+    options = projWrapper.options
+    costModel = projWrapper.getCostModel()
+    maxParallel = projWrapper.configWrapper.getMaxParallelSubtrees()
+    if options.database != "kyoto_tycoon":
+        maxParallel = 1
+    maxThreads = getattr(options, "maxThreads", None)
+    maxJobs = getattr(options, "maxJobs", None)
+    if options.batchSystem == 'singleMachine':
+        if maxThreads is None:
+            maxThreads = cpu_count()
+        cpusPerSlot = int(maxThreads) / maxParallel
+    elif jobLimit(maxJobs) is not None:
+        cpusPerSlot = jobLimit(maxJobs) / maxParallel
+    else:
+        cpusPerSlot = clusterCpusPerSubtree
+    ktType = projWrapper.ktType
+    if ktType is None:
+        ktType = "disk"
+    plan = simulateSchedule(costModel, maxParallel, cpusPerSlot, ktType)
+    return planSummary(costModel, plan, maxParallel, max(1, cpusPerSlot),
+                       ktType)
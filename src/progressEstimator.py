@@ -0,0 +1,162 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import datetime
+import xml.etree.ElementTree as ET
+from optparse import OptionParser
+
+from cactus.progressive.multiCactusProject import MultiCactusProject
+from cactus.shared.experimentWrapper import ExperimentWrapper
+
+from projectWrapper import ProjectWrapper
+from eventCostModel import EventCostModel
+from fastaScanner import FastaScanner, sequenceSize
+
+# Sizes of the leaf genomes of the alignment in workDir.  We use the
+# sequence lengths from the sanity check scan if it's there, and the
+# sizes of the files otherwise.
+def leafSizesFromWorkDir(workDir):
+    expWrapper = ExperimentWrapper(ET.parse(
+        os.path.join(workDir, "expTemplate.xml")).getroot())
+    tree = expWrapper.getTree()
+    leaves = [tree.getName(node) for node in tree.postOrderTraversal()
+              if tree.isLeaf(node)]
+    scanner = FastaScanner(os.path.join(workDir, "sequenceScan.json"))
+    leafSizes = dict()
+    for name, path in zip(leaves, expWrapper.getSequences()):
+        if os.path.exists(path):
+            leafSizes[name] = sequenceSize(path, scanner)
+    return leafSizes
+
+# Time the event with the given experiment file finished (ie when the last
+# of its HAL export inputs was written), or None if it isn't done
+def eventFinishTime(expPath):
+    exp = ExperimentWrapper(ET.parse(expPath).getroot())
+    finishTime = None
+    for path in [exp.getHALPath(), exp.getHALFastaPath()]:
+        if path is None or not os.path.isfile(path) or \
+               os.path.getsize(path) == 0:
+            return None
+        finishTime = max(finishTime, os.path.getmtime(path))
+    return finishTime
+
+###############################################################################
+# Estimate how far along the progressive alignment in a working directory
+# is, using only what's in the working directory.
+#
+# An event is considered done once both of its HAL export inputs (the
+# .c2h and .fa files that cactus writes at the very end of the event) are
+# there.  The fraction of the total work (see EventCostModel) in done
+# events gives the percent complete, and the rate at which that work was
+# done since startTime gives the ETA, which therefore gets better with
+# every event that finishes.  If startTime isn't given, the time the
+# project was created is used.
+###############################################################################
+class ProgressEstimator:
+    def __init__(self, workDir, startTime=None):
+        self.workDir = workDir
+        self.projectPath = os.path.join(
+            workDir, ProjectWrapper.alignmentDirName,
+            "%s_project.xml" % ProjectWrapper.alignmentDirName)
+        self.mcProj = MultiCactusProject()
+        self.mcProj.readXML(self.projectPath)
+        self.costModel = EventCostModel(self.mcProj.mcTree,
+                                        leafSizesFromWorkDir(workDir),
+                                        self.mcProj.expMap.keys())
+        self.startTime = startTime
+        if self.startTime is None:
+            self.startTime = os.path.getmtime(self.projectPath)
+        # event -> time it finished
+        self.doneEvents = dict()
+        self.fractionDone = 0.
+        self.eta = None
+
+    # Time the event finished, or None if it isn't done
+    def eventFinishTime(self, event):
+        return eventFinishTime(self.mcProj.expMap[event])
+
+    def update(self):
+        for event in self.costModel.events:
+            if event not in self.doneEvents:
+                finishTime = self.eventFinishTime(event)
+                if finishTime is not None:
+                    self.doneEvents[event] = finishTime
+        totalWork = self.costModel.totalWork()
+        doneWork = sum([self.costModel.eventWork(event) for event in
+                        self.doneEvents])
+        self.fractionDone = 1.
+        if totalWork > 0:
+            self.fractionDone = doneWork / totalWork
+        self.eta = None
+        recentDone = [t for t in self.doneEvents.values()
+                      if t > self.startTime]
+        if len(recentDone) > 0 and doneWork > 0:
+            recentWork = sum([self.costModel.eventWork(e) for e, t in
+                              self.doneEvents.items() if t > self.startTime])
+            elapsed = max(time.time(), max(recentDone)) - self.startTime
+            if recentWork > 0 and elapsed > 0:
+                self.eta = (totalWork - doneWork) * elapsed / recentWork
+        return self.fractionDone
+
+    def summary(self):
+        msg = "%d of %d events done (%.1f%% of estimated work)" % (
+            len(self.doneEvents), len(self.costModel.events),
+            100. * self.fractionDone)
+        if self.fractionDone >= 1.:
+            msg += ", alignment complete"
+        elif self.eta is not None:
+            msg += ", about %s remaining" % str(
+                datetime.timedelta(seconds=int(self.eta)))
+        return msg
+
+def main():
+    usage = "usage: progressiveCactusStatus.sh [options] <workDir>\n\n"\
+            "Estimate the progress of the alignment in <workDir>"
+    parser = OptionParser(usage=usage)
+    parser.add_option("--events", dest="events", action="store_true",
+                      help="List the status of each event", default=False)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        return 1
+    try:
+        estimator = ProgressEstimator(args[0])
+    except:
+        sys.stderr.write("Error: No progressive alignment found in %s\n" %
+                         args[0])
+        return -1
+    estimator.update()
+    if options.events is True:
+        for event in estimator.costModel.events:
+            status = "pending"
+            if event in estimator.doneEvents:
+                status = "done %s" % str(datetime.datetime.fromtimestamp(
+                    estimator.doneEvents[event]))
+            print "%s\t%.3g\t%s" % (event,
+                                    estimator.costModel.eventWork(event),
+                                    status)
+    print estimator.summary()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
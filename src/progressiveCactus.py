@@ -29,6 +29,7 @@ import copy
 from optparse import OptionParser
 from optparse import OptionGroup
 import imp
+import shlex
 import socket
 import signal
 import traceback
@@ -52,6 +53,16 @@ from cactus.shared.configWrapper import ConfigWrapper
 from seqFile import SeqFile
 from projectWrapper import ProjectWrapper
 from jobStatusMonitor import JobStatusMonitor
+from metricsExporter import MetricsExporter
+from runReport import RunReport, reportSystem, envCommand
+from progressEstimator import ProgressEstimator
+from ktServerSizing import parseBytes
+from planSimulator import planAlignment
+from halExporter import IncrementalHalExporter, HalExportThread
+from mafExporter import MafExporter
+from dirRemover import removeDir
+from checkpoint import Checkpoint, CheckpointThread
+from workDirManager import WorkDirManager, WorkDirThread
 
 def initParser():
     usage = "usage: runProgressiveCactus.sh [options] <seqFile> <workDir> <outputHalFile>\n\n"\
@@ -80,8 +91,18 @@ def initParser():
                       " [default: %default]",
                       default="kyoto_tycoon")
     parser.add_option("--outputMaf", dest="outputMaf",
-                      help="[DEPRECATED use hal2maf on the ouput file instead] Path of output alignment in .maf format.  This option should be avoided and will soon be removed.  It may cause sequence names to be mangled, and use a tremendous amount of memory. ",
+                      help="Path of output alignment in .maf format.  It is "
+                      "exported from <outputHalFile> in windows along the "
+                      "reference genome (see --mafReference) by parallel "
+                      "hal2maf processes with bounded memory",
                       default=None)
+    parser.add_option("--mafReference", dest="mafReference",
+                      help="Reference genome of the --outputMaf alignment "
+                      "[default: the first leaf of the tree]", default=None)
+    parser.add_option("--mafWorkerMemory", dest="mafWorkerMemory",
+                      help="Memory limit of each hal2maf process used to "
+                      "export --outputMaf [default: %default]",
+                      default="2g")
     parser.add_option("--configFile", dest="configFile",
                       help="Specify cactus configuration file",
                       default=None)
@@ -98,6 +119,58 @@ def initParser():
                       " dangerous to use until we can more robustly detect " +
                       " deadlocks.",
                       default=False)
+    parser.add_option("--deadlockSensitivity", dest="deadlockSensitivity",
+                      type=float, help="How many times longer than the "
+                      "usual gap between signs of progress (job files "
+                      "changing, jobs completing, the log growing) the "
+                      "jobTree monitor waits before suspecting a deadlock.  "
+                      "Lower values catch hangs sooner but may flag slow "
+                      "phases [default: %default]", default=8.0)
+    parser.add_option("--metricsPromFile", dest="metricsPromFile",
+                      help="Also write the monitoring metrics that are "
+                      "appended to <workDir>/metrics.jsonl to this path in "
+                      "Prometheus text format (ie for the node_exporter "
+                      "textfile collector)", default=None)
+    parser.add_option("--incrementalHal", dest="incrementalHal",
+                      action="store_true", help="Export each ancestral "
+                      "event to HAL as soon as it is aligned, while the "
+                      "rest of the alignment runs, then merge the exported "
+                      "events into <outputHalFile> at the end.  Events "
+                      "exported by a previous run are not exported again",
+                      default=False)
+    parser.add_option("--preprocess", dest="preprocess", action="store_true",
+                      help="Stage the input sequences into <workDir> with "
+                      "their headers fixed up for cactus (sequence names "
+                      "made valid and unique, carriage returns removed), "
+                      "and warn about genomes that don't look soft-masked."
+                      "  Genomes that need no changes are linked rather "
+                      "than copied", default=False)
+    parser.add_option("--keepIntermediates", dest="keepIntermediates",
+                      action="store_true", help="Compress the databases "
+                      "and other intermediate files of aligned events "
+                      "instead of deleting them once their parent event "
+                      "is aligned (and, with --incrementalHal, they're "
+                      "exported), and keep the jobTree after a successful "
+                      "run", default=False)
+    parser.add_option("--reclaimDuringRun", dest="reclaimDuringRun",
+                      action="store_true", help="Delete (or with "
+                      "--keepIntermediates, compress) the intermediate "
+                      "files of aligned events while the alignment runs "
+                      "rather than once it's finished, and keep track of "
+                      "the space used in <workDir>/diskUsage.json",
+                      default=False)
+    parser.add_option("--diskQuota", dest="diskQuota",
+                      help="Maximum size of <workDir> (ex 500g).  When it "
+                      "is exceeded the alignment is paused (so no new "
+                      "subtrees are started) until space is freed.  "
+                      "Implies --reclaimDuringRun",
+                      default=None)
+    parser.add_option("--plan", dest="plan", action="store_true",
+                      help="Don't run anything.  Just print the predicted "
+                      "runtime, peak memory, peak disk and per-event "
+                      "schedule of the alignment with the given options.  "
+                      "<workDir> and <outputHalFile> are optional",
+                      default=False)
     parser.add_option("--overwrite", dest="overwrite", action="store_true",
                       help="Re-align nodes in the tree that have already" +
                       " been successfully aligned.",
@@ -133,8 +206,19 @@ def initParser():
     ktGroup.add_option("--ktType", dest="ktType",
                        help="Kyoto Tycoon server type "
                        "(memory, snapshot, or disk)"
-                       " [default: %default]",
-                       default='memory')
+                       " [default: memory, or chosen from the genome sizes"
+                       " if --ktMemoryCeiling is given]",
+                       default=None)
+    ktGroup.add_option("--ktMemoryCeiling", dest="ktMemoryCeiling",
+                       help="Memory available to a ktserver on the nodes "
+                       "they run on (ex 64g).  If given, the server type "
+                       "(unless --ktType is given) and creation tuning "
+                       "(unless --ktCreateTuning is given) are estimated "
+                       "from the input genome sizes, with the reasoning "
+                       "written to cactus.log.  The ktservers are also "
+                       "watched while they run, with a warning when one is "
+                       "about to outgrow it",
+                       default=None)
     # sonlib doesn't allow for spaces in attributes in the db conf
     # which renders this options useless
     #ktGroup.add_option("--ktOpts", dest="ktOpts",
@@ -176,12 +260,20 @@ def validateInput(workDir, outputHalFile, options):
             open(options.outputMaf, "w")
         except:
             raise RuntimeError("Unable to write to maf: %s" % options.outputMaf)
+        parseBytes(options.mafWorkerMemory)
     if options.configFile is not None:
         try:
             ConfigWrapper(ET.parse(options.configFile).getroot())
         except:
             raise RuntimeError("Unable to read config: %s" % options.configFile)
-    if options.database == 'kyoto_tycoon':
+    if options.ktMemoryCeiling is not None:
+        parseBytes(options.ktMemoryCeiling)
+    if options.diskQuota is not None:
+        parseBytes(options.diskQuota)
+    if options.deadlockSensitivity <= 0:
+        raise RuntimeError("Invalid --deadlockSensitivity: %g.  Must be "
+                           "positive" % options.deadlockSensitivity)
+    if options.database == 'kyoto_tycoon' and options.ktType is not None:
         if options.ktType.lower() != 'memory' and\
            options.ktType.lower() != 'snapshot' and\
            options.ktType.lower() != 'disk':
@@ -215,12 +307,21 @@ def parseOptionsFile(path):
         line = l.rstrip()
         if line:
             args += shlex.split(line)
+    optFile.close()
+    return args
+
+# Set (by progressiveCactusService.sh) when the environment has already
+# been sourced into our own environment, which the commands we run inherit
+envSourcedMarker = "PROGRESSIVE_CACTUS_ENV_SOURCED"
 
 # This source file should always be in progressiveCactus/src.  So
 # we return the path to progressiveCactus/environment, which needs
-# to be sourced before doing anything. 
+# to be sourced before doing anything.  None is returned if it has
+# been sourced already (see envSourcedMarker).
 def getEnvFilePath():
-    path = os.path.dirname(sys.argv[0])
+    if os.environ.get(envSourcedMarker) == "1":
+        return None
+    path = os.path.dirname(os.path.abspath(__file__))
     envFile = os.path.join(path, '..', 'environment')
     assert os.path.isfile(envFile)
     return envFile
@@ -232,8 +333,8 @@ def abortFunction(jtPath, options):
     def afClosure():
         sys.stderr.write('\nAborting due to deadlock (prevent with'
                          + '--noAutoAbort' +
-                         ' option), and running rm -rf %s\n\n' % jtPath)
-        system('rm -rf %s' % jtPath)
+                         ' option), and removing %s\n\n' % jtPath)
+        removeDir(jtPath)
         sys.exit(-1)
     if options.autoAbortOnDeadlock:
         return afClosure
@@ -243,15 +344,18 @@ def abortFunction(jtPath, options):
 # Run cactus progressive on the project that has been created in workDir.
 # Any jobtree options are passed along.  Should probably look at redirecting
 # stdout/stderr in the future.
-def runCactus(workDir, jtCommands, jtPath, options):
+# If state is given, the cactus_progressive process is kept in
+# state["process"] while it runs.
+def runCactus(workDir, jtCommands, jtPath, options, report=None,
+              checkpoint=None, state=None):
     envFile = getEnvFilePath()
     pjPath = os.path.join(workDir, ProjectWrapper.alignmentDirName,
                           '%s_project.xml' % ProjectWrapper.alignmentDirName)
     logFile = os.path.join(workDir, 'cactus.log')
 
     if options.overwrite:
+        # cactus.log was started afresh by runAlignment()
         overwriteFlag = '--overwrite'
-        system("rm -f %s" % logFile)
     else:
         overwriteFlag = ''
 
@@ -259,19 +363,80 @@ def runCactus(workDir, jtCommands, jtPath, options):
     logHandle.write("\n%s: Beginning Progressive Cactus Alignment\n\n" % str(
         datetime.datetime.now()))
     logHandle.close()
-    cmd = '. %s && cactus_progressive.py %s %s %s >> %s 2>&1' % (envFile,
-                                                                 jtCommands,
-                                                                 pjPath,
-                                                                 overwriteFlag,
-                                                                 logFile)
+    # exec so that the pid is cactus_progressive's, for --diskQuota
+    cmd = envCommand(envFile, 'exec cactus_progressive.py %s %s %s >> %s 2>&1'
+                     % (jtCommands, pjPath, overwriteFlag, logFile))
+    try:
+        progressEstimator = ProgressEstimator(workDir, time.time())
+    except Exception, e:
+        logger.info("Progress will not be estimated: %s" % str(e))
+        progressEstimator = None
+    ktMemoryCeiling = None
+    if options.ktMemoryCeiling is not None:
+        ktMemoryCeiling = parseBytes(options.ktMemoryCeiling)
+    # inotify only sees changes made by this host
     jtMonitor = JobStatusMonitor(jtPath, pjPath, logFile,
                                  deadlockCallbackFn=abortFunction(jtPath,
-                                                                  options))
+                                                                  options),
+                                 useInotify=options.batchSystem ==
+                                 'singleMachine',
+                                 metricsExporter=MetricsExporter(
+                                     workDir, options.metricsPromFile),
+                                 progressEstimator=progressEstimator,
+                                 sensitivity=options.deadlockSensitivity,
+                                 ktMemoryCeiling=ktMemoryCeiling)
     if options.database == "kyoto_tycoon":
         jtMonitor.daemon = True
         jtMonitor.start()
+    if checkpoint is None:
+        checkpoint = Checkpoint(workDir)
+    checkpointThread = CheckpointThread(checkpoint)
+    checkpointThread.start()
+    halThread = None
+    halExporter = None
+    if options.incrementalHal:
+        halExporter = IncrementalHalExporter(workDir, envFile, checkpoint)
+        halThread = HalExportThread(halExporter)
+        halThread.start()
+    wdThread = None
+    if options.reclaimDuringRun or options.diskQuota is not None:
+        diskQuota = None
+        if options.diskQuota is not None:
+            diskQuota = parseBytes(options.diskQuota)
+        wdThread = WorkDirThread(WorkDirManager(workDir, jtPath,
+                                                options.keepIntermediates,
+                                                halExporter, checkpoint),
+                                 diskQuota)
+        wdThread.start()
         
-    system(cmd)
+    succeeded = False
+    try:
+        def onStart(proc):
+            if wdThread is not None:
+                wdThread.setPid(proc.pid)
+            if state is not None:
+                state["process"] = proc
+        reportSystem(report, "cactus_progressive", cmd, onStart)
+        succeeded = True
+    finally:
+        jtMonitor.stop()
+        # record what finished since the last poll, so a resume doesn't
+        # align it again.  Once cactus_progressive has succeeded nothing
+        # is still being written, so there's no need to wait for outputs
+        # to settle.
+        try:
+            if succeeded:
+                checkpoint.update(settleTime=0)
+            else:
+                checkpoint.update()
+        except Exception, e:
+            sys.stderr.write("%s: Checkpoint update failed: %s\n" % (
+                str(datetime.datetime.now()), str(e)))
+        checkpointThread.stop()
+        if wdThread is not None:
+            wdThread.stop()
+        if halThread is not None:
+            halThread.stop()
     logHandle = open(logFile, "a")
     logHandle.write("\n%s: Finished Progressive Cactus Alignment\n" % str(
         datetime.datetime.now()))
@@ -280,20 +445,36 @@ def runCactus(workDir, jtCommands, jtPath, options):
 def checkCactus(workDir, options):
     pass
 
+# Check the events a previous run finished against the checkpoint before
+# cactus is restarted on the working directory, so that suspect ones (and
+# everything aligned from them) are re-aligned and the rest are skipped.
+def resumeFromCheckpoint(workDir, checkpoint, options):
+    if options.overwrite:
+        checkpoint.clear()
+        return
+    invalid = checkpoint.validate()
+    complete = checkpoint.completeEvents()
+    if len(complete) == 0 and len(invalid) == 0:
+        return
+    msg = "Resuming alignment: %d of %d ancestral events already aligned " \
+          "and verified" % (len(complete), len(checkpoint.events))
+    if len(invalid) > 0:
+        msg += "\nOutputs of %s could not be verified against the " \
+               "checkpoint and will be re-aligned" % ", ".join(invalid)
+    frontier = checkpoint.frontier()
+    if len(frontier) > 0:
+        msg += "\nAligning next: %s" % ", ".join(frontier)
+    print msg
+    logHandle = open(os.path.join(workDir, 'cactus.log'), "a")
+    logHandle.write("\n%s: %s\n" % (str(datetime.datetime.now()), msg))
+    logHandle.close()
+
 # Call cactus2hal to extract a single hal file out of the progressive
-# alignmenet in the working directory.  If the maf option was set, we
-# just move out the root maf.  
-def extractOutput(workDir, outputHalFile, options):
-    if options.outputMaf is not None:
-        mcProj = MultiCactusProject()
-        mcProj.readXML(
-            os.path.join(workDir, ProjectWrapper.alignmentDirName,
-                         ProjectWrapper.alignmentDirName + "_project.xml"))
-        rootName = mcProj.mcTree.getRootName()
-        rootPath = os.path.join(workDir, ProjectWrapper.alignmentDirName,
-        rootName, rootName + '.maf')
-        cmd = 'mv %s %s' % (rootPath, options.outputMaf)
-        system(cmd)
+# alignmenet in the working directory (or, with --incrementalHal, put it
+# together from the events exported while aligning).  If the maf option
+# was set, the maf is then exported from the hal file.
+def extractOutput(workDir, outputHalFile, options, report=None,
+                  checkpoint=None):
     envFile = getEnvFilePath()
     logFile = os.path.join(workDir, 'cactus.log')
     pjPath = os.path.join(workDir, ProjectWrapper.alignmentDirName,
@@ -302,18 +483,94 @@ def extractOutput(workDir, outputHalFile, options):
     logHandle.write("\n\n%s: Beginning HAL Export\n\n" % str(
         datetime.datetime.now()))
     logHandle.close()
-    cmd = '. %s && cactus2hal.py %s %s >> %s 2>&1' % (envFile, pjPath,
-                                                      outputHalFile, logFile)
-    system(cmd)
+    if options.incrementalHal:
+        IncrementalHalExporter(workDir, envFile,
+                               checkpoint).assemble(outputHalFile)
+    else:
+        cmd = envCommand(envFile, 'cactus2hal.py %s %s >> %s 2>&1' % (
+            pjPath, outputHalFile, logFile))
+        reportSystem(report, "cactus2hal", cmd)
     logHandle = open(logFile, "a")
     logHandle.write("\n%s: Finished HAL Export \n" % str(
         datetime.datetime.now()))
     logHandle.close()
+    if options.outputMaf is not None:
+        logHandle = open(logFile, "a")
+        logHandle.write("\n%s: Beginning MAF Export\n" % str(
+            datetime.datetime.now()))
+        logHandle.close()
+        mafExporter = MafExporter(outputHalFile, options.mafReference,
+                                  workerMemory=parseBytes(
+                                      options.mafWorkerMemory),
+                                  envFile=envFile, logPath=logFile,
+                                  tempDir=workDir)
+        mafExporter.export(options.outputMaf)
+        logHandle = open(logFile, "a")
+        logHandle.write("\n%s: Finished MAF Export\n" % str(
+            datetime.datetime.now()))
+        logHandle.close()
+
+# Align the genomes of the seqFile at seqFilePath into outputHalFile using
+# workDir, raising a RuntimeError if anything goes wrong.  state (if given)
+# is a dictionary that's kept up to date with the stage reached and the
+# RunReport, for error messages.  slot (if given) is acquired (with the
+# options, which it may change) before the setup and alignment stages and
+# released before the export, so a batch of alignments can share the
+# threads and ktserver ports of one machine (see progressiveCactusBatch).
+def runAlignment(seqFilePath, workDir, outputHalFile, options, parser,
+                 state=None, slot=None):
+    if state is None:
+        state = dict()
+    state["stage"] = 0
+    seqFile = SeqFile(seqFilePath)
+    validateInput(workDir, outputHalFile, options)
+    # with a slot, other alignments are running in this process too
+    report = RunReport(outputHalFile + ".report.json", workDir,
+                       concurrent=slot is not None)
+    state["report"] = report
+    jtPath = os.path.join(workDir, "jobTree")
+    if options.overwrite:
+        # before the ProjectWrapper logs how it set up the project
+        system("rm -f %s" % os.path.join(workDir, 'cactus.log'))
+    if slot is not None:
+        slot.acquire(options)
+    try:
+        report.beginStage("setup")
+        seqFile.sanityCheckSequences(os.path.join(workDir,
+                                                  "sequenceScan.json"),
+                                     preprocess=options.preprocess)
+        state["stage"] = 1
+        print "\nBeginning Alignment"
+        # the old jobTree is moved aside and deleted in the background
+        removeDir(jtPath)
+        projWrapper = ProjectWrapper(options, seqFile, workDir)
+        projWrapper.writeXml()
+        checkpoint = Checkpoint(workDir)
+        resumeFromCheckpoint(workDir, checkpoint, options)
+        jtCommands = getJobTreeCommands(jtPath, parser, options)
+        report.beginStage("alignment")
+        runCactus(workDir, jtCommands, jtPath, options, report, checkpoint,
+                  state)
+    finally:
+        if slot is not None:
+            slot.release()
+
+    state["stage"] = 2
+    report.beginStage("export")
+    cmd = 'jobTreeStatus --failIfNotComplete --jobTree %s > /dev/null 2>&1 ' %\
+          jtPath
+    report.system("jobTreeStatus", cmd)
+    print "Beginning HAL Export"
+    extractOutput(workDir, outputHalFile, options, report, checkpoint)
+    WorkDirManager(workDir, jtPath, options.keepIntermediates,
+                   checkpoint=checkpoint).cleanup()
+    report.endStage()
+    report.write()
 
 def main():
     # init as dummy function
     cleanKtFn = lambda x,y:x
-    stage = -1
+    state = { "stage" : -1 }
     workDir = None
     try:
         parser = initParser()
@@ -325,37 +582,28 @@ def main():
         if len(args) == 0:
             parser.print_help()
             return 1
-        if len(args) != 3:
+        if len(args) != 3 and not options.plan:
             raise RuntimeError("Error parsing command line. Exactly 3 arguments are required but %d arguments were detected: %s" % (len(args), str(args)))
         
         if options.optionsFile != None:
             fileArgs = parseOptionsFile(options.optionsFile)
             options, args = parser.parse_args(fileArgs + sys.argv[1:])
-            if len(args) != 3:
+            if len(args) != 3 and not options.plan:
                 raise RuntimeError("Error parsing options file.  Make sure all "
                                    "options have -- prefix")
-        stage = 0
         setLoggingFromOptions(options)
-        seqFile = SeqFile(args[0])
+        if options.plan:
+            # the working directory is only read (for a previous
+            # sequence scan), never written
+            planDir = os.getcwd()
+            if len(args) > 1:
+                planDir = args[1]
+            projWrapper = ProjectWrapper(options, SeqFile(args[0]), planDir,
+                                         dryRun=True)
+            print planAlignment(projWrapper)
+            return 0
         workDir = args[1]
-        outputHalFile = args[2]
-        validateInput(workDir, outputHalFile, options)
-
-        jtPath = os.path.join(workDir, "jobTree")
-        stage = 1
-        print "\nBeginning Alignment"
-        system("rm -rf %s" % jtPath) 
-        projWrapper = ProjectWrapper(options, seqFile, workDir)
-        projWrapper.writeXml()
-        jtCommands = getJobTreeCommands(jtPath, parser, options)
-        runCactus(workDir, jtCommands, jtPath, options)
-        cmd = 'jobTreeStatus --failIfNotComplete --jobTree %s > /dev/null 2>&1 ' %\
-              jtPath
-        system(cmd)
-
-        stage = 2
-        print "Beginning HAL Export"
-        extractOutput(workDir, outputHalFile, options)
+        runAlignment(args[0], workDir, args[2], options, parser, state)
         print "Success.\n" "Temporary data was left in: %s\n" \
               % workDir
         
@@ -363,6 +611,9 @@ def main():
     
     except RuntimeError, e:
         sys.stderr.write("Error: %s\n\n" % str(e))
+        if state.get("report") is not None:
+            state["report"].write()
+        stage = state["stage"]
         if stage >= 0 and workDir is not None and os.path.isdir(workDir):
             sys.stderr.write("Temporary data was left in: %s\n" % workDir)
         if stage == 1:
@@ -0,0 +1,241 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import copy
+import json
+import time
+import traceback
+from threading import Semaphore, Lock
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from sonLib.bioio import setLoggingFromOptions
+
+from progressiveCactus import initParser, parseOptionsFile, runAlignment
+
+###############################################################################
+# Share the threads and ktserver ports of one machine between the
+# alignments of a batch.  At most numSlots alignments can be in their
+# setup and alignment stages at once, each with its own range of
+# portsPerSlot ktserver ports starting at basePort (so the ktservers of
+# different alignments never race for the same port).  The export stage
+# doesn't need a slot, so one alignment's HAL export runs while the next
+# alignment uses its threads.
+###############################################################################
+class AlignmentSlots:
+    def __init__(self, numSlots, basePort, portsPerSlot):
+        self.semaphore = Semaphore(numSlots)
+        self.lock = Lock()
+        self.freePorts = [basePort + i * portsPerSlot for i in
+                          xrange(numSlots)]
+
+    def slot(self):
+        return AlignmentSlot(self)
+
+# One alignment's claim on AlignmentSlots, as expected by runAlignment()
+class AlignmentSlot:
+    def __init__(self, slots):
+        self.slots = slots
+        self.port = None
+
+    def acquire(self, options):
+        self.slots.semaphore.acquire()
+        with self.slots.lock:
+            self.port = self.slots.freePorts.pop(0)
+        options.ktPort = self.port
+
+    def release(self):
+        if self.port is None:
+            return
+        with self.slots.lock:
+            self.slots.freePorts.append(self.port)
+        self.port = None
+        self.slots.semaphore.release()
+
+# Read a batch manifest: one alignment per line, given as
+#   <seqFile> <outputHalFile> [<workDir>]
+# with blank lines and lines starting with # ignored.  The working
+# directory defaults to <batchDir>/<name>, where name is the output's file
+# name without its extension.
+def parseManifest(manifestPath, batchDir):
+    jobs = []
+    names = set()
+    outputs = set()
+    for lineNum, line in enumerate(open(manifestPath, "r")):
+        tokens = line.split()
+        if len(tokens) == 0 or tokens[0].startswith("#"):
+            continue
+        if len(tokens) not in [2, 3]:
+            raise RuntimeError("Line %d of %s: expected <seqFile> "
+                               "<outputHalFile> [<workDir>]" % (
+                                   lineNum + 1, manifestPath))
+        outputHalFile = os.path.abspath(tokens[1])
+        if outputHalFile in outputs:
+            raise RuntimeError("Line %d of %s: %s is the output of more "
+                               "than one alignment" % (
+                                   lineNum + 1, manifestPath, tokens[1]))
+        outputs.add(outputHalFile)
+        name = os.path.splitext(os.path.basename(outputHalFile))[0]
+        i = 2
+        while name in names:
+            name = "%s.%d" % (os.path.splitext(os.path.basename(
+                outputHalFile))[0], i)
+            i += 1
+        names.add(name)
+        if len(tokens) == 3:
+            workDir = tokens[2]
+        else:
+            workDir = os.path.join(batchDir, name)
+        jobs.append({ "name" : name,
+                      "seqFile" : os.path.abspath(tokens[0]),
+                      "outputHalFile" : outputHalFile,
+                      "workDir" : os.path.abspath(workDir) })
+    return jobs
+
+# Run one alignment of a batch (in a pool thread) and return its result
+def runJob(args):
+    job, options, parser, slots = args
+    result = dict(job)
+    state = dict()
+    start = time.time()
+    try:
+        runAlignment(job["seqFile"], job["workDir"], job["outputHalFile"],
+                     copy.copy(options), parser, state, slots.slot())
+        result["status"] = "success"
+    except Exception, e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+        if not isinstance(e, RuntimeError):
+            result["error"] += "\n" + traceback.format_exc()
+        if state.get("report") is not None:
+            state["report"].write()
+    result["seconds"] = time.time() - start
+    result["stage"] = ["setup", "alignment", "export"][state.get("stage", 0)]
+    if state.get("report") is not None:
+        result["stageSeconds"] = dict(
+            [(stage["name"], stage["wallTime"]) for stage in
+             state["report"].stages])
+    return result
+
+def formatResults(results):
+    lines = ["%-30s %-8s %10s %10s %10s  %s" % (
+        "alignment", "status", "setup", "alignment", "export", "total")]
+    for result in results:
+        stageSeconds = result.get("stageSeconds", dict())
+        line = "%-30s %-8s" % (result["name"], result["status"])
+        for stage in ["setup", "alignment", "export"]:
+            if stage in stageSeconds:
+                line += " %9ds" % stageSeconds[stage]
+            else:
+                line += " %10s" % "-"
+        line += "  %ds" % result["seconds"]
+        lines.append(line)
+    for result in results:
+        if result["status"] != "success":
+            lines.append("\n%s failed during %s: %s\n  (see %s)" % (
+                result["name"], result["stage"], result["error"],
+                os.path.join(result["workDir"], "cactus.log")))
+    return "\n".join(lines)
+
+def main():
+    parser = initParser()
+    parser.set_usage("usage: progressiveCactusBatch.sh [options] "
+                     "<manifest> <batchDir>\n\n"
+                     "Run many alignments from one driver.  Each line of "
+                     "<manifest> is\n"
+                     "  <seqFile> <outputHalFile> [<workDir>]\n"
+                     "and working directories default to <batchDir>/<name>."
+                     "  The other\noptions are those of "
+                     "runProgressiveCactus.sh, and apply to every "
+                     "alignment\n(--maxThreads is per alignment).")
+    parser.add_option("--concurrent", dest="concurrent", type=int,
+                      default=None, help="Number of alignments to run at "
+                      "once [default: the number of cores divided by "
+                      "--maxThreads]")
+    parser.add_option("--portsPerAlignment", dest="portsPerAlignment",
+                      type=int, default=100, help="Size of the range of "
+                      "ktserver ports (from --ktPort up) given to each "
+                      "running alignment [default: %default]")
+    parser.add_option("--batchReport", dest="batchReport", default=None,
+                      help="Path of the json file with the status and "
+                      "timing of each alignment [default: "
+                      "<batchDir>/batchReport.json]")
+    options, args = parser.parse_args()
+    if options.optionsFile is not None:
+        options, args = parser.parse_args(
+            parseOptionsFile(options.optionsFile) + sys.argv[1:])
+    if len(args) != 2:
+        parser.print_help()
+        return 1
+    try:
+        for option in ["outputMaf", "metricsPromFile", "plan"]:
+            if getattr(options, option):
+                raise RuntimeError("--%s can't be used in batch mode" %
+                                   option)
+        setLoggingFromOptions(options)
+        manifestPath, batchDir = args
+        if not os.path.isdir(batchDir):
+            os.makedirs(batchDir)
+        jobs = parseManifest(manifestPath, batchDir)
+    except RuntimeError, e:
+        sys.stderr.write("Error: %s\n\n" % str(e))
+        return 1
+
+    numSlots = options.concurrent
+    if numSlots is None:
+        numSlots = max(1, cpu_count() / max(1, int(options.maxThreads)))
+    numSlots = max(1, min(numSlots, len(jobs)))
+    slots = AlignmentSlots(numSlots, int(options.ktPort),
+                           options.portsPerAlignment)
+    print "Running %d alignments, %d at a time" % (len(jobs), numSlots)
+    # twice as many threads as slots, so exports overlap alignments
+    pool = ThreadPool(max(1, min(len(jobs), 2 * numSlots)))
+    results = []
+    try:
+        for result in pool.imap_unordered(runJob, [
+            (job, options, parser, slots) for job in jobs]):
+            results.append(result)
+            print "[%d/%d] %s: %s in %ds" % (len(results), len(jobs),
+                                            result["name"], result["status"],
+                                            result["seconds"])
+    finally:
+        pool.close()
+        pool.join()
+
+    order = dict([(job["name"], i) for i, job in enumerate(jobs)])
+    results.sort(key=lambda r: order[r["name"]])
+    print "\n" + formatResults(results)
+    reportPath = options.batchReport
+    if reportPath is None:
+        reportPath = os.path.join(batchDir, "batchReport.json")
+    reportFile = open(reportPath, "w")
+    json.dump(results, reportFile, indent=2, sort_keys=True)
+    reportFile.write("\n")
+    reportFile.close()
+    numFailed = len([r for r in results if r["status"] != "success"])
+    if numFailed > 0:
+        print "\n%d of %d alignments failed" % (numFailed, len(results))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,17 +28,32 @@ import random
 import copy
 from optparse import OptionParser
 from optparse import OptionGroup
+from optparse import Values
 import imp
 import string
 import socket
+import json
 
 from sonLib.bioio import system, absSymPath
+from sonLib.bioio import logger
 
 from seqFile import SeqFile
+from seqManifest import SeqManifest, affectedEvents
+from seqStaging import SequenceStager
+from seqPreprocessor import SequencePreprocessor
+from fastaScanner import FastaScanner, sequenceSize
+from eventCostModel import EventCostModel
+from ktServerSizing import sizeKtServers, parseBytes
+from subtreePlanner import planMaxParallelSubtrees
+from dirRemover import removeDir
 from cactus.shared.experimentWrapper import ExperimentWrapper
 from cactus.shared.experimentWrapper import DbElemWrapper
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.shared.common import cactusRootPath
+from cactus.progressive.multiCactusProject import MultiCactusProject
+from cactus.progressive.multiCactusTree import MultiCactusTree
+from cactus.progressive.cactus_createMultiCactusProject import createMCProject
+from cactus.progressive.cactus_createMultiCactusProject import cleanEventTree
 
 
 # Wrap up the cactus_progressive interface:
@@ -47,14 +62,20 @@ from cactus.shared.common import cactusRootPath
 # - create Config file from options
 # - run cactus_createMultiCactusProject
 # - now ready to launch cactus progressive
+# With dryRun set, nothing is written to the working directory, so the
+# config and experiment can be inspected (ie by --plan) without side effects.
 class ProjectWrapper:
     alignmentDirName = 'progressiveAlignment'
-    def __init__(self, options, seqFile, workingDir):
+    def __init__(self, options, seqFile, workingDir, dryRun=False):
         self.options = options
         self.seqFile = seqFile
         self.workingDir = workingDir
+        self.dryRun = dryRun
         self.configWrapper = None
         self.expWrapper = None
+        self.costModel = None
+        self.manifest = None
+        self.ktType = None
         self.processConfig()
         self.processExperiment()
 
@@ -71,27 +92,89 @@ class ProjectWrapper:
         # here we can go through the options and apply some to the config
         self.configWrapper.setBuildHal(True)
         self.configWrapper.setBuildFasta(True)
-        if self.options.outputMaf is not None:
-            self.configWrapper.setBuildMaf(True)
-            self.configWrapper.setJoinMaf(True)
-        # pre-emptively turn down maxParallelSubtree for singleMachine
-        # mode if not enough threads are provided to support it.  Probably
-        # need to do something for other ?combined? batch systems?
-        if self.options.batchSystem == 'singleMachine' and \
-               self.options.database == 'kyoto_tycoon':
-            if int(self.options.maxThreads) < \
-                   self.configWrapper.getMaxParallelSubtrees() * 3:
-                self.configWrapper.setMaxParallelSubtrees(
-                    max(1, int(self.options.maxThreads) / 3)) 
-
+        # the maf (if any) is exported from the hal file afterwards, so
+        # cactus doesn't need to build one
         # this is a little hack to effectively toggle back to the
         # non-progressive version of cactus (as published in Gen. Res. 2011)
         # from the high-level interface. 
         if self.options.legacy is True:
             self.configWrapper.setSubtreeSize(sys.maxint)
 
+        # pick maxParallelSubtrees from the machine (or cluster) resources
+        # and the shape of the tree.  the config's value (from the default
+        # config or a user-supplied one) is kept as an upper bound.
+        if self.options.database == 'kyoto_tycoon':
+            parallel, reasons = planMaxParallelSubtrees(
+                self.getCostModel(), self.options.batchSystem,
+                getattr(self.options, "maxThreads", None),
+                getattr(self.options, "maxJobs", None))
+            configParallel = self.configWrapper.getMaxParallelSubtrees()
+            if configParallel < parallel:
+                configName = self.options.configFile
+                if configName is None:
+                    configName = "the default config"
+                reasons.append("%s sets %d" % (configName, configParallel))
+                parallel = configParallel
+            self.configWrapper.setMaxParallelSubtrees(parallel)
+            self.log("Using maxParallelSubtrees=%d: %s\n" % (
+                parallel, "; ".join(reasons)))
+
+    # EventCostModel for the progressive decomposition of the input tree,
+    # as cactus_createMultiCactusProject will make it
+    def getCostModel(self):
+        if self.costModel is None:
+            mcTree = MultiCactusTree(copy.deepcopy(self.seqFile.tree),
+                                     self.configWrapper.getSubtreeSize())
+            mcTree.nameUnlabeledInternalNodes(
+                self.configWrapper.getDefaultInternalNodePrefix())
+            mcTree.computeSubtreeRoots()
+            scanner = FastaScanner(os.path.join(self.workingDir,
+                                                "sequenceScan.json"))
+            leafSizes = dict()
+            for name, path in self.seqFile.pathMap.items():
+                if os.path.exists(path):
+                    leafSizes[name] = sequenceSize(path, scanner)
+            self.costModel = EventCostModel(mcTree, leafSizes,
+                                            mcTree.getSubtreeRootNames())
+        return self.costModel
+
+    # give the unlabeled ancestors of the input tree the names they have
+    # in namedTree (a named copy of it, with the same node ids)
+    def nameAncestors(self, namedTree):
+        tree = self.seqFile.tree
+        for node in tree.postOrderTraversal():
+            if not tree.isLeaf(node) and not tree.getName(node):
+                tree.setName(node, namedTree.getName(node))
+
+    # add a message to cactus.log (and the logger)
+    def log(self, msg):
+        logger.info(msg)
+        if not self.dryRun and os.path.isdir(self.workingDir):
+            logFile = open(os.path.join(self.workingDir, 'cactus.log'), "a")
+            logFile.write("\n%s" % msg)
+            logFile.close()
+
     def processExperiment(self):
-        expXml = self.seqFile.toXMLElement()
+        outSeqDir = os.path.join(self.workingDir, "sequenceData")
+        if os.path.exists(outSeqDir) and self.options.overwrite and \
+               not self.dryRun:
+            removeDir(outSeqDir)
+        if not os.path.exists(outSeqDir) and not self.dryRun:
+            system("mkdir %s" % outSeqDir)
+        if not self.dryRun:
+            # before staging overwrites the copies of any that changed
+            self.manifest = self.checkSources()
+            self.stageSequences(outSeqDir)
+            if self.options.preprocess:
+                self.preprocessSequences(outSeqDir)
+
+        # siblings are written longest chain of events first.  cactus
+        # names unlabeled ancestors in the order it finds them, so they're
+        # named first, as they would be in the input order, to keep the
+        # event names the same whatever the order
+        costModel = self.getCostModel()
+        self.nameAncestors(costModel.tree)
+        expXml = self.seqFile.toXMLElement(costModel.subtreePriorities())
         #create the cactus disk
         cdElem = ET.SubElement(expXml, "cactus_disk")
         database = self.options.database
@@ -105,37 +188,117 @@ class ProjectWrapper:
             self.expWrapper.setDbPort(str(self.options.ktPort))
             if self.options.ktHost is not None:
                 self.expWrapper.setDbHost(self.options.ktHost)
-            if self.options.ktType == 'memory':
+            ktType = self.options.ktType
+            ktCreateTuning = self.options.ktCreateTuning
+            if self.options.ktMemoryCeiling is not None:
+                autoType, autoTuning, reasons = sizeKtServers(
+                    self.getCostModel(),
+                    parseBytes(self.options.ktMemoryCeiling))
+                if ktType is None:
+                    ktType = autoType
+                else:
+                    reasons.append("  (--ktType %s overrides the "
+                                   "estimate)" % ktType)
+                if ktCreateTuning is None:
+                    ktCreateTuning = autoTuning
+                else:
+                    reasons.append("  (--ktCreateTuning %s overrides the "
+                                   "estimate)" % ktCreateTuning)
+                self.log("\n".join(reasons) + "\n")
+            if ktType is None:
+                ktType = 'memory'
+            self.ktType = ktType
+            if ktType == 'memory':
                 self.expWrapper.setDbInMemory(True)
                 self.expWrapper.setDbSnapshot(False)
-            elif self.options.ktType == 'snapshot':
+            elif ktType == 'snapshot':
                 self.expWrapper.setDbInMemory(True)
                 self.expWrapper.setDbSnapshot(True)
             else:
-                assert self.options.ktType == 'disk'
+                assert ktType == 'disk'
                 self.expWrapper.setDbInMemory(False)
                 self.expWrapper.setDbSnapshot(False)
             # sonlib doesn't allow for spaces in attributes in the db conf
             # which renders this options useless
             # if self.options.ktOpts is not None:
             #    self.expWrapper.setDbServerOptions(self.options.ktOpts)
-            if self.options.ktCreateTuning is not None:
-                self.expWrapper.setDbCreateTuningOptions(
-                    self.options.ktCreateTuning)
+            if ktCreateTuning is not None:
+                self.expWrapper.setDbCreateTuningOptions(ktCreateTuning)
             if self.options.ktOpenTuning is not None:
                 self.expWrapper.setDbReadTuningOptions(
                     self.options.ktOpenTuning)
         
         #set the sequence output directory
-        outSeqDir = os.path.join(self.workingDir, "sequenceData")
-        if os.path.exists(outSeqDir) and self.options.overwrite:
-            system("rm -rf %s" % outSeqDir)
-        if not os.path.exists(outSeqDir):
-            system("mkdir %s" % outSeqDir)
-        self.expWrapper.setOutputSequenceDir(os.path.join(self.workingDir, 
-                                                          "sequenceData"))
+        self.expWrapper.setOutputSequenceDir(outSeqDir)
+
+    # decompress any compressed input sequences into the sequence
+    # directory, since cactus can only read plain FASTA.  a decompressed
+    # copy has the same contents as its source, so it's given the
+    # source's scan (if there is one) rather than being scanned again.
+    # fingerprint the input sequences (the user's files, not the staged
+    # copies of them) and, if an existing project is going to be reused,
+    # raise a RuntimeError if any of them changed since it was created.
+    # returns the SeqManifest, which is written once the project is set up
+    def checkSources(self):
+        manifest = SeqManifest(self.manifestPath())
+        changed = manifest.update(self.seqFile)
+        projXmlPath = os.path.join(self.workingDir, self.alignmentDirName,
+                                   '%s_project.xml' % self.alignmentDirName)
+        if len(changed) > 0 and not self.options.overwrite and \
+               os.path.isfile(projXmlPath):
+            mcProj = MultiCactusProject()
+            mcProj.readXML(projXmlPath)
+            raise RuntimeError("Input sequence(s) %s changed since the "
+                               "existing project %s was created, so "
+                               "ancestral event(s) %s would have to be "
+                               "re-aligned.  Please erase the working "
+                               "directory or rerun with the --overwrite "
+                               "option to start from scratch." % (
+                                   ", ".join(changed),
+                                   os.path.dirname(projXmlPath),
+                                   ", ".join(affectedEvents(mcProj,
+                                                            changed))))
+        return manifest
+
+    def stageSequences(self, outSeqDir):
+        stager = SequenceStager(os.path.join(outSeqDir, "decompressed"))
+        sourcePathMap = self.seqFile.pathMap
+        self.seqFile.pathMap = stager.stage(sourcePathMap, self.leafNames())
+        scanner = FastaScanner(os.path.join(self.workingDir,
+                                            "sequenceScan.json"))
+        numCopied = 0
+        for name in self.leafNames():
+            stagedPath = self.seqFile.pathMap[name]
+            if stagedPath == sourcePathMap[name] or \
+                   scanner.cachedStats(stagedPath) is not None:
+                continue
+            stats = scanner.cachedStats(sourcePathMap[name])
+            if stats is not None:
+                scanner.setStats(stagedPath, stats)
+                numCopied += 1
+        if numCopied > 0:
+            scanner.writeCache()
+
+    # normalize the headers of the input sequences into the sequence
+    # directory (see SequencePreprocessor)
+    def preprocessSequences(self, outSeqDir):
+        scanner = FastaScanner(os.path.join(self.workingDir,
+                                            "sequenceScan.json"))
+        preprocessor = SequencePreprocessor(
+            os.path.join(outSeqDir, "preprocessed"), scanner)
+        self.seqFile.pathMap = preprocessor.preprocess(
+            self.seqFile.pathMap, self.leafNames())
+        for msg in preprocessor.messages:
+            sys.stderr.write(msg + "\n")
+            self.log(msg)
+
+    def leafNames(self):
+        return [self.seqFile.tree.getName(node) for node in
+                self.seqFile.tree.postOrderTraversal()
+                if self.seqFile.tree.isLeaf(node)]
 
     def writeXml(self):
+        assert not self.dryRun
         assert os.path.isdir(self.workingDir)
         configPath = absSymPath(
             os.path.join(self.workingDir, "config.xml"))
@@ -148,25 +311,28 @@ class ProjectWrapper:
         projPath = os.path.join(self.workingDir,
                                 ProjectWrapper.alignmentDirName)
         if os.path.exists(projPath) and self.options.overwrite:
-            system("rm -rf %s" % projPath)
+            removeDir(projPath)
         if self.options.outputMaf is True:
             fixNames=1
         else:
             fixNames=0
         if os.path.exists(projPath):
-           if not self.isSameAsExisting(expPath, projPath, fixNames):
+           diffs = self.diffWithExisting(projPath, fixNames)
+           if len(diffs) > 0:
                raise RuntimeError("Existing project %s not " % projPath+
-                                  "compatible with current input.  Please "
-                                  "erase the working directory or rerun "
-                                  "with the --overwrite option to start "
-                                  "from scratch.")
-           else:
-               logPath = os.path.join(self.workingDir, 'cactus.log')
-               logFile = open(logPath, "a")
-               logFile.write("\nContinuing existing alignment.  Use "
-                             "--overwrite or erase the working directory to "
-                             "force restart from scratch.\n")
-               logFile.close()
+                                  "compatible with current input:\n  %s\n" %
+                                  "\n  ".join(diffs) +
+                                  "Please erase the working directory or "
+                                  "rerun with the --overwrite option to "
+                                  "start from scratch.")
+           # the inputs were checked by checkSources() before staging
+           self.manifest.write()
+           logPath = os.path.join(self.workingDir, 'cactus.log')
+           logFile = open(logPath, "a")
+           logFile.write("\nContinuing existing alignment.  Use "
+                         "--overwrite or erase the working directory to "
+                         "force restart from scratch.\n")
+           logFile.close()
         else:
             cmd = "cactus_createMultiCactusProject.py \"%s\" \"%s\" --fixNames=%d" % (
                 expPath, projPath, fixNames)
@@ -178,50 +344,162 @@ class ProjectWrapper:
             if self.options.root is not None:
                 cmd += " --root %s" % self.options.root
             system(cmd)
+            self.manifest.write()
+        self.writeSchedule(os.path.join(projPath, '%s_project.xml' %
+                                        self.alignmentDirName))
 
-    # create a project in a dummy directory.  check if the
-    # project xml is the same as the current project.
-    # we do this to see if we should start fresh or try to
-    # work with the existing project when the overwrite flag is off
-    def isSameAsExisting(self, expPath, projPath, fixNames):
-        if not os.path.exists(projPath):
-            return False
-        oldPath = os.path.dirname(projPath + "/")
-        tempPath = "%s_temp" % oldPath
-        # Fix for relative directories
-        if oldPath[0:2] == './':
-            oldPath = oldPath[2:]
-        if tempPath[0:2] == './':
-            tempPath = tempPath[2:]
-        if os.path.exists(tempPath):
-            system("rm -rf %s" % tempPath)
-        cmd = "cactus_createMultiCactusProject.py %s %s --fixNames=%d" % (
-            expPath, tempPath, fixNames)
-        if len(self.seqFile.outgroups) > 0: 
-            cmd += " --outgroupNames " + ",".join(self.seqFile.outgroups)
-        if self.options.rootOutgroupDists:
-            cmd += " --rootOutgroupDists %s" % self.options.rootOutgroupDists
-            cmd += " --rootOutgroupPaths %s" % self.options.rootOutgroupPaths
-        if self.options.root is not None:
-            cmd += " --root %s" % self.options.root
-        system(cmd)
-        projFilePathNew = os.path.join(tempPath,'%s_temp_project.xml' %
-                                       self.alignmentDirName)
-        projFilePathOld = os.path.join(oldPath, '%s_project.xml' %
-                                       self.alignmentDirName)
-        
-        newFile = [line for line in open(projFilePathNew, "r")]
-        oldFile = [line for line in open(projFilePathOld, "r")]
-        areSame = True
-        if len(newFile) != len(oldFile):
-            areSame = False
-        for newLine, oldLine in zip(newFile, oldFile):
-            if newLine.replace(tempPath, oldPath) != oldLine:
-                areSame = False
-        system("rm -rf %s" % tempPath)
-        return areSame
-
-    
+    # write the estimated cost and scheduling priority of each event of
+    # the project at projXmlPath (so with the names cactus gave them),
+    # along with the critical path, to <workDir>/eventSchedule.json
+    def writeSchedule(self, projXmlPath):
+        mcProj = MultiCactusProject()
+        mcProj.readXML(projXmlPath)
+        costModel = EventCostModel(mcProj.mcTree,
+                                   self.getCostModel().leafSizes,
+                                   mcProj.expMap.keys())
+        criticalPath = costModel.criticalPath()
+        schedule = { "criticalPath" : criticalPath,
+                     "events" : dict() }
+        for event in costModel.events:
+            schedule["events"][event] = {
+                "work" : costModel.eventWork(event),
+                "priority" : costModel.eventPriority(event),
+                "parent" : costModel.eventParent(event) }
+        schedFile = open(os.path.join(self.workingDir, "eventSchedule.json"),
+                         "w")
+        json.dump(schedule, schedFile, indent=1, sort_keys=True)
+        schedFile.close()
+        if len(criticalPath) > 0:
+            self.log("Critical path (%.1f%% of estimated work): %s\n" % (
+                100. * costModel.eventPriority(criticalPath[0]) /
+                max(1., costModel.totalWork()), " -> ".join(criticalPath)))
 
-        
-        
+    # fingerprints of the input sequences the project was created from
+    def manifestPath(self):
+        return os.path.join(self.workingDir, "sequenceManifest.json")
+
+    # build the project that cactus_createMultiCactusProject would create
+    # for the current input in memory, and compare it structurally with
+    # the existing project xml.  we do this to see if we should start
+    # fresh or try to work with the existing project when the overwrite
+    # flag is off.  returns a list of the differences found (so an
+    # empty list means the existing project can be reused)
+    def diffWithExisting(self, projPath, fixNames):
+        projXmlPath = os.path.join(projPath, '%s_project.xml' %
+                                   self.alignmentDirName)
+        if not os.path.isfile(projXmlPath):
+            return ["project file %s not found" % projXmlPath]
+        oldProj = MultiCactusProject()
+        oldProj.readXML(projXmlPath)
+
+        expWrapper = ExperimentWrapper(copy.deepcopy(self.expWrapper.xmlRoot))
+        if fixNames:
+            cleanEventTree(expWrapper)
+        mcOptions = createMCProjectOptions(projPath, fixNames,
+                                           self.seqFile.outgroups,
+                                           self.options)
+        newProj = createMCProject(expWrapper.getTree(), expWrapper,
+                                  self.configWrapper, mcOptions)
+
+        diffs = []
+        oldTree = canonicalNewick(oldProj.mcTree)
+        newTree = canonicalNewick(newProj.mcTree)
+        if oldTree != newTree:
+            diffs.append("tree: existing %s, current %s" % (oldTree, newTree))
+        oldSeqs = set([os.path.realpath(p) for p in oldProj.inputSequences])
+        newSeqs = set([os.path.realpath(p) for p in newProj.inputSequences])
+        if self.options.rootOutgroupPaths is not None:
+            for path in self.options.rootOutgroupPaths.split(","):
+                newSeqs.add(os.path.realpath(path))
+        for path in sorted(newSeqs - oldSeqs):
+            diffs.append("sequence %s: not in existing project" % path)
+        for path in sorted(oldSeqs - newSeqs):
+            diffs.append("sequence %s: not in current input" % path)
+        for event in sorted(set(oldProj.expMap) | set(newProj.expMap)):
+            if event not in newProj.expMap:
+                diffs.append("event %s: not in current input" % event)
+            elif event not in oldProj.expMap:
+                diffs.append("event %s: not in existing project" % event)
+            elif os.path.realpath(oldProj.expMap[event]) != \
+                     os.path.realpath(newProj.expMap[event]):
+                diffs.append("event %s: existing experiment %s, current %s" % (
+                    event, oldProj.expMap[event], newProj.expMap[event]))
+        # the existing project read back from xml has no outgroup map, so
+        # its outgroups come from the experiments it wrote
+        oldOutgroups = experimentOutgroupMap(oldProj)
+        newOutgroups = outgroupMap(newProj)
+        if newOutgroups is None:
+            newOutgroups = dict()
+        for event in sorted(set(oldProj.expMap) & set(newProj.expMap)):
+            old = oldOutgroups.get(event, [])
+            new = newOutgroups.get(event, [])
+            if old != new:
+                diffs.append("outgroups of %s: existing %s, current %s" % (
+                    event, ",".join(old) or "none", ",".join(new) or "none"))
+        return diffs
+
+# the options cactus_createMultiCactusProject.py passes to createMCProject()
+# when it's run with the same arguments as processExperiment() gives it,
+# converted the same way its main() converts them
+def createMCProjectOptions(projPath, fixNames, outgroups, options):
+    mcOptions = Values()
+    mcOptions.path = os.path.abspath(projPath)
+    mcOptions.name = os.path.basename(mcOptions.path)
+    mcOptions.fixNames = fixNames
+    mcOptions.root = options.root
+    mcOptions.outgroupNames = None
+    if len(outgroups) > 0:
+        mcOptions.outgroupNames = set(",".join(outgroups).split(","))
+    mcOptions.rootOutgroupDists = None
+    mcOptions.rootOutgroupPaths = None
+    if options.rootOutgroupDists:
+        mcOptions.rootOutgroupPaths = [os.path.abspath(path) for path in
+                                       options.rootOutgroupPaths.split(",")]
+        mcOptions.rootOutgroupDists = [float(dist) for dist in
+                                       options.rootOutgroupDists.split(",")]
+    return mcOptions
+
+# newick string for a tree with the children of every node sorted by
+# name, so that trees can be compared regardless of child order
+def canonicalNewick(tree, node=None):
+    if node is None:
+        node = tree.getRootId()
+    name = tree.getName(node)
+    if name is None:
+        name = ""
+    children = [canonicalNewick(tree, child) for child in
+                tree.getChildren(node)]
+    if len(children) > 0:
+        name = "(%s)%s" % (",".join(sorted(children)), name)
+    if tree.hasParent(node):
+        weight = tree.getWeight(tree.getParent(node), node)
+        if weight is not None:
+            name += ":%g" % weight
+    else:
+        name += ";"
+    return name
+
+# event -> sorted outgroup names, from the experiment xml of each event
+# of a project (ie one read with readXML(), which doesn't load the
+# outgroups).  Events whose experiment can't be read are left out.
+def experimentOutgroupMap(mcProj):
+    ogMap = dict()
+    for event, expPath in mcProj.expMap.items():
+        try:
+            exp = ExperimentWrapper(ET.parse(expPath).getroot())
+        except (IOError, ET.ParseError):
+            continue
+        ogMap[event] = sorted(exp.getOutgroupEvents())
+    return ogMap
+
+# event -> sorted outgroup names, or None if the project doesn't have
+# its outgroups computed (ie it was created in memory with
+# createMCProject(), not read from xml)
+def outgroupMap(mcProj):
+    outgroup = getattr(mcProj, "outgroup", None)
+    if outgroup is None or not hasattr(outgroup, "ogMap"):
+        return None
+    ogMap = dict()
+    for event, outgroups in outgroup.ogMap.items():
+        ogMap[event] = sorted([og[0] for og in outgroups])
+    return ogMap
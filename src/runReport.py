@@ -0,0 +1,312 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import errno
+import time
+import json
+import resource
+import subprocess
+import datetime
+from threading import Lock
+
+from sonLib.bioio import system
+
+# Size in bytes of everything under path (as reported by du), or None
+# if it can't be determined.  du is run without a shell, so the path can
+# contain anything.
+def diskUsage(path):
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        devNull = open(os.devnull, "w")
+        proc = subprocess.Popen(["du", "-sk", path], stdout=subprocess.PIPE,
+                                stderr=devNull)
+        output = proc.communicate()[0]
+        devNull.close()
+        return int(output.split()[0]) * 1024
+    except:
+        return None
+
+###############################################################################
+# Cached measurements of the space used by a working directory and the
+# directories near its top (down to maxDepth levels), taken with a single
+# du walk.  usage() returns the bytes under a path as of a walk that
+# started no more than maxAge seconds before the call, so callers that
+# poll on their own schedules share walks rather than each running their
+# own.  Concurrent callers wait for the walk in progress.  Paths deeper
+# than maxDepth, or outside the working directory, are measured on their
+# own.
+###############################################################################
+class DiskUsageSampler:
+    def __init__(self, workDir, maxDepth=2):
+        self.workDir = os.path.abspath(workDir)
+        self.maxDepth = maxDepth
+        self.lock = Lock()
+        # start time of the last walk, and bytes under each path it saw
+        self.sampleTime = None
+        self.sizes = dict()
+
+    def sample(self, maxAge=0):
+        callTime = time.time()
+        with self.lock:
+            if self.sampleTime is None or \
+                   self.sampleTime < callTime - maxAge:
+                self.sampleTime = time.time()
+                self.sizes = duTree(self.workDir, self.maxDepth)
+            return self.sizes
+
+    def usage(self, path=None, maxAge=0):
+        return self.usages([path], maxAge)[0]
+
+    # Bytes under each of a list of paths (None for the working
+    # directory), from at most one walk
+    def usages(self, paths, maxAge=0):
+        sizes = None
+        results = []
+        for path in paths:
+            if path is None:
+                path = self.workDir
+            path = os.path.abspath(path)
+            if path == self.workDir:
+                depth = 0
+            elif path.startswith(self.workDir + os.sep):
+                depth = len(path[len(self.workDir) + 1:].split(os.sep))
+            else:
+                depth = None
+            if depth is None or depth > self.maxDepth:
+                results.append(diskUsage(path))
+                continue
+            if sizes is None:
+                sizes = self.sample(maxAge)
+            results.append(sizes.get(path))
+        return results
+
+# Bytes under path and each directory down to maxDepth levels below it,
+# from one du walk.  Files that vanish during the walk (which du
+# complains about) are ignored.
+def duTree(path, maxDepth):
+    sizes = dict()
+    if not os.path.exists(path):
+        return sizes
+    try:
+        devNull = open(os.devnull, "w")
+        proc = subprocess.Popen(["du", "-k", "--max-depth=%d" % maxDepth,
+                                 path], stdout=subprocess.PIPE,
+                                stderr=devNull)
+        output = proc.communicate()[0]
+        devNull.close()
+    except OSError:
+        return sizes
+    for line in output.split("\n"):
+        tokens = line.split("\t", 1)
+        if len(tokens) == 2 and tokens[0].isdigit():
+            sizes[os.path.abspath(tokens[1])] = int(tokens[0]) * 1024
+    return sizes
+
+# The DiskUsageSampler shared by everything that measures workDir
+samplers = dict()
+samplersLock = Lock()
+def usageSampler(workDir):
+    workDir = os.path.abspath(workDir)
+    with samplersLock:
+        if workDir not in samplers:
+            samplers[workDir] = DiskUsageSampler(workDir)
+        return samplers[workDir]
+
+# Resource counters at a point in time.  Child times only include
+# children that have been waited on, which is the case for everything
+# run through runCommand().  ru_maxrss is in kilobytes on Linux.
+def resourceSnapshot():
+    times = os.times()
+    return { "wall" : time.time(),
+             "user" : times[0],
+             "sys" : times[1],
+             "childUser" : times[2],
+             "childSys" : times[3],
+             "peakRssKb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             "peakChildRssKb" : resource.getrusage(
+                 resource.RUSAGE_CHILDREN).ru_maxrss }
+
+# The usage between two snapshots.  Peak RSS can't be computed for an
+# interval, so it's the peak of the process (or its children) so far.
+def resourceDelta(start, end):
+    return { "wallTime" : end["wall"] - start["wall"],
+             "cpuTime" : (end["user"] + end["sys"]) -
+                         (start["user"] + start["sys"]),
+             "childCpuTime" : (end["childUser"] + end["childSys"]) -
+                              (start["childUser"] + start["childSys"]),
+             "peakRssKb" : end["peakRssKb"],
+             "peakChildRssKb" : end["peakChildRssKb"] }
+
+###############################################################################
+# Record how much time and how many resources each stage of a run (and
+# each external command within a stage) used, and write it all to a json
+# report.  Bytes written to the working directory are measured per stage
+# (as the change in du), not per command, since du can be slow on a big
+# working directory.  The working directory is measured once at each
+# stage boundary (the end of one stage is the start of the next) with the
+# shared DiskUsageSampler.
+#
+# The usage of each command comes from waiting on it (wait4), so it's its
+# own.  The process-wide counters of a stage are only meaningful if this
+# is the only alignment in the process.  If it's concurrent with others
+# (progressiveCactusBatch, alignmentService), the stage's cpuTime and
+# peakRssKb are left out and its child usage is the sum (and peak) of its
+# commands' instead.
+###############################################################################
+class RunReport:
+    def __init__(self, reportPath, workDir=None, concurrent=False):
+        self.reportPath = reportPath
+        self.workDir = workDir
+        self.concurrent = concurrent
+        self.startTime = datetime.datetime.now()
+        self.stages = []
+        self.curStage = None
+        self.curStart = None
+        self.curBytes = None
+
+    # Bytes used by the working directory now
+    def measureWorkDir(self):
+        if self.workDir is None:
+            return None
+        return usageSampler(self.workDir).usage()
+
+    def beginStage(self, name):
+        if self.curStage is not None:
+            # the previous stage's end measurement is this one's start
+            self.endStage()
+        else:
+            self.curBytes = self.measureWorkDir()
+        self.curStage = { "name" : name, "commands" : [] }
+        self.curStart = resourceSnapshot()
+
+    def endStage(self, success=True):
+        if self.curStage is None:
+            return
+        usage = resourceDelta(self.curStart, resourceSnapshot())
+        if self.concurrent:
+            commands = self.curStage["commands"]
+            usage["cpuTime"] = None
+            usage["peakRssKb"] = None
+            usage["childCpuTime"] = sum([c["childCpuTime"] or 0 for c in
+                                         commands])
+            usage["peakChildRssKb"] = max([c["peakChildRssKb"] or 0 for c
+                                           in commands] + [0])
+        self.curStage.update(usage)
+        endBytes = self.measureWorkDir()
+        self.curStage["workDirBytesWritten"] = None
+        if endBytes is not None and self.curBytes is not None:
+            self.curStage["workDirBytesWritten"] = endBytes - self.curBytes
+        self.curStage["success"] = success
+        self.stages.append(self.curStage)
+        self.curStage = None
+        self.curBytes = endBytes
+
+    # Run a command with runCommand(), recording its usage in the current
+    # stage.  Exceptions are passed on after being recorded.
+    def system(self, name, cmd, onStart=None):
+        start = resourceSnapshot()
+        success = False
+        childUsage = dict()
+        try:
+            runCommand(cmd, onStart, childUsage)
+            success = True
+        finally:
+            usage = resourceDelta(start, resourceSnapshot())
+            usage["childCpuTime"] = childUsage.get("cpuTime")
+            usage["peakChildRssKb"] = childUsage.get("peakRssKb")
+            if self.concurrent:
+                usage["cpuTime"] = None
+                usage["peakRssKb"] = None
+            usage["name"] = name
+            usage["command"] = cmd
+            usage["success"] = success
+            if self.curStage is not None:
+                self.curStage["commands"].append(usage)
+
+    def write(self):
+        if self.curStage is not None:
+            self.endStage(False)
+        report = { "start" : str(self.startTime),
+                   "end" : str(datetime.datetime.now()),
+                   "workDir" : self.workDir,
+                   "stages" : self.stages }
+        reportFile = open(self.reportPath, "w")
+        json.dump(report, reportFile, indent=2, sort_keys=True)
+        reportFile.write("\n")
+        reportFile.close()
+
+# Run a shell command like system(), but call onStart (if given) with the
+# Popen object once it's started (ie so its pid can be signalled).  The
+# command is waited on with wait4, which gives the usage of it and
+# everything it waited on, and not of anything else this process runs.
+# The cpu time (seconds) and peak RSS (kilobytes) are put in usage (if
+# given), even if the command fails.
+def runCommand(cmd, onStart=None, usage=None):
+    proc = subprocess.Popen(cmd, shell=True)
+    try:
+        if onStart is not None:
+            onStart(proc)
+    finally:
+        ret, rusage = waitWithUsage(proc)
+    if usage is not None and rusage is not None:
+        usage["cpuTime"] = rusage.ru_utime + rusage.ru_stime
+        usage["peakRssKb"] = rusage.ru_maxrss
+    if ret != 0:
+        raise RuntimeError("Command: %s exited with non-zero status %i" % (
+            cmd, ret))
+
+# Wait for a Popen process with wait4, setting its returncode as wait()
+# would, and return (returncode, rusage).  The process must only be
+# waited on here: other threads should check returncode rather than
+# poll().  If it was reaped elsewhere anyway, the rusage is None.
+def waitWithUsage(proc):
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                return (proc.wait(), None)
+            raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return (proc.returncode, rusage)
+
+# A shell command that sources envFile (unless it's None) then runs cmd
+def envCommand(envFile, cmd):
+    if envFile is None:
+        return cmd
+    return '. %s && %s' % (envFile, cmd)
+
+# Run cmd through the report if there is one
+def reportSystem(report, name, cmd, onStart=None):
+    if report is not None:
+        report.system(name, cmd, onStart)
+    elif onStart is not None:
+        runCommand(cmd, onStart)
+    else:
+        system(cmd)
@@ -31,12 +31,15 @@ from optparse import OptionGroup
 import imp
 import string
 import re
+from multiprocessing.pool import ThreadPool
 
 from sonLib.bioio import absSymPath
 from sonLib.nxtree import NXTree
 from sonLib.nxnewick import NXNewick
 from sonLib.bioio import popenCatch
 
+from fastaScanner import FastaScanner
+
 # parse the input seqfile for progressive cactus.  this file is in the
 # format of:
 #   newick tree
@@ -118,42 +121,60 @@ class SeqFile:
             self.tree.setName(label, name)
             self.tree.setWeight(0, label, SeqFile.branchLen)
         
-    def validate(self):
-        if len([i for i in self.tree.postOrderTraversal()]) <= 2:
+    # Check that the tree has at least two leaves and that every leaf
+    # has a sequence path that exists.  The paths are checked
+    # concurrently, since each check can be a round trip to a file server.
+    def validate(self, numThreads=16):
+        leafNames = []
+        numNodes = 0
+        for node in self.tree.postOrderTraversal():
+            numNodes += 1
+            if self.tree.isLeaf(node):
+                leafNames.append(self.tree.getName(node))
+        if numNodes <= 2:
             raise RuntimeError("At least two valid leaf genomes required in"
                                " input tree")
+        for name in leafNames:
+            if name not in self.pathMap:
+                raise RuntimeError("No sequence specified for %s" % name)
+        paths = [self.pathMap[name] for name in leafNames]
+        uniquePaths = list(set(paths))
+        pool = ThreadPool(max(1, min(numThreads, len(uniquePaths))))
+        try:
+            exists = dict(zip(uniquePaths, pool.map(os.path.exists,
+                                                    uniquePaths)))
+        finally:
+            pool.close()
+            pool.join()
+        for path in paths:
+            if not exists[path]:
+                raise RuntimeError("Sequence path not found: %s" % path)
+
+    # Scan all the leaf sequences (in parallel, and using the cache in
+    # cachePath if given) and warn about any that look suspicious.  If
+    # preprocess is set, the headers will be fixed by --preprocess, so
+    # bad headers aren't warned about.
+    def sanityCheckSequences(self, cachePath=None, numProcs=None,
+                             preprocess=False):
+        paths = []
         for node in self.tree.postOrderTraversal():
             if self.tree.isLeaf(node):
-                name = self.tree.getName(node)
-                if name not in self.pathMap:
-                    raise RuntimeError("No sequence specified for %s" % name)
-                else:
-                    path = self.pathMap[name]
-                    if not os.path.exists(path):
-                        raise RuntimeError("Sequence path not found: %s" % path)
-                    self.sanityCheckSequence(path)
+                paths.append(self.pathMap[self.tree.getName(node)])
+        scanner = FastaScanner(cachePath, numProcs)
+        statsMap = scanner.scan(paths)
+        for path in paths:
+            self.sanityCheckSequence(path, statsMap[path], preprocess)
 
-    def sanityCheckSequence(self, path):
+    def sanityCheckSequence(self, path, stats, preprocess=False):
         """Warns the user about common problems with the input sequences."""
-        # Relies on cactus_analyseAssembly output staying in the
-        # format it's currently in.
-        return
-        cmdline = "cactus_analyseAssembly"
-        if os.path.isdir(path):
-            cmdline = "cat %s/* | %s -" % (path, cmdline)
-        else:
-            cmdline += " %s" % path
-        output = popenCatch(cmdline)
-        try:
-            repeatMaskedFrac = float(re.search(r'Proportion-repeat-masked: ([0-9.]*)', output).group(1))
-            nFrac = float(re.search(r'ProportionNs: ([0-9.]*)', output).group(1))
-        except ValueError:
-            # This can happen if the genome has 0 length, making the fractions NaN.
-            # We warn the user but return afterwards, as the rest of the checks are
-            # dependent on the fraction values.
+        if stats["length"] == 0:
+            # We warn the user but return afterwards, as the rest of the
+            # checks are dependent on the fraction values.
             sys.stderr.write("WARNING: sequence path %s has 0 length. Consider "
                              "removing it from your input file.\n\n" % path)
             return
+        repeatMaskedFrac = float(stats["masked"]) / stats["length"]
+        nFrac = float(stats["ns"]) / stats["length"]
         # These thresholds are pretty arbitrary, but should be good for
         # badly- to well-assembled vertebrate genomes.
         if repeatMaskedFrac > 0.70:
@@ -165,6 +186,14 @@ class SeqFile:
                              "accidentally provided an all-lowercase genome, "
                              "in which case nothing will be aligned to "
                              "it!\n\n" % (path, repeatMaskedFrac))
+        badHeaders = stats.get("badHeaders", 0) + \
+                     stats.get("duplicateHeaders", 0)
+        if badHeaders > 0 and not preprocess:
+            sys.stderr.write("WARNING: sequence path %s has %d FASTA headers "
+                             "whose first word is not a unique "
+                             "alphanumeric name, which cactus will reject. "
+                             "Rerun with --preprocess to fix them.\n\n" % (
+                                 path, badHeaders))
         if nFrac > 0.30:
             sys.stderr.write("WARNING: sequence path %s has an extremely high "
                              "proportion of 'N' bases: %f. The process will "
@@ -175,16 +204,27 @@ class SeqFile:
                              "poorly assembled regions, feel free to "
                              "ignore this message.\n\n" % (path, nFrac))
 
-    # remove leaves that do not have sequence data associated with them
+    # remove leaves that do not have sequence data associated with them,
+    # along with any internal nodes left without leaves, and splice out
+    # internal nodes left with a single child (adding up the branch
+    # lengths), as repeated calls to removeLeaf would.  Then fill in
+    # missing branch lengths.  The pruning is done in bulk, so this is
+    # linear in the size of the tree no matter how many leaves go.
     def cleanTree(self):
+        postOrder = list(self.tree.postOrderTraversal())
+        # node -> whether any leaf below it (or itself) has a sequence
+        keep = dict()
         numLeaves = 0
         removeList = []
-        for node in self.tree.postOrderTraversal():
+        for node in postOrder:
             if self.tree.isLeaf(node):
-                name = self.tree.getName(node)
-                if name not in self.pathMap:
+                keep[node] = self.tree.getName(node) in self.pathMap
+                if not keep[node]:
                     removeList.append(node)
                 numLeaves += 1
+            else:
+                keep[node] = any([keep[c] for c in
+                                  self.tree.getChildren(node)])
         if numLeaves < 2:
             raise RuntimeError("At least two valid leaf genomes required in"
                                " input tree")
@@ -193,33 +233,101 @@ class SeqFile:
         for leaf in removeList:
              sys.stderr.write("No sequence path found for %s: skipping\n" % (
                  self.tree.getName(leaf)))
-             self.tree.removeLeaf(leaf)
+        self.tree.nxDg.remove_nodes_from([node for node in postOrder
+                                          if not keep[node]])
 
-        for node in self.tree.postOrderTraversal():
-            if self.tree.hasParent(node):
+        # parents come before children in reverse post order, so the
+        # branch above a node is final by the time we get to it
+        for node in reversed(postOrder):
+            if not keep[node]:
+                continue
+            children = self.tree.getChildren(node)
+            if len(children) == 1:
+                child = children[0]
+                if self.tree.hasParent(node):
+                    parent = self.tree.getParent(node)
+                    weight = self.tree.getWeight(parent, node)
+                    childWeight = self.tree.getWeight(node, child)
+                    self.tree.nxDg.remove_node(node)
+                    self.tree.nxDg.add_edge(parent, child)
+                    if weight is not None and childWeight is not None:
+                        self.tree.setWeight(parent, child,
+                                            weight + childWeight)
+                else:
+                    self.tree.nxDg.remove_node(node)
+                    self.tree.rootId = child
+            elif self.tree.hasParent(node):
                 parent = self.tree.getParent(node)
                 if self.tree.getWeight(parent, node) is None:
                     sys.stderr.write(
                         "No branch length for %s: setting to %d\n" % (
                             self.tree.getName(node), SeqFile.branchLen))
                     self.tree.setWeight(parent, node, SeqFile.branchLen)
-                    
 
     # create the cactus_workflow_experiment xml element which serves as
     # the root node of the experiment template file needed by
     # cactus_createMultiCactusProject.  Note the element is incomplete
-    # until the cactus_disk child element has been added
-    def toXMLElement(self):
+    # until the cactus_disk child element has been added.  If
+    # nodePriorities (node id -> priority) is given, the children of
+    # each node are written in decreasing order of priority, since
+    # cactus considers sibling subtrees in the order they appear.  Since
+    # cactus also names unlabeled ancestors in the order it finds them,
+    # they should be named before the tree is reordered (see
+    # ProjectWrapper.nameAncestors).
+    def toXMLElement(self, nodePriorities=None):
         assert self.tree is not None
         elem = ET.Element("cactus_workflow_experiment")
-        seqString = ""
-        for node in self.tree.postOrderTraversal():
+        seqPaths = []
+        for node in self.orderedPostOrder(nodePriorities):
             if self.tree.isLeaf(node):
                 name = self.tree.getName(node)
-                path = self.pathMap[name]
-                path.replace(" ", "\ ")
-                seqString += absSymPath(path) + " "
-        elem.attrib["sequences"] = seqString
-        elem.attrib["species_tree"] = NXNewick().writeString(self.tree)
+                seqPaths.append(absSymPath(self.pathMap[name]) + " ")
+        elem.attrib["sequences"] = "".join(seqPaths)
+        if nodePriorities is None:
+            elem.attrib["species_tree"] = NXNewick().writeString(self.tree)
+        else:
+            elem.attrib["species_tree"] = self.orderedNewick(
+                nodePriorities, self.tree.getRootId()) + ";"
         elem.attrib["config"] = "defaultProgressive"
         return elem
+
+    def orderedChildren(self, node, nodePriorities):
+        children = self.tree.getChildren(node)
+        if nodePriorities is not None:
+            children = sorted(children, key=lambda c: -nodePriorities[c])
+        return children
+
+    # post order traversal visiting children in order of priority.  this
+    # is done with a stack rather than recursion so deep trees are fine
+    def orderedPostOrder(self, nodePriorities, node=None):
+        if node is None:
+            node = self.tree.getRootId()
+        nodes = []
+        stack = [(node, False)]
+        while len(stack) > 0:
+            node, visited = stack.pop()
+            if visited:
+                nodes.append(node)
+            else:
+                stack.append((node, True))
+                children = self.orderedChildren(node, nodePriorities)
+                stack += [(c, False) for c in reversed(children)]
+        return nodes
+
+    def orderedNewick(self, nodePriorities, root):
+        newicks = dict()
+        for node in self.orderedPostOrder(nodePriorities, root):
+            children = self.orderedChildren(node, nodePriorities)
+            parts = []
+            if len(children) > 0:
+                parts.append("(%s)" % ",".join([newicks.pop(c) for c in
+                                                children]))
+            name = self.tree.getName(node)
+            if name is not None:
+                parts.append(name)
+            if self.tree.hasParent(node):
+                weight = self.tree.getWeight(self.tree.getParent(node), node)
+                if weight is not None:
+                    parts.append(":%s" % repr(float(weight)))
+            newicks[node] = "".join(parts)
+        return newicks[root]
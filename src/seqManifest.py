@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2012 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import json
+import hashlib
+from multiprocessing import Pool, cpu_count
+
+from fastaScanner import sequenceFiles, pathSignature
+
+###############################################################################
+# Sampled content fingerprint of a sequence path.  Small files are hashed
+# completely, big ones by reading numSamples evenly spaced chunks (always
+# including the first and last) along with the file size.  This catches
+# a genome being swapped for another one under the same path while only
+# reading a few megabytes of each input.
+###############################################################################
+def fingerprintPath(path, sampleSize=1 << 20, numSamples=16):
+    sha = hashlib.sha1()
+    for filePath in sequenceFiles(path):
+        size = os.path.getsize(filePath)
+        sha.update("%s %d\n" % (os.path.basename(filePath), size))
+        seqFile = open(filePath, "rb")
+        if size <= sampleSize * numSamples:
+            offsets = [0]
+            readSize = size
+        else:
+            step = (size - sampleSize) / (numSamples - 1)
+            offsets = [i * step for i in xrange(numSamples)]
+            readSize = sampleSize
+        for offset in offsets:
+            seqFile.seek(offset)
+            sha.update(seqFile.read(readSize))
+        seqFile.close()
+    return sha.hexdigest()
+
+###############################################################################
+# Keep track of the fingerprint of each input genome in a json file in
+# the working directory.  Fingerprints are only recomputed when a
+# path's size or mtime changes (and then in parallel), so checking a
+# resumed alignment against its inputs is cheap.
+###############################################################################
+class SeqManifest:
+    def __init__(self, manifestPath, numProcs=None):
+        self.manifestPath = manifestPath
+        self.numProcs = numProcs
+        if self.numProcs is None:
+            self.numProcs = cpu_count()
+        self.entries = dict()
+        if os.path.isfile(self.manifestPath):
+            try:
+                self.entries = json.load(open(self.manifestPath, "r"))
+            except:
+                sys.stderr.write("Ignoring unreadable sequence manifest "
+                                 "%s\n" % self.manifestPath)
+                self.entries = dict()
+
+    # Fingerprint the leaf genomes of seqFile (their paths as given by the
+    # user, before staging), and return the names of those whose content
+    # differs from what was previously recorded.  Genomes that weren't in
+    # the manifest before are not reported, and nor are those recorded
+    # from their staged copy in the working directory (by older versions),
+    # which can't be compared with the source.
+    def update(self, seqFile):
+        newEntries = dict()
+        todo = []
+        for node in seqFile.tree.postOrderTraversal():
+            if seqFile.tree.isLeaf(node):
+                name = seqFile.tree.getName(node)
+                path = os.path.abspath(seqFile.pathMap[name])
+                entry = { "path" : path, "signature" : pathSignature(path) }
+                oldEntry = self.entries.get(name)
+                if oldEntry is not None and \
+                       oldEntry["path"] == entry["path"] and \
+                       oldEntry["signature"] == entry["signature"]:
+                    entry["fingerprint"] = oldEntry["fingerprint"]
+                else:
+                    todo.append(name)
+                newEntries[name] = entry
+
+        paths = [newEntries[name]["path"] for name in todo]
+        if len(paths) > 1 and self.numProcs > 1:
+            pool = Pool(processes=min(len(paths), self.numProcs))
+            try:
+                fingerprints = pool.map(fingerprintPath, paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            fingerprints = [fingerprintPath(path) for path in paths]
+        for name, fingerprint in zip(todo, fingerprints):
+            newEntries[name]["fingerprint"] = fingerprint
+
+        stageDir = os.path.join(os.path.dirname(os.path.abspath(
+            self.manifestPath)), "sequenceData") + os.sep
+        changed = []
+        for name, entry in newEntries.items():
+            oldEntry = self.entries.get(name)
+            if oldEntry is None or (
+                oldEntry["path"] != entry["path"] and
+                oldEntry["path"].startswith(stageDir)):
+                continue
+            if oldEntry["fingerprint"] != entry["fingerprint"]:
+                changed.append(name)
+        self.entries = newEntries
+        return sorted(changed)
+
+    def write(self):
+        tempPath = self.manifestPath + ".tmp"
+        manifestFile = open(tempPath, "w")
+        json.dump(self.entries, manifestFile, indent=1, sort_keys=True)
+        manifestFile.close()
+        os.rename(tempPath, self.manifestPath)
+
+# Names of the ancestral events (in the tree of a MultiCactusProject)
+# that have at least one of the given genomes beneath them, and
+# therefore need to be re-aligned if those genomes change.
+def affectedEvents(mcProj, genomeNames):
+    tree = mcProj.mcTree
+    nameToId = dict()
+    for node in tree.postOrderTraversal():
+        nameToId[tree.getName(node)] = node
+    events = set()
+    for name in genomeNames:
+        if name not in nameToId:
+            continue
+        node = nameToId[name]
+        while tree.hasParent(node):
+            node = tree.getParent(node)
+            if tree.getName(node) in mcProj.expMap:
+                events.add(tree.getName(node))
+    return sorted(events)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import re
+import json
+import shutil
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+from fastaScanner import FastaScanner, sequenceFiles, pathSignature
+from fastaScanner import readBlocks, headerName
+
+invalidNameChars = re.compile(r"[^A-Za-z0-9_.\-]")
+
+# A valid version of the first word of header that isn't in usedNames,
+# followed by the rest of the header
+def normalizeHeader(header, usedNames):
+    header = header.strip()
+    name = invalidNameChars.sub("_", headerName(header))
+    if name == "":
+        name = "sequence"
+    if name in usedNames:
+        i = 2
+        while "%s.%d" % (name, i) in usedNames:
+            i += 1
+        name = "%s.%d" % (name, i)
+    usedNames.add(name)
+    rest = header[len(headerName(header)):]
+    return name + rest
+
+# Copy a FASTA file to outFile with its headers normalized and carriage
+# returns removed, a block at a time.  Sequence bytes are written out as
+# they're read, so only a header line that's split between blocks is ever
+# carried over, and a genome on a single unwrapped line is no slower (and
+# needs no more memory) than a wrapped one.  A missing newline at the end
+# of the file is added.
+def normalizeFile(sourcePath, outFile, bufferSize, usedNames):
+    # the header line being read (without the '>'), if we're in one
+    header = None
+    lineStart = True
+    for block in readBlocks(sourcePath, bufferSize):
+        if "\r" in block:
+            block = block.replace("\r", "")
+        pos = 0
+        while pos < len(block):
+            if header is not None:
+                eol = block.find("\n", pos)
+                if eol < 0:
+                    header += block[pos:]
+                    break
+                header += block[pos:eol]
+                outFile.write(">%s\n" % normalizeHeader(header, usedNames))
+                header = None
+                lineStart = True
+                pos = eol + 1
+            elif lineStart and block[pos] == ">":
+                header = ""
+                pos += 1
+            else:
+                gt = block.find("\n>", pos)
+                if gt < 0:
+                    outFile.write(block[pos:])
+                    lineStart = block.endswith("\n")
+                    break
+                outFile.write(block[pos:gt + 1])
+                lineStart = True
+                pos = gt + 1
+    if header is not None:
+        outFile.write(">%s\n" % normalizeHeader(header, usedNames))
+    elif not lineStart:
+        outFile.write("\n")
+
+# Copy the FASTA files of a genome to the given targets with their headers
+# normalized (run in a worker process).  The files are read in big blocks
+# and only the header lines are touched, so this runs at about the speed
+# of the disk.
+def normalizeGenome(args):
+    sourceFiles, targetFiles, bufferSize = args
+    usedNames = set()
+    for sourcePath, targetPath in zip(sourceFiles, targetFiles):
+        outFile = open(targetPath, "wb")
+        normalizeFile(sourcePath, outFile, bufferSize, usedNames)
+        outFile.close()
+
+# Stage a file that needs no changes without copying its bytes: a hard
+# link if it's on the same filesystem, otherwise a reflink (copy on write
+# clone) if the filesystem supports them.  Returns False if neither works.
+def linkFile(sourcePath, targetPath):
+    if os.path.lexists(targetPath):
+        os.remove(targetPath)
+    try:
+        os.link(sourcePath, targetPath)
+        return True
+    except OSError:
+        pass
+    devNull = open(os.devnull, "w")
+    ret = subprocess.call(["cp", "--reflink=always", sourcePath, targetPath],
+                          stderr=devNull)
+    devNull.close()
+    if ret != 0 and os.path.lexists(targetPath):
+        os.remove(targetPath)
+    return ret == 0
+
+# Warning about the soft-masking of a genome, or None if it looks fine
+def maskingWarning(name, stats):
+    if stats["length"] == 0:
+        return None
+    if stats["masked"] == 0:
+        return ("%s has no soft-masked (lowercase) bases.  Progressive "
+                "Cactus expects repeats to be soft-masked, and will be much "
+                "slower and produce spurious alignments without it." % name)
+    if stats["masked"] == stats["length"]:
+        return ("%s is entirely lowercase, so every base will be treated "
+                "as a repeat and nothing will be aligned to it." % name)
+    return None
+
+###############################################################################
+# Preprocess the input genomes into stageDir, so that cactus gets FASTA
+# it won't choke on:
+# - the first word of each header is made a unique, valid sequence name
+#   (invalid characters become '_', and repeats get a .2, .3... suffix)
+# - carriage returns are removed
+# - soft-masking is checked, with a warning for genomes that have none
+#   or are entirely lowercase
+#
+# What needs fixing comes from the FastaScanner stats, which the sanity
+# check has usually cached already, so clean genomes aren't read again.
+# They are staged as hard links or reflinks (or just used in place when
+# neither is possible), which takes no time or space.  Genomes that do
+# need fixing are rewritten by a pool of workers, one per genome.
+# Genomes already inside stageDir's parent (ie decompressed by the
+# SequenceStager) are used in place when clean.
+###############################################################################
+class SequencePreprocessor:
+    manifestName = ".preprocessedSequences.json"
+    def __init__(self, stageDir, scanner, numProcs=None,
+                 bufferSize=1 << 24):
+        self.stageDir = os.path.abspath(stageDir)
+        self.scanner = scanner
+        self.numProcs = numProcs
+        if self.numProcs is None:
+            self.numProcs = cpu_count()
+        self.bufferSize = bufferSize
+        self.manifestPath = os.path.join(self.stageDir,
+                                         SequencePreprocessor.manifestName)
+        self.entries = dict()
+        if os.path.isfile(self.manifestPath):
+            try:
+                self.entries = json.load(open(self.manifestPath, "r"))
+            except:
+                self.entries = dict()
+        # lines describing what was done, for the log
+        self.messages = []
+
+    # Preprocess the given genomes in pathMap and return a copy of
+    # pathMap with the paths of their staged versions
+    def preprocess(self, pathMap, names):
+        if not os.path.isdir(self.stageDir):
+            os.makedirs(self.stageDir)
+        newPathMap = dict(pathMap)
+        statsMap = self.scanner.scan([pathMap[name] for name in names])
+        dirty = []
+        numLinked = 0
+        for name in names:
+            sourcePath = os.path.abspath(pathMap[name])
+            stats = statsMap[pathMap[name]]
+            warning = maskingWarning(name, stats)
+            if warning is not None:
+                self.messages.append("WARNING: " + warning)
+            targetPath = os.path.join(self.stageDir, name)
+            if not os.path.isdir(sourcePath):
+                targetPath += ".fa"
+            entry = self.entries.get(name)
+            if entry is not None and entry["source"] == sourcePath and \
+                   entry["signature"] == pathSignature(sourcePath) and \
+                   os.path.exists(entry["target"]):
+                newPathMap[name] = entry["target"]
+            elif stats["badHeaders"] == 0 and \
+                     stats["duplicateHeaders"] == 0 and \
+                     stats["carriageReturns"] == 0:
+                newPathMap[name] = self.linkGenome(sourcePath, targetPath)
+                if newPathMap[name] != sourcePath:
+                    numLinked += 1
+                self.setEntry(name, sourcePath, newPathMap[name], stats)
+            else:
+                self.messages.append(
+                    "%s: fixing %d invalid and %d duplicate header names "
+                    "and %d carriage returns" % (
+                        name, stats["badHeaders"], stats["duplicateHeaders"],
+                        stats["carriageReturns"]))
+                dirty.append((name, sourcePath, targetPath, stats))
+                newPathMap[name] = targetPath
+        if numLinked > 0:
+            self.messages.append("%d clean genome(s) staged without "
+                                 "copying" % numLinked)
+        self.rewrite(dirty)
+        self.write()
+        self.scanner.writeCache()
+        return newPathMap
+
+    # Stage a clean genome, returning its staged path
+    def linkGenome(self, sourcePath, targetPath):
+        if os.path.dirname(sourcePath).startswith(
+            os.path.dirname(self.stageDir) + os.sep):
+            # already staged by us
+            return sourcePath
+        if not os.path.isdir(sourcePath):
+            if linkFile(sourcePath, targetPath):
+                return targetPath
+            return sourcePath
+        if os.path.isdir(targetPath):
+            shutil.rmtree(targetPath)
+        os.mkdir(targetPath)
+        for filePath in sequenceFiles(sourcePath):
+            fileTarget = os.path.join(targetPath, os.path.basename(filePath))
+            if not linkFile(filePath, fileTarget):
+                os.symlink(filePath, fileTarget)
+        return targetPath
+
+    def rewrite(self, dirty):
+        if len(dirty) == 0:
+            return
+        jobs = []
+        for name, sourcePath, targetPath, stats in dirty:
+            sourceFiles = sequenceFiles(sourcePath)
+            if os.path.isdir(sourcePath):
+                if os.path.isdir(targetPath):
+                    shutil.rmtree(targetPath)
+                os.mkdir(targetPath)
+                targetFiles = [os.path.join(targetPath, os.path.basename(f))
+                               for f in sourceFiles]
+            else:
+                targetFiles = [targetPath]
+            jobs.append((sourceFiles, targetFiles, self.bufferSize))
+        pool = Pool(processes=max(1, min(len(jobs), self.numProcs)))
+        try:
+            pool.map(normalizeGenome, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        for name, sourcePath, targetPath, stats in dirty:
+            fixedStats = dict(stats)
+            fixedStats["badHeaders"] = 0
+            fixedStats["duplicateHeaders"] = 0
+            fixedStats["carriageReturns"] = 0
+            self.setEntry(name, sourcePath, targetPath, fixedStats)
+
+    # remember what a genome was staged as, and what the scanner would
+    # find in the staged version
+    def setEntry(self, name, sourcePath, targetPath, stats):
+        self.entries[name] = { "source" : sourcePath,
+                               "target" : targetPath,
+                               "signature" : pathSignature(sourcePath) }
+        if targetPath != sourcePath:
+            self.scanner.setStats(targetPath, stats)
+
+    def write(self):
+        tempPath = self.manifestPath + ".tmp"
+        manifestFile = open(tempPath, "w")
+        json.dump(self.entries, manifestFile, indent=1, sort_keys=True)
+        manifestFile.close()
+        os.rename(tempPath, self.manifestPath)
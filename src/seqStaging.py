@@ -0,0 +1,241 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import json
+import zlib
+import struct
+import shutil
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+from fastaScanner import sequenceFiles, pathSignature, compressionType
+from seqManifest import fingerprintPath
+
+# Every BGZF block starts with a gzip header with a 6 byte "BC" extra
+# field holding the size of the block
+bgzfMagic = "\x1f\x8b\x08\x04"
+bgzfHeaderSize = 18
+
+def isBgzf(filePath):
+    if compressionType(filePath) != "gzip":
+        return False
+    inFile = open(filePath, "rb")
+    header = inFile.read(bgzfHeaderSize)
+    inFile.close()
+    return len(header) == bgzfHeaderSize and \
+           header[:4] == bgzfMagic and header[12:14] == "BC"
+
+# (offset, length) ranges of whole BGZF blocks, each about batchBytes
+# long, covering the file.  Only the block headers are read.
+def bgzfRanges(filePath, batchBytes):
+    ranges = []
+    size = os.path.getsize(filePath)
+    inFile = open(filePath, "rb")
+    start, pos = 0, 0
+    while pos < size:
+        inFile.seek(pos)
+        header = inFile.read(bgzfHeaderSize)
+        if len(header) < bgzfHeaderSize or header[:4] != bgzfMagic or \
+               header[12:14] != "BC":
+            inFile.close()
+            raise RuntimeError("Invalid BGZF block at offset %d of %s" % (
+                pos, filePath))
+        pos += struct.unpack("<H", header[16:18])[0] + 1
+        if pos - start >= batchBytes:
+            ranges.append((start, pos - start))
+            start = pos
+    inFile.close()
+    if pos > start:
+        ranges.append((start, pos - start))
+    return ranges
+
+# Inflate the BGZF blocks in a range of a file (run in a worker process)
+def inflateBgzfRange(args):
+    filePath, offset, length = args
+    inFile = open(filePath, "rb")
+    inFile.seek(offset)
+    data = inFile.read(length)
+    inFile.close()
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        extraLen = struct.unpack("<H", data[pos + 10:pos + 12])[0]
+        blockSize = struct.unpack("<H", data[pos + 16:pos + 18])[0] + 1
+        # the deflated data sits between the header and the crc32/size
+        chunks.append(zlib.decompress(
+            data[pos + 12 + extraLen:pos + blockSize - 8], -15))
+        pos += blockSize
+    return "".join(chunks)
+
+# Decompress a whole (non-BGZF) file with gzip or xz (run in a worker
+# process)
+def decompressFile(args):
+    sourcePath, targetPath = args
+    outFile = open(targetPath, "wb")
+    try:
+        ret = subprocess.call([compressionType(sourcePath), "-dc",
+                               sourcePath], stdout=outFile)
+    finally:
+        outFile.close()
+    if ret != 0:
+        raise RuntimeError("Unable to decompress %s" % sourcePath)
+
+# Name of the decompressed version of a file
+def decompressedName(filePath):
+    if compressionType(filePath) is not None:
+        return os.path.splitext(os.path.basename(filePath))[0]
+    return os.path.basename(filePath)
+
+###############################################################################
+# Decompress compressed (.gz, .bgz or .xz) input sequences into stageDir,
+# so that cactus only ever sees plain FASTA.  A sequence path that is a
+# directory is staged as a directory of decompressed files (with links to
+# any files in it that weren't compressed).
+#
+# All the files are decompressed by one pool of worker processes.  BGZF
+# files are split into ranges of blocks that are inflated in parallel and
+# written out in order.  Other files are each decompressed by one worker
+# running gzip or xz.
+#
+# What was staged is recorded in a json file in stageDir along with the
+# fingerprint (see seqManifest) of each source, and sources whose
+# fingerprint hasn't changed since the last run aren't decompressed again.
+###############################################################################
+class SequenceStager:
+    manifestName = ".stagedSequences.json"
+    def __init__(self, stageDir, numProcs=None, batchBytes=1 << 23):
+        self.stageDir = os.path.abspath(stageDir)
+        self.numProcs = numProcs
+        if self.numProcs is None:
+            self.numProcs = cpu_count()
+        self.batchBytes = batchBytes
+        self.manifestPath = os.path.join(self.stageDir,
+                                         SequenceStager.manifestName)
+        self.entries = dict()
+        self.modified = False
+        if os.path.isfile(self.manifestPath):
+            try:
+                self.entries = json.load(open(self.manifestPath, "r"))
+            except:
+                sys.stderr.write("Ignoring unreadable staging manifest "
+                                 "%s\n" % self.manifestPath)
+                self.entries = dict()
+
+    # Stage the sequences of the given genomes in pathMap, and return a
+    # copy of pathMap with their staged paths
+    def stage(self, pathMap, names):
+        newPathMap = dict(pathMap)
+        todo = []
+        for name in names:
+            sourcePath = os.path.abspath(pathMap[name])
+            if len([f for f in sequenceFiles(sourcePath)
+                    if compressionType(f) is not None]) == 0:
+                continue
+            targetPath = os.path.join(self.stageDir, name)
+            if not os.path.isdir(sourcePath):
+                targetPath += ".fa"
+            newPathMap[name] = targetPath
+            if not self.isStaged(name, sourcePath, targetPath):
+                todo.append((name, sourcePath, targetPath))
+        if len(todo) > 0:
+            if not os.path.isdir(self.stageDir):
+                os.makedirs(self.stageDir)
+            self.decompress(todo)
+        if self.modified:
+            self.write()
+        return newPathMap
+
+    # Is the staged copy of a genome up to date with its source?  The
+    # fingerprint is only computed if the source's size or mtime changed.
+    def isStaged(self, name, sourcePath, targetPath):
+        entry = self.entries.get(name)
+        signature = pathSignature(sourcePath)
+        if entry is None or entry["source"] != sourcePath or \
+               entry["target"] != targetPath or \
+               not os.path.exists(targetPath):
+            return False
+        if entry["signature"] == signature:
+            return True
+        if entry["fingerprint"] == fingerprintPath(sourcePath):
+            entry["signature"] = signature
+            self.modified = True
+            return True
+        return False
+
+    def decompress(self, todo):
+        # (source file, temporary target file) of every file to stage
+        wholeFiles = []
+        bgzfFiles = []
+        for name, sourcePath, targetPath in todo:
+            tempPath = targetPath + ".tmp"
+            if os.path.isdir(tempPath):
+                shutil.rmtree(tempPath)
+            if os.path.isdir(sourcePath):
+                os.mkdir(tempPath)
+                for filePath in sequenceFiles(sourcePath):
+                    fileTarget = os.path.join(tempPath,
+                                              decompressedName(filePath))
+                    if compressionType(filePath) is None:
+                        os.symlink(filePath, fileTarget)
+                    elif isBgzf(filePath):
+                        bgzfFiles.append((filePath, fileTarget))
+                    else:
+                        wholeFiles.append((filePath, fileTarget))
+            elif isBgzf(sourcePath):
+                bgzfFiles.append((sourcePath, tempPath))
+            else:
+                wholeFiles.append((sourcePath, tempPath))
+
+        pool = Pool(processes=self.numProcs)
+        try:
+            results = [pool.apply_async(decompressFile, (args,))
+                       for args in wholeFiles]
+            for sourcePath, targetPath in bgzfFiles:
+                ranges = [(sourcePath, offset, length) for offset, length in
+                          bgzfRanges(sourcePath, self.batchBytes)]
+                outFile = open(targetPath, "wb")
+                for data in pool.imap(inflateBgzfRange, ranges):
+                    outFile.write(data)
+                outFile.close()
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+        for name, sourcePath, targetPath in todo:
+            if os.path.isdir(targetPath):
+                shutil.rmtree(targetPath)
+            os.rename(targetPath + ".tmp", targetPath)
+            self.entries[name] = {
+                "source" : sourcePath,
+                "target" : targetPath,
+                "signature" : pathSignature(sourcePath),
+                "fingerprint" : fingerprintPath(sourcePath) }
+            self.modified = True
+
+    def write(self):
+        tempPath = self.manifestPath + ".tmp"
+        manifestFile = open(tempPath, "w")
+        json.dump(self.entries, manifestFile, indent=1, sort_keys=True)
+        manifestFile.close()
+        os.rename(tempPath, self.manifestPath)
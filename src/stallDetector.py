@@ -0,0 +1,89 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+###############################################################################
+# Decide when a running alignment has stopped making progress, from how
+# often it usually shows signs of progress rather than from a fixed timer.
+#
+# Each poll, observe() is given the amount of each progress signal seen
+# since the last poll (ie job files changed, jobs completed, bytes added to
+# the log).  Whenever any of them is positive, the time since the previous
+# sign of progress is folded into a running (exponentially weighted) mean
+# gap.  The alignment is stalled once it's been quiet for sensitivity times
+# that mean gap, but never less than minStallTime or more than
+# maxStallTime.  So a phase that's busy every minute is flagged after a
+# few quiet minutes, while a phase that only finishes a job every hour has
+# to be quiet for a good deal longer.
+#
+# pollInterval() suggests how long to wait before the next poll: half the
+# mean gap (the threshold over twice the sensitivity).  The gaps we see
+# can't be shorter than the time between polls, so polling any less often
+# than the mean gap would feed back into it and make it grow without
+# bound; at half of it, the gaps we see converge on the real ones.
+###############################################################################
+class StallDetector:
+    def __init__(self, sensitivity=8.0, minStallTime=300, maxStallTime=14400,
+                 smoothing=0.2, now=None):
+        self.sensitivity = sensitivity
+        self.minStallTime = minStallTime
+        self.maxStallTime = maxStallTime
+        self.smoothing = smoothing
+        if now is None:
+            now = time.time()
+        self.lastProgressTime = now
+        self.meanGap = None
+        # names of the signals that showed progress at the last poll
+        # that had any
+        self.lastSignals = []
+
+    def observe(self, progress, now=None):
+        if now is None:
+            now = time.time()
+        signals = sorted([name for name, amount in progress.items()
+                          if amount > 0])
+        if len(signals) > 0:
+            gap = now - self.lastProgressTime
+            if self.meanGap is None:
+                self.meanGap = gap
+            else:
+                self.meanGap += self.smoothing * (gap - self.meanGap)
+            self.lastProgressTime = now
+            self.lastSignals = signals
+        return self.isStalled(now)
+
+    def stallThreshold(self):
+        threshold = self.minStallTime
+        if self.meanGap is not None:
+            threshold = max(threshold, self.sensitivity * self.meanGap)
+        return min(threshold, self.maxStallTime)
+
+    def idleTime(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.lastProgressTime
+
+    def isStalled(self, now=None):
+        return self.idleTime(now) > self.stallThreshold()
+
+    def pollInterval(self, minPollTime=30, maxPollTime=600):
+        return max(minPollTime, min(maxPollTime, self.stallThreshold() /
+                                    (2. * self.sensitivity)))
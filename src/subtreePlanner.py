@@ -0,0 +1,114 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+from multiprocessing import cpu_count
+
+from ktServerSizing import eventDbSize, formatBytes, headroom
+
+# psutil is a submodule, but don't insist on it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# A running subtree needs a thread for its ktserver, one for the
+# cactus_progressive target waiting on it and at least one to do work
+threadsPerSubtree = 3
+# Fraction of the machine's memory we're willing to hand to ktservers
+memoryFraction = 0.8
+# Subtrees run at once on a cluster when we don't know how many jobs we
+# may issue (and so how many nodes the ktservers will be spread over)
+clusterDefaultSubtrees = 8
+
+# jobTree's --maxJobs, or None if it wasn't given (jobTree defaults it to
+# sys.maxint)
+def jobLimit(maxJobs):
+    if maxJobs is None or int(maxJobs) >= sys.maxint:
+        return None
+    return int(maxJobs)
+
+# Total physical memory of this machine in bytes
+def totalMemory():
+    if psutil is not None:
+        if hasattr(psutil, "virtual_memory"):
+            return psutil.virtual_memory().total
+        if hasattr(psutil, "TOTAL_PHYMEM"):
+            return psutil.TOTAL_PHYMEM
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+# The most events that can ever run at once, which is the number of
+# events that don't depend on any other events
+def maxWidth(costModel):
+    return len([event for event in costModel.events
+                if len(costModel.eventChildren(event)) == 0])
+
+###############################################################################
+# Choose maxParallelSubtrees.  Running more subtrees than there are
+# independent events buys nothing, so the tree's width is always an upper
+# bound.  On a single machine, every subtree needs threadsPerSubtree
+# threads and a ktserver in the machine's memory, so we also bound it by
+# maxThreads and by how many of the biggest ktservers fit in memory
+# together (which leaves room for whichever events end up on the critical
+# path).  On a cluster the ktservers are spread over the nodes, so it's
+# bounded by the number of jobs we're allowed to issue or, if --maxJobs
+# isn't given, by clusterDefaultSubtrees.  The caller also caps it at the
+# config's maxParallelSubtrees.
+#
+# Returns (maxParallelSubtrees, list of lines explaining the choice)
+###############################################################################
+def planMaxParallelSubtrees(costModel, batchSystem, maxThreads=None,
+                            maxJobs=None, memory=None):
+    width = max(1, maxWidth(costModel))
+    reasons = ["tree has %d independent events" % width]
+    limit = width
+    if batchSystem == 'singleMachine':
+        if maxThreads is None:
+            maxThreads = cpu_count()
+        byThreads = max(1, int(maxThreads) / threadsPerSubtree)
+        reasons.append("%s threads allow %d subtrees" % (maxThreads,
+                                                         byThreads))
+        limit = min(limit, byThreads)
+        if memory is None:
+            memory = totalMemory()
+        available = memory * memoryFraction
+        dbSizes = sorted([eventDbSize(costModel, event)[0] * headroom
+                          for event in costModel.events], reverse=True)
+        byMemory = 0
+        used = 0
+        for dbSize in dbSizes:
+            if used + dbSize > available:
+                break
+            used += dbSize
+            byMemory += 1
+        byMemory = max(1, byMemory)
+        reasons.append("%d%% of %s memory fits the %d biggest ktservers" % (
+            int(100 * memoryFraction), formatBytes(memory), byMemory))
+        limit = min(limit, byMemory)
+    elif jobLimit(maxJobs) is not None:
+        byJobs = max(1, jobLimit(maxJobs) / threadsPerSubtree)
+        reasons.append("%s jobs allow %d subtrees" % (maxJobs, byJobs))
+        limit = min(limit, byJobs)
+    else:
+        reasons.append("no --maxJobs given, so at most %d subtrees on a "
+                       "cluster" % clusterDefaultSubtrees)
+        limit = min(limit, clusterDefaultSubtrees)
+    return (limit, reasons)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python2.7
+
+# Progressive Cactus Package
+# Copyright (C) 2009-2013 by Glenn Hickey (hickey@soe.ucsc.edu)
+# and Benedict Paten (benedictpaten@gmail.com)
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import json
+import time
+import signal
+import datetime
+import xml.etree.ElementTree as ET
+from threading import Thread, Event
+
+from sonLib.bioio import system
+
+from cactus.progressive.multiCactusProject import MultiCactusProject
+from cactus.shared.experimentWrapper import ExperimentWrapper
+
+from projectWrapper import ProjectWrapper
+from progressEstimator import eventFinishTime
+from runReport import diskUsage, usageSampler
+from ktServerSizing import formatBytes
+from dirRemover import removeDir
+
+###############################################################################
+# Keep track of (and reclaim) the space used by a working directory.
+#
+# usage() measures the bytes used by each event's directory under
+# progressiveAlignment, by sequenceData and by the jobTree.
+#
+# Once an event is finished, its parent event is finished too (so its
+# output has been consumed) and, if a HAL exporter is given, it has been
+# exported, its intermediates are reclaimed: its database and MAF are
+# deleted, or just compressed if keepIntermediates is set.  The .c2h and
+# .fa files are never touched, because they are what HAL is exported from
+# and what a resumed run uses to tell that the event is done.  If a
+# Checkpoint is given, it's brought up to date before each collection and
+# events only count as finished once they've been recorded in it.
+#
+# cleanup() reclaims what's left once the output has been written.
+###############################################################################
+class WorkDirManager:
+    usageFileName = "diskUsage.json"
+    def __init__(self, workDir, jtPath, keepIntermediates=False,
+                 halExporter=None, checkpoint=None):
+        self.workDir = workDir
+        self.jtPath = jtPath
+        self.keepIntermediates = keepIntermediates
+        self.halExporter = halExporter
+        self.checkpoint = checkpoint
+        self.projectPath = os.path.join(
+            workDir, ProjectWrapper.alignmentDirName,
+            "%s_project.xml" % ProjectWrapper.alignmentDirName)
+        self.mcProj = MultiCactusProject()
+        self.mcProj.readXML(self.projectPath)
+        self.usagePath = os.path.join(workDir, WorkDirManager.usageFileName)
+        tree = self.mcProj.mcTree
+        self.parentEvent = dict()
+        for node in tree.postOrderTraversal():
+            name = tree.getName(node)
+            if name not in self.mcProj.expMap:
+                continue
+            self.parentEvent[name] = None
+            parent = node
+            while tree.hasParent(parent):
+                parent = tree.getParent(parent)
+                if tree.getName(parent) in self.mcProj.expMap:
+                    self.parentEvent[name] = tree.getName(parent)
+                    break
+        # bytes reclaimed so far
+        self.reclaimed = 0
+
+    def experiment(self, event):
+        return ExperimentWrapper(ET.parse(
+            self.mcProj.expMap[event]).getroot())
+
+    # Directory holding an event's experiment and outputs
+    def eventDir(self, event):
+        return os.path.dirname(os.path.abspath(self.mcProj.expMap[event]))
+
+    # Paths of an event's files that nothing needs once it's been
+    # consumed and exported
+    def intermediates(self, event):
+        exp = self.experiment(event)
+        paths = []
+        for path in [exp.getDbDir(), exp.getMAFPath()]:
+            if path is not None and os.path.exists(path):
+                paths.append(path)
+        return paths
+
+    def isFinished(self, event):
+        if self.checkpoint is not None:
+            return self.checkpoint.isComplete(event)
+        return eventFinishTime(self.mcProj.expMap[event]) is not None
+
+    def isReclaimable(self, event):
+        if not self.isFinished(event):
+            return False
+        parent = self.parentEvent[event]
+        if parent is not None and not self.isFinished(parent):
+            return False
+        return self.halExporter is None or self.halExporter.isExported(event)
+
+    # Delete (or compress) a path, returning the bytes freed
+    def reclaimPath(self, path):
+        before = diskUsage(path)
+        if self.keepIntermediates:
+            if os.path.isdir(path):
+                system("tar -czf '%s.tar.gz' -C '%s' '%s' && rm -rf '%s'" % (
+                    path, os.path.dirname(path), os.path.basename(path),
+                    path))
+                after = diskUsage(path + ".tar.gz")
+            else:
+                system("gzip -f '%s'" % path)
+                after = diskUsage(path + ".gz")
+        else:
+            removeDir(path, background=False)
+            after = 0
+        if before is None or after is None:
+            return 0
+        return max(0, before - after)
+
+    # Reclaim the intermediates of every event that can be, and return
+    # the bytes freed.  If stopEvent is given, stop as soon as it's set.
+    def collect(self, stopEvent=None):
+        if self.checkpoint is not None:
+            self.checkpoint.update()
+        freed = 0
+        for event in self.parentEvent:
+            if stopEvent is not None and stopEvent.is_set():
+                break
+            if not self.isReclaimable(event):
+                continue
+            for path in self.intermediates(event):
+                freed += self.reclaimPath(path)
+        self.reclaimed += freed
+        return freed
+
+    # Reclaim everything that isn't needed once the output is written:
+    # the intermediates of all the events, the jobTree and the exported
+    # HAL pieces (which are only kept when keepIntermediates is set)
+    def cleanup(self):
+        if self.checkpoint is not None:
+            # nothing is being written any more
+            self.checkpoint.update(0)
+        halExporter = self.halExporter
+        self.halExporter = None
+        try:
+            self.collect()
+        finally:
+            self.halExporter = halExporter
+        if not self.keepIntermediates:
+            for path in [self.jtPath, os.path.join(self.workDir, "halExport")]:
+                if os.path.exists(path):
+                    self.reclaimed += self.reclaimPath(path)
+        self.write(self.usage())
+
+    # Bytes used by the working directory, its parts and each event,
+    # measured with one walk of the working directory (see
+    # DiskUsageSampler)
+    def usage(self):
+        events = sorted(self.parentEvent.keys())
+        sizes = usageSampler(self.workDir).usages(
+            [self.workDir, os.path.join(self.workDir, "sequenceData"),
+             self.jtPath] + [self.eventDir(event) for event in events])
+        return { "time" : time.time(),
+                 "total" : sizes[0],
+                 "sequenceData" : sizes[1],
+                 "jobTree" : sizes[2],
+                 "events" : dict(zip(events, sizes[3:])),
+                 "reclaimed" : self.reclaimed }
+
+    def write(self, usage):
+        tempPath = self.usagePath + ".tmp"
+        usageFile = open(tempPath, "w")
+        json.dump(usage, usageFile, indent=1, sort_keys=True)
+        usageFile.close()
+        os.rename(tempPath, self.usagePath)
+
+###############################################################################
+# Run a WorkDirManager in the background while the alignment runs,
+# reclaiming space and writing <workDir>/diskUsage.json every pollTime
+# seconds.  It's only run when --reclaimDuringRun or --diskQuota is
+# given, since measuring a big working directory isn't free.
+#
+# If a diskQuota (in bytes) is given, cactus_progressive (whose pid is set
+# with setPid()) is paused with SIGSTOP whenever the working directory is
+# still over the quota after reclaiming what it can, so no new subtrees
+# are started, and resumed with SIGCONT once usage drops below
+# resumeFraction of the quota.  Jobs already running carry on while it's
+# paused.  A paused alignment can only get back under the quota if its
+# running jobs finish events that can then be reclaimed, so if nothing has
+# been reclaimed for maxStuckPolls polls in a row it's resumed with a
+# warning, and the quota isn't enforced again until usage has dropped back
+# below resumeFraction of it.
+###############################################################################
+class WorkDirThread(Thread):
+    resumeFraction = 0.9
+    def __init__(self, manager, diskQuota=None, pollTime=300,
+                 maxStuckPolls=3):
+        Thread.__init__(self)
+        self.manager = manager
+        self.diskQuota = diskQuota
+        self.pollTime = pollTime
+        self.maxStuckPolls = maxStuckPolls
+        self.pid = None
+        self.paused = False
+        # polls in a row that the alignment was paused and nothing could
+        # be reclaimed
+        self.stuckPolls = 0
+        self.quotaWaived = False
+        self.stopEvent = Event()
+        self.daemon = True
+
+    def setPid(self, pid):
+        self.pid = pid
+
+    def __message(self, msg):
+        sys.stderr.write("%s: %s\n" % (str(datetime.datetime.now()), msg))
+
+    def __signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+            return True
+        except OSError:
+            return False
+
+    # Pause or resume the alignment given the working directory's total
+    # size and the bytes freed by the last collection
+    def throttle(self, total, freed=0):
+        if self.diskQuota is None or self.pid is None or total is None:
+            return
+        belowResume = total < self.diskQuota * WorkDirThread.resumeFraction
+        if self.quotaWaived and belowResume:
+            self.quotaWaived = False
+        if not self.paused and total > self.diskQuota and \
+               not self.quotaWaived:
+            if self.__signal(signal.SIGSTOP):
+                self.paused = True
+                self.stuckPolls = 0
+                self.__message("Working directory uses %s, which is over the "
+                               "disk quota of %s.  Pausing the alignment "
+                               "until space is freed" % (
+                                   formatBytes(total),
+                                   formatBytes(self.diskQuota)))
+        elif self.paused and belowResume:
+            self.resume()
+        elif self.paused:
+            if freed > 0:
+                self.stuckPolls = 0
+            else:
+                self.stuckPolls += 1
+            if self.stuckPolls >= self.maxStuckPolls:
+                self.quotaWaived = True
+                self.__message("WARNING: the alignment has been paused for "
+                               "%d polls and nothing more can be reclaimed, "
+                               "so the working directory (%s) can't get "
+                               "back under the disk quota of %s.  Resuming "
+                               "the alignment, which will exceed the quota." %
+                               (self.stuckPolls, formatBytes(total),
+                                formatBytes(self.diskQuota)))
+                self.resume()
+            else:
+                self.__message("Alignment still paused: working directory "
+                               "uses %s (disk quota %s)" % (
+                                   formatBytes(total),
+                                   formatBytes(self.diskQuota)))
+
+    def resume(self):
+        if self.paused:
+            self.__signal(signal.SIGCONT)
+            self.paused = False
+            self.__message("Resuming the alignment")
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                freed = self.manager.collect(self.stopEvent)
+                usage = self.manager.usage()
+                usage["paused"] = self.paused
+                self.manager.write(usage)
+                self.throttle(usage["total"], freed)
+            except Exception, e:
+                self.__message("Working directory cleanup failed: %s" %
+                               str(e))
+            self.stopEvent.wait(self.pollTime)
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+        self.resume()